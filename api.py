@@ -0,0 +1,567 @@
+"""Headless JSON API over the library.
+
+    GET    /books                  a page of books; facet filters, sort and paging in the query string
+    POST   /books                  add a book, or a list of books
+    POST   /batch                  add, update and delete many books in one batch
+    GET    /books/<id>
+    PATCH  /books/<id>             change some of a book's fields
+    DELETE /books/<id>
+    GET    /search?q=<query>       full-text search, with a corrected query when nothing matches
+    GET    /search/complete?q=     completions of the last word of a query
+    GET    /facets                 facet counts for the filters in the query string
+    GET    /stats                  the Dashboard counts and the Statistics aggregates
+    GET    /recommendations        unread books like the highly rated ones; ?exclude=<id>&exclude=...
+    GET    /collections
+    GET    /collections/<name>
+    PUT    /collections/<name>     {"book_ids": [...]}
+    POST   /collections/<name>     {"add": [...], "remove": [...], "move": [...], "position": n}
+    DELETE /collections/<name>
+    GET    /reading-list
+    POST   /reading-list           {"add": [...], "remove": [...], "move": [...], "position": n}
+    GET    /libraries              the library names
+
+Any path can be prefixed with ``/libraries/<name>`` to use a named library.
+
+    python api.py --port 8000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import tornado.ioloop
+import tornado.web
+
+from charts import FigureCache, library_aggregates
+from facets import normalize_filters
+from repository import DUPLICATE_MODES, SORT_FIELDS, JsonRepository, SqliteRepository
+from sharding import ShardedRepository, list_libraries
+from storage import JournalStore, StoreBusyError, apply_journal
+
+MAIN_LIBRARY = "Main Library"
+LIBRARY_FILE = "library.json"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+# Threads running repository calls for requests.
+API_WORKERS = 8
+# Books per page when a request gives no ``limit``, and the most it may ask for.
+PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 1000
+COMPLETIONS = 5
+
+# JSON type of each known book field a client may send; other fields are kept as sent.
+FIELD_TYPES = {
+    'id': str, 'title': str, 'author': str, 'year': int, 'genre': str, 'read': bool,
+    'rating': int, 'notes': str, 'isbn': str, 'tags': list, 'date_added': str,
+}
+# Fields that may also be null.
+OPTIONAL_FIELDS = ['year', 'genre', 'rating', 'notes', 'isbn', 'tags']
+TYPE_NAMES = {str: "a string", int: "an integer", bool: "true or false", list: "a list"}
+
+# Facet filters read from the query string; the others take several values.
+_LIST_FACETS = ['genre', 'author', 'tags', 'collection']
+
+
+class Libraries:
+    """Opens each library once, on first use, and shares it between requests."""
+
+    def __init__(self, backend=None, library_file=LIBRARY_FILE, db_file=None, root=None, binary_snapshot=None):
+        self.backend = (backend or os.environ.get("LIBRARY_BACKEND", "json")).lower()
+        self.library_file = library_file
+        self.db_file = db_file or os.environ.get("LIBRARY_DB", "library.db")
+        self.root = root or os.environ.get("LIBRARY_ROOT", "libraries")
+        if binary_snapshot is None:
+            binary_snapshot = os.environ.get("LIBRARY_BINARY_SNAPSHOT", "1") != "0"
+        self.binary_snapshot = binary_snapshot
+        self.figures = FigureCache()
+        self._repositories = {}
+        self._lock = threading.Lock()
+
+    def names(self):
+        return [MAIN_LIBRARY] + list_libraries(self.root)
+
+    def _open(self, name):
+        if name != MAIN_LIBRARY:
+            return ShardedRepository.open(os.path.join(self.root, name), binary_snapshot=self.binary_snapshot)
+        store = JournalStore(self.library_file, binary_snapshot=self.binary_snapshot)
+        if self.backend == "sqlite":
+            repo = SqliteRepository(self.db_file)
+            # Seed a new database from the existing JSON library, as the app does.
+            if repo.is_empty() and os.path.exists(self.library_file):
+                data = store.open()
+                # A library file that is not a JSON object leaves the database empty, as in the app.
+                if isinstance(data, dict):
+                    repo.replace(apply_journal(data))
+                    store.write_quarantine()
+            return repo
+        return JsonRepository.open(store)
+
+    def get(self, name=None):
+        """Return the repository of library ``name`` (the main one for ``None``), up to date with other processes.
+
+        Raises ``KeyError`` for an unknown library.
+        """
+        name = name or MAIN_LIBRARY
+        with self._lock:
+            repo = self._repositories.get(name)
+            if repo is None:
+                if name not in self.names():
+                    raise KeyError(name)
+                repo = self._repositories[name] = self._open(name)
+        # Pick up changes the app or another server made to the library files.
+        if repo.is_stale():
+            repo.refresh()
+        return repo
+
+
+def encode_cursor(position, key):
+    """Return the cursor of the page at ``position`` (any JSON value) of the query ``key`` identifies."""
+    return base64.urlsafe_b64encode(json.dumps([position, key]).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, key):
+    """Return the position ``cursor`` points at; raises ``ValueError`` if it is not a cursor of query ``key``."""
+    try:
+        position, cursor_key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if cursor_key != key:
+        raise ValueError("The cursor belongs to a different query")
+    return position
+
+
+def check_fields(fields):
+    """Raise ``ValueError`` if a known book field in ``fields`` holds a value of the wrong JSON type."""
+    for name, value in fields.items():
+        expected = FIELD_TYPES.get(name)
+        if expected is None or (value is None and name in OPTIONAL_FIELDS):
+            continue
+        # JSON true and false are ints to Python, but not years or ratings.
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            raise ValueError(f"{name} must be {TYPE_NAMES[expected]}")
+        if name == 'tags' and not all(isinstance(tag, str) for tag in value):
+            raise ValueError("tags must list strings")
+        if name in ('title', 'author') and not value:
+            raise ValueError(f"{name} cannot be empty")
+
+
+def new_book(book):
+    """Check a book sent by a client and fill in its id and date added."""
+    if not isinstance(book, dict):
+        raise ValueError("A book must be a JSON object")
+    if not book.get('title') or not book.get('author'):
+        raise ValueError("A book needs a title and an author")
+    check_fields(book)
+    book = dict(book)
+    book.setdefault('id', str(uuid.uuid4()))
+    book.setdefault('date_added', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    return book
+
+
+def book_changes(changes):
+    """Check the fields a client wants to change on a book."""
+    if not isinstance(changes, dict):
+        raise ValueError("Changes must be a JSON object")
+    if 'id' in changes:
+        raise ValueError("A book's id cannot be changed")
+    check_fields(changes)
+    return changes
+
+
+class LibraryHandler(tornado.web.RequestHandler):
+    """Base handler: finds the library, answers conditional GETs and writes JSON."""
+
+    def initialize(self, libraries, executor):
+        self.libraries = libraries
+        self.executor = executor
+        self.repo = None
+
+    def set_default_headers(self):
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        # Clients may cache responses but must check the ETag first.
+        self.set_header("Cache-Control", "no-cache")
+
+    async def call(self, function, *args):
+        """Run a blocking repository call on the worker threads, turning library errors into HTTP errors."""
+        try:
+            return await tornado.ioloop.IOLoop.current().run_in_executor(self.executor, function, *args)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        except StoreBusyError as e:
+            raise tornado.web.HTTPError(503, str(e))
+
+    async def prepare(self):
+        name = self.path_args[0] if self.path_args else None
+        try:
+            self.repo = await self.call(self.libraries.get, name)
+        except KeyError:
+            raise tornado.web.HTTPError(404, f"No library named '{name}'")
+        if self.request.method in ("GET", "HEAD"):
+            version = await self.call(lambda: self.repo.version)
+            self.set_header("Etag", f'W/"{version}"')
+            if self.check_etag_header():
+                self.set_status(304)
+                self.finish()
+
+    def compute_etag(self):
+        # The version set in ``prepare`` covers every GET; no body hash needed.
+        return None
+
+    def body(self):
+        try:
+            return json.loads(self.request.body or b'null')
+        except ValueError:
+            raise tornado.web.HTTPError(400, "The request body is not valid JSON")
+
+    def send(self, data, status=200):
+        self.set_status(status)
+        self.finish(json.dumps(data))
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs.get('exc_info', (None, None))[1]
+        message = getattr(error, 'log_message', None) or self._reason
+        self.finish(json.dumps({'error': message}))
+
+    def limit(self):
+        try:
+            limit = int(self.get_argument('limit', PAGE_LIMIT))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "limit must be a number")
+        if not 1 <= limit <= MAX_PAGE_LIMIT:
+            raise tornado.web.HTTPError(400, f"limit must be between 1 and {MAX_PAGE_LIMIT}")
+        return limit
+
+    def page_position(self, valid):
+        """Return the position the request's cursor points at (``None`` without one), checked against the rest of the query.
+
+        ``valid(position)`` tells whether the position has the handler's form.
+        """
+        cursor = self.get_argument('cursor', None)
+        if not cursor:
+            return None
+        try:
+            position = decode_cursor(cursor, self.query_key())
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        if not valid(position):
+            raise tornado.web.HTTPError(400, "Invalid cursor")
+        return position
+
+    def query_key(self):
+        """Return a short hash of the query string apart from the paging arguments."""
+        arguments = sorted(
+            (name, values) for name, values in self.request.query_arguments.items()
+            if name not in ('cursor', 'limit')
+        )
+        return hashlib.sha1(repr(arguments).encode('utf-8')).hexdigest()[:12]
+
+    def next_cursor(self, position, has_more):
+        return encode_cursor(position, self.query_key()) if has_more else None
+
+    def filters(self):
+        """Read the facet filters of the query string; see ``facets`` for their meaning."""
+        filters = {name: self.get_arguments(name) or None for name in _LIST_FACETS}
+        try:
+            ratings = self.get_arguments('rating')
+            filters['rating'] = [int(rating) for rating in ratings] or None
+            year_min, year_max = self.get_argument('year_min', None), self.get_argument('year_max', None)
+            if year_min is not None or year_max is not None:
+                filters['year'] = (None if year_min is None else int(year_min), None if year_max is None else int(year_max))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "rating, year_min and year_max must be numbers")
+        read = self.get_argument('read', None)
+        if read is not None:
+            if read not in ('true', 'false'):
+                raise tornado.web.HTTPError(400, "read must be true or false")
+            filters['read'] = read == 'true'
+        return normalize_filters(filters)
+
+
+class LibrariesHandler(LibraryHandler):
+    async def get(self, library=None):
+        self.send({'libraries': await self.call(self.libraries.names)})
+
+
+class BooksHandler(LibraryHandler):
+    async def get(self, library=None):
+        sort_by = self.get_argument('sort', 'title')
+        if sort_by not in SORT_FIELDS:
+            raise tornado.web.HTTPError(400, f"sort must be one of: {', '.join(SORT_FIELDS)}")
+        descending = self.get_argument('order', 'asc') == 'desc'
+        filters, limit = self.filters(), self.limit()
+        # The cursor holds the sort value and id of the previous page's last book.
+        after = self.page_position(lambda position: isinstance(position, list) and len(position) == 2 and isinstance(position[1], str))
+        # Fetch one extra book to learn whether a next page exists.
+        total, books = await self.call(
+            lambda: self.repo.filter_books(filters, sort_by, descending, limit + 1, after=None if after is None else tuple(after))
+        )
+        more, books = len(books) > limit, books[:limit]
+        self.send({
+            'total': total,
+            'books': [dict(book) for book in books],
+            'next': self.next_cursor([books[-1].get(sort_by), books[-1]['id']] if more else None, more),
+        })
+
+    async def post(self, library=None):
+        data = self.body()
+        self.send({'ids': await self.call(self._add, data if isinstance(data, list) else [data])}, status=201)
+
+    def _add(self, books):
+        books = [new_book(book) for book in books]
+        self.repo.add_books(books)
+        return [book['id'] for book in books]
+
+
+class BatchHandler(LibraryHandler):
+    """Adds, updates and deletes many books in one ``repo.batch()``.
+
+    The body is ``{"add": [...], "on_duplicate": ..., "update": [...], "delete": [...]}``
+    with every key optional.  ``update`` holds objects with a book's ``id``
+    and the fields to change, and ``delete`` holds book ids.  With
+    ``on_duplicate`` (one of ``DUPLICATE_MODES``), added books that duplicate
+    stored ones are resolved as an import resolves them.  Every entry is
+    checked before anything is written.
+    """
+
+    async def post(self, library=None):
+        data = self.body()
+        if not isinstance(data, dict):
+            raise tornado.web.HTTPError(400, "The batch must be a JSON object")
+        self.send(await self.call(self._apply, data))
+
+    def _apply(self, data):
+        on_duplicate = data.get('on_duplicate')
+        if on_duplicate is not None and on_duplicate not in DUPLICATE_MODES:
+            raise ValueError(f"on_duplicate must be one of: {', '.join(DUPLICATE_MODES)}")
+        added = [new_book(book) for book in data.get('add', [])]
+        updates = []
+        for update in data.get('update', []):
+            if not isinstance(update, dict) or 'id' not in update:
+                raise ValueError("Each update needs the id of its book")
+            changes = dict(update)
+            updates.append((changes.pop('id'), book_changes(changes)))
+        deleted = data.get('delete', [])
+        if not all(isinstance(book_id, str) for book_id in deleted):
+            raise ValueError("delete must list book ids")
+        result = {'inserted': 0, 'updated': 0, 'duplicates': 0, 'deleted': 0, 'missing': [], 'ids': {}}
+        with self.repo.batch():
+            if added and on_duplicate:
+                result.update(self.repo.import_books(added, on_duplicate=on_duplicate))
+            elif added:
+                self.repo.add_books(added)
+                result['inserted'] = len(added)
+                result['ids'] = {book['id']: book['id'] for book in added}
+            for book_id, changes in updates:
+                if self.repo.update_book(book_id, changes):
+                    result['updated'] += 1
+                else:
+                    result['missing'].append(book_id)
+            for book_id in deleted:
+                if self.repo.delete_book(book_id):
+                    result['deleted'] += 1
+                else:
+                    result['missing'].append(book_id)
+        return result
+
+
+class BookHandler(LibraryHandler):
+    async def get(self, library, book_id):
+        book = await self.call(self.repo.get_book, book_id)
+        if book is None:
+            raise tornado.web.HTTPError(404, f"No book with id '{book_id}'")
+        self.send(dict(book))
+
+    async def patch(self, library, book_id):
+        changes = self.body()
+        book = await self.call(self._update, book_id, changes)
+        if book is None:
+            raise tornado.web.HTTPError(404, f"No book with id '{book_id}'")
+        self.send(dict(book))
+
+    def _update(self, book_id, changes):
+        if not self.repo.update_book(book_id, book_changes(changes)):
+            return None
+        return self.repo.get_book(book_id)
+
+    async def delete(self, library, book_id):
+        if not await self.call(self.repo.delete_book, book_id):
+            raise tornado.web.HTTPError(404, f"No book with id '{book_id}'")
+        self.set_status(204)
+        self.finish()
+
+
+class SearchHandler(LibraryHandler):
+    async def get(self, library=None):
+        query = self.get_argument('q', '')
+        limit = self.limit()
+        offset = self.page_position(lambda position: isinstance(position, int) and position >= 0) or 0
+        # Fetch one extra result to learn whether a next page exists.
+        books = await self.call(lambda: self.repo.search_books(query, limit=limit + 1, offset=offset))
+        result = {
+            'books': [dict(book) for book in books[:limit]],
+            'next': self.next_cursor(offset + limit, len(books) > limit),
+        }
+        if not books and not offset:
+            result['suggestion'] = await self.call(self.repo.suggest_query, query)
+        self.send(result)
+
+
+class CompleteHandler(LibraryHandler):
+    async def get(self, library=None):
+        query = self.get_argument('q', '')
+        self.send({'completions': await self.call(self.repo.complete_query, query, COMPLETIONS)})
+
+
+class RecommendationsHandler(LibraryHandler):
+    async def get(self, library=None):
+        limit, exclude = self.limit(), self.get_arguments('exclude')
+        recommended = await self.call(self.repo.recommend_books, limit, exclude)
+        self.send({'books': [
+            {'book': dict(book), 'score': score, 'because': None if liked is None else liked['id']}
+            for book, score, liked in recommended
+        ]})
+
+
+class FacetsHandler(LibraryHandler):
+    async def get(self, library=None):
+        filters = self.filters()
+        counts = await self.call(self.repo.facet_counts, filters)
+        self.send({field: [[value, count] for value, count in pairs] for field, pairs in counts.items()})
+
+
+class StatsHandler(LibraryHandler):
+    async def get(self, library=None):
+        self.send(await self.call(self._stats, library or MAIN_LIBRARY))
+
+    def _stats(self, name):
+        repo = self.repo
+        total = repo.count_books()
+        read = repo.count_books(read=True)
+        # Aggregates read every book, so they are computed once per library version.
+        aggregates = self.libraries.figures.get(('aggregates', name, repo.version), lambda: library_aggregates(repo))
+        return {
+            'books': total,
+            'read': read,
+            'unread': total - read,
+            'genres': repo.count_distinct('genre'),
+            'authors': repo.count_distinct('author'),
+            'aggregates': aggregates,
+        }
+
+
+def edit_list(repo, data, name=None):
+    """Apply the add, remove and move of ``data`` to collection ``name``, or to the reading list for ``None``; returns its ids."""
+    if not isinstance(data, dict):
+        raise ValueError("The body must be a JSON object")
+    changes = [data.get(action) or [] for action in ('add', 'remove', 'move')]
+    if not all(isinstance(book_ids, list) and all(isinstance(book_id, str) for book_id in book_ids) for book_ids in changes):
+        raise ValueError("add, remove and move must list book ids")
+    position = data.get('position')
+    if position is not None and (not isinstance(position, int) or isinstance(position, bool)):
+        raise ValueError("position must be an integer")
+    added, removed, moved = changes
+    if moved and position is None:
+        raise ValueError("move needs a position")
+    if name is not None and name not in repo.collections():
+        raise tornado.web.HTTPError(404, f"No collection named '{name}'")
+    with repo.batch():
+        if name is None:
+            repo.add_to_reading_list(added, position)
+            repo.remove_from_reading_list(removed)
+            repo.move_in_reading_list(moved, position)
+            return repo.reading_list()
+        repo.add_to_collection(name, added, position)
+        repo.remove_from_collection(name, removed)
+        repo.move_in_collection(name, moved, position)
+        return repo.collections().get(name, [])
+
+
+class CollectionsHandler(LibraryHandler):
+    async def get(self, library=None):
+        self.send({'collections': await self.call(self.repo.collections)})
+
+
+class CollectionHandler(LibraryHandler):
+    async def get(self, library, name):
+        book_ids = (await self.call(self.repo.collections)).get(name)
+        if book_ids is None:
+            raise tornado.web.HTTPError(404, f"No collection named '{name}'")
+        self.send({'name': name, 'book_ids': book_ids})
+
+    async def put(self, library, name):
+        data = self.body()
+        book_ids = data.get('book_ids') if isinstance(data, dict) else None
+        if not isinstance(book_ids, list) or not all(isinstance(book_id, str) for book_id in book_ids):
+            raise tornado.web.HTTPError(400, "book_ids must list book ids")
+        await self.call(self.repo.set_collection, name, book_ids)
+        self.send({'name': name, 'book_ids': book_ids})
+
+    async def post(self, library, name):
+        book_ids = await self.call(edit_list, self.repo, self.body(), name)
+        self.send({'name': name, 'book_ids': book_ids})
+
+    async def delete(self, library, name):
+        if not await self.call(self._delete, name):
+            raise tornado.web.HTTPError(404, f"No collection named '{name}'")
+        self.set_status(204)
+        self.finish()
+
+    def _delete(self, name):
+        with self.repo.batch():
+            if name not in self.repo.collections():
+                return False
+            self.repo.delete_collection(name)
+            return True
+
+
+class ReadingListHandler(LibraryHandler):
+    async def get(self, library=None):
+        self.send({'book_ids': await self.call(self.repo.reading_list)})
+
+    async def post(self, library=None):
+        self.send({'book_ids': await self.call(edit_list, self.repo, self.body())})
+
+
+# Routes; the optional prefix selects a named library.
+_LIBRARY = r"(?:/libraries/([^/]+))?"
+
+
+def make_app(libraries=None, workers=API_WORKERS):
+    """Return the API as a Tornado application over ``libraries`` (a ``Libraries``)."""
+    options = {'libraries': libraries or Libraries(), 'executor': ThreadPoolExecutor(workers, thread_name_prefix="library-api")}
+    return tornado.web.Application([
+        (r"/libraries", LibrariesHandler, options),
+        (_LIBRARY + r"/books", BooksHandler, options),
+        (_LIBRARY + r"/batch", BatchHandler, options),
+        (_LIBRARY + r"/books/([^/]+)", BookHandler, options),
+        (_LIBRARY + r"/search", SearchHandler, options),
+        (_LIBRARY + r"/search/complete", CompleteHandler, options),
+        (_LIBRARY + r"/facets", FacetsHandler, options),
+        (_LIBRARY + r"/stats", StatsHandler, options),
+        (_LIBRARY + r"/recommendations", RecommendationsHandler, options),
+        (_LIBRARY + r"/collections", CollectionsHandler, options),
+        (_LIBRARY + r"/collections/([^/]+)", CollectionHandler, options),
+        (_LIBRARY + r"/reading-list", ReadingListHandler, options),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the library as a JSON API.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="threads running repository calls")
+    args = parser.parse_args()
+
+    app = make_app(workers=args.workers)
+    app.listen(args.port, address=args.host)
+    print(f"Serving the library on http://{args.host}:{args.port}")
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
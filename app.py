@@ -1,13 +1,20 @@
 import streamlit as st
 import json
 import os
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 from datetime import datetime
-import plotly.express as px
 import uuid
-import io
+from instrumentation import PROFILE_MODES, Profiler, finish_rerun, phase, start_rerun
+from storage import JournalStore, apply_journal, read_quarantine
+from repository import JsonRepository, SqliteRepository
+from backups import BackupStore
+from sharding import DEFAULT_SHARDS, ShardedRepository, create_library, list_libraries
+from charts import FigureCache, STATISTICS_CHARTS, library_aggregates, reading_progress_figure
+from facets import filters_key
+from jobs import JobQueue, backup_job, export_job, import_csv_job, prune_job, restore_file_job, restore_point_job
+from recommend import LIKED_RATING
+
+# Time the phases of this rerun (see instrumentation.py)
+rerun_metrics = start_rerun()
 
 # Set page configuration
 st.set_page_config(
@@ -119,67 +126,86 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Debug panel and profiling, switched on per process with environment
+# variables, or per session with ?debug=1 / ?profile=cprofile|tracemalloc
+# once LIBRARY_DEBUG_PARAMS=1 allows it
+debug_params = os.environ.get("LIBRARY_DEBUG_PARAMS") == "1"
+debug_enabled = os.environ.get("LIBRARY_DEBUG") == "1" or (debug_params and st.query_params.get("debug") == "1")
+profile_mode = (st.query_params.get("profile") if debug_params else None) or os.environ.get("LIBRARY_PROFILE")
+profiler = Profiler(profile_mode) if profile_mode in PROFILE_MODES else None
+metrics_path = os.environ.get("LIBRARY_METRICS")
+
 # File to store the library
 filename = "library.json"
+store = JournalStore(filename, binary_snapshot=os.environ.get("LIBRARY_BINARY_SNAPSHOT", "1") != "0")
+
+# Storage backend: "json" (default) or "sqlite"
+backend = os.environ.get("LIBRARY_BACKEND", "json").lower()
+db_filename = os.environ.get("LIBRARY_DB", "library.db")
+
+# Named libraries, each sharded over several files; the library above is the main one
+MAIN_LIBRARY = "Main Library"
+library_root = os.environ.get("LIBRARY_ROOT", "libraries")
+library_shards = int(os.environ.get("LIBRARY_SHARDS", DEFAULT_SHARDS))
+
+# Incremental backup points
+backup_root = os.environ.get("LIBRARY_BACKUPS", "backups")
+backup_store = BackupStore(backup_root)
+
+# Import choices for rows that duplicate an existing book
+duplicate_options = {
+    "Skip duplicates": "skip",
+    "Update existing": "update",
+    "Merge missing fields": "merge"
+}
+
+# Pagination for Browse Books and Search
+page_size_options = [10, 25, 50, 100]
+default_page_size = 25
+
+# Search completions offered for the word being typed
+search_completions = 5
+
+# Collections and Reading List: books listed per page, and search results offered when adding books
+list_page_size = 25
+picker_results = 20
+
+# Recommended books shown on the Dashboard and Reading List
+recommendations_shown = 5
+
+# Browse Books facets: (filter name, widget label), and the most values listed per facet
+browse_facets = [("genre", "Genre"), ("author", "Author"), ("tags", "Tags"), ("collection", "Collection"), ("rating", "Rating")]
+facet_option_limit = 200
+
+# Background jobs: seconds between status polls while a job runs, and the most jobs listed
+job_poll_seconds = 1
+jobs_shown = 10
 
 # Function to load the library from file
 def load_library():
-    """Load the library from a JSON file, handling various data formats and errors."""
+    """Load the library from a JSON file, handling various data formats and errors.
+
+    Entries that are not valid books are set aside in the store's quarantine
+    report rather than loaded; see ``storage``.
+    """
     default_structure = {
         'books': [],
         'collections': {},
         'reading_list': []
     }
     
-    if not os.path.exists(filename):
+    if not os.path.exists(filename) and not os.path.exists(store.journal_path):
         return default_structure
     
     try:
-        with open(filename, 'r') as f:
-            data = json.load(f)
+        data = store.open()
         
         # Handle case where data is neither list nor dict
-        if not isinstance(data, (list, dict)):
+        if not isinstance(data, dict):
             st.error(f"Invalid library format: expected list or dict, got {type(data)}. Starting with empty library.")
             return default_structure
         
-        # Handle old format (just a list of books)
-        if isinstance(data, list):
-            valid_books = []
-            for book in data:
-                if isinstance(book, dict):
-                    if 'id' not in book:
-                        book['id'] = str(uuid.uuid4())
-                    valid_books.append(book)
-                else:
-                    st.warning(f"Skipping invalid book entry: {book}")
-            return {
-                'books': valid_books,
-                'collections': {},
-                'reading_list': []
-            }
-        
-        # Handle proper dictionary format
-        elif isinstance(data, dict):
-            if 'books' in data and isinstance(data['books'], list):
-                valid_books = []
-                for book in data['books']:
-                    if isinstance(book, dict):
-                        if 'id' not in book:
-                            book['id'] = str(uuid.uuid4())
-                        valid_books.append(book)
-                    else:
-                        st.warning(f"Skipping invalid book entry: {book}")
-                data['books'] = valid_books
-            else:
-                data['books'] = []
-            
-            if 'collections' not in data or not isinstance(data['collections'], dict):
-                data['collections'] = {}
-            if 'reading_list' not in data or not isinstance(data['reading_list'], list):
-                data['reading_list'] = []
-            
-            return data
+        return data
     
     except json.JSONDecodeError as e:
         st.error(f"Invalid JSON format: {str(e)}. Starting with empty library.")
@@ -188,98 +214,354 @@ def load_library():
         st.error(f"Unexpected error loading library: {str(e)}. Starting with empty library.")
         return default_structure
 
+# Function to open the configured library repository
+def open_repository():
+    """Open the repository for the configured storage backend."""
+    if backend == "sqlite":
+        repo = SqliteRepository(db_filename)
+        # Seed a new database from the existing JSON library.
+        if repo.is_empty() and os.path.exists(filename):
+            repo.replace(apply_journal(load_library()))
+            store.write_quarantine()
+        return repo
+    return JsonRepository.open(store, load_library)
+
+# Function to share one repository across all sessions
+@st.cache_resource(show_spinner=False)
+def shared_repository(backend, path):
+    """Open the repository once per process; every session reads the same instance."""
+    if backend == "sharded":
+        return ShardedRepository.open(path, binary_snapshot=store.binary_snapshot)
+    return open_repository()
+
+# Function to share one figure cache across all sessions
+@st.cache_resource(show_spinner=False)
+def figure_cache():
+    """Create the process-wide cache of chart figures and aggregates."""
+    return FigureCache()
+
 # Function to save the library to file
 def save_library(data):
-    """Save the library to a JSON file."""
+    """Replace the stored library with the given data."""
     try:
-        with open(filename, 'w') as f:
-            json.dump(data, f)
+        with phase("save"):
+            st.session_state.repo.replace(data)
         return True
     except Exception as e:
         st.error(f"Error saving library: {str(e)}")
         return False
 
-# Function to backup the library
-def backup_library():
-    """Create a backup of the current library state."""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_filename = f"library_backup_{timestamp}.json"
+# Function to share one background job queue across all sessions
+@st.cache_resource(show_spinner=False)
+def job_queue():
+    """Create the process-wide queue that runs imports, backups, restores and exports."""
+    return JobQueue()
+
+# Function to run a long operation as a background job
+def submit_job(kind, label, run):
+    """Queue ``run`` for the current library; its jobs run one at a time."""
     try:
-        full_data = {
-            'books': st.session_state.library,
-            'collections': st.session_state.get('collections', {}),
-            'reading_list': st.session_state.get('reading_list', [])
-        }
-        with open(backup_filename, 'w') as f:
-            json.dump(full_data, f)
-        return backup_filename
+        job_queue().submit(kind, label, run, owner=library_name, lock=library_name)
     except Exception as e:
-        st.error(f"Error creating backup: {str(e)}")
-        return None
+        st.error(f"Error starting {label.lower()}: {str(e)}")
+        return
+    st.rerun()
+
+# Function to show the background jobs of the current library
+def render_jobs(active):
+    """List the recent jobs with their progress and results.
+
+    Rendered as a fragment that polls while ``active`` jobs run; the whole page
+    reruns once one of them finishes, so it shows the job's changes.
+    """
+    jobs = job_queue().list(library_name)[:jobs_shown]
+    if not jobs:
+        return
+    st.subheader("Background Jobs")
+    seen = st.session_state.setdefault('jobs_seen', set())
+    newly_finished = False
+    for job in jobs:
+        with st.container(border=True):
+            st.markdown(f"**{job.label}** · {job.status.capitalize()} · {job.elapsed:.1f}s")
+            if not job.finished:
+                st.progress(job.fraction, text=job.message)
+                st.button("Cancel", key=f"cancel_job_{job.id}", on_click=job.cancel)
+            elif job.status == 'done':
+                st.success(job.result['message'])
+                if 'warning' in job.result:
+                    st.warning(job.result['warning'])
+                if 'download' in job.result:
+                    label, path, file_name, mime = job.result['download']
+                    if os.path.exists(path):
+                        with open(path, 'rb') as f:
+                            st.download_button(label, f, file_name=file_name, mime=mime, key=f"download_job_{job.id}")
+            elif job.status == 'failed':
+                st.error(f"Error in {job.label.lower()}: {job.error}")
+            else:
+                if job.kind == 'import':
+                    st.info(f"Cancelled; the chunks saved before it are kept ({job.message}).")
+                else:
+                    st.info("Cancelled; the library was not changed.")
+        if job.finished and job.id not in seen:
+            seen.add(job.id)
+            newly_finished = True
+    if active and newly_finished:
+        st.rerun()
+
+# Function to render pagination controls
+def page_controls(key, total=None):
+    """Render page size, view mode and page number controls.
+
+    Returns the offset and limit of the selected page and the view mode. The
+    page number resets whenever ``key`` changes, so callers include their
+    filter values in it.
+    """
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        page_size = st.selectbox("Books per page", page_size_options, index=page_size_options.index(default_page_size), key=f"{key.split(':')[0]}_page_size")
+    with col2:
+        view_mode = st.radio("View", ["Cards", "Table"], horizontal=True, key=f"{key.split(':')[0]}_view")
+    num_pages = None if total is None else max(1, -(-total // page_size))
+    with col3:
+        page = st.number_input("Page", min_value=1, max_value=num_pages, value=1, step=1, key=f"{key}:{page_size}_page")
+    if num_pages is not None:
+        st.caption(f"Page {page} of {num_pages} ({total} books)")
+    return (page - 1) * page_size, page_size, view_mode
+
+# Function to build a book card
+def book_card(book, detail):
+    """Return the HTML card for a book."""
+    return (
+        f'<div class="book-card">'
+        f'<div class="book-title">{book["title"]}</div>'
+        f'<div class="book-author">{book["author"]}</div>'
+        f'<div>{detail}</div>'
+        f'</div>'
+    )
 
-# Function to restore from backup
-def restore_from_backup(backup_file):
-    """Restore library from a backup file."""
+# Function to render a page of books
+def render_books(books, view_mode, detail):
+    """Render books as HTML cards in a single element, or as a compact table."""
+    if view_mode == "Table":
+        st.dataframe(
+            [{
+                'Title': book.get('title'),
+                'Author': book.get('author'),
+                'Year': book.get('year'),
+                'Genre': book.get('genre'),
+                'Rating': book.get('rating'),
+                'Read': book.get('read', False)
+            } for book in books],
+            use_container_width=True,
+            hide_index=True
+        )
+    else:
+        st.markdown("\n".join(book_card(book, detail(book)) for book in books), unsafe_allow_html=True)
+
+# Function to read the Browse Books filters
+def browse_filters(year_bounds):
+    """Return the facet filters selected on Browse Books.
+
+    The year range only filters once it is narrower than ``year_bounds``.
+    """
+    state = st.session_state
+    filters = {name: state.get(f"browse_{name}") for name, _ in browse_facets}
+    filters['read'] = {"Read": True, "Unread": False}.get(state.get("browse_read"))
+    year = state.get("browse_year")
+    if year is not None and tuple(year) != year_bounds:
+        filters['year'] = tuple(year)
+    return filters
+
+# Function to keep a Browse Books filter selection
+def keep_facet(name):
+    """Copy a facet widget's value to ``browse_<name>`` in the session.
+
+    The widgets' option labels carry live counts, so Streamlit recreates a
+    widget whenever the counts change and the widget's own state is lost.
+    The copy outlives it and is passed back as the widget's default.
+    """
+    st.session_state[f"browse_{name}"] = st.session_state[f"facet_{name}"]
+
+# Function to reset the Browse Books filters
+def clear_browse_filters():
+    for name in [name for name, _ in browse_facets] + ["read", "year"]:
+        st.session_state.pop(f"browse_{name}", None)
+        st.session_state.pop(f"facet_{name}", None)
+
+# Function to label a facet value with its count
+def facet_label(name, value, count):
+    if name == "rating":
+        value = "⭐" * value if value else "Unrated"
+    return f"{value} ({count})"
+
+# Function to put a suggested query into the search box
+def set_search_query(query):
+    st.session_state.search_query = query
+
+# Function to add, remove or move books in a collection or the reading list
+def edit_list(action, book_ids, name=None, position=None):
+    """Apply ``action`` to collection ``name``, or to the reading list when ``name`` is None."""
     try:
-        with open(backup_file, 'r') as f:
-            data = json.load(f)
-        if isinstance(data, list):
-            st.session_state.library = data
-            st.session_state.collections = {}
-            st.session_state.reading_list = []
-        elif isinstance(data, dict):
-            st.session_state.library = data.get('books', [])
-            st.session_state.collections = data.get('collections', {})
-            st.session_state.reading_list = data.get('reading_list', [])
+        if action == "add":
+            if name is None:
+                repo.add_to_reading_list(book_ids, position)
+            else:
+                repo.add_to_collection(name, book_ids, position)
+        elif action == "remove":
+            if name is None:
+                repo.remove_from_reading_list(book_ids)
+            else:
+                repo.remove_from_collection(name, book_ids)
+        elif name is None:
+            repo.move_in_reading_list(book_ids, position)
         else:
-            raise ValueError("Invalid backup format")
-        save_library({
-            'books': st.session_state.library,
-            'collections': st.session_state.collections,
-            'reading_list': st.session_state.reading_list
-        })
-        return True
+            repo.move_in_collection(name, book_ids, position)
     except Exception as e:
-        st.error(f"Error restoring from backup: {str(e)}")
-        return False
+        st.error(f"Error saving library: {str(e)}")
+
+# Function to add the books picked for a list and clear the pick
+def add_picked(key, name=None):
+    edit_list("add", st.session_state.get(f"{key}_picked") or [], name)
+    st.session_state[f"{key}_picked"] = []
 
-# Initialize session state
-if 'library' not in st.session_state:
-    data = load_library()
-    st.session_state.library = data['books']
-    st.session_state.collections = data['collections']
-    st.session_state.reading_list = data['reading_list']
-if 'nav_option' not in st.session_state:
-    st.session_state.nav_option = "Dashboard"
-
-# App header
-st.title("📚 Personal Library Manager")
-st.write("Organize and manage your book collection with style and ease.")
-
-# Sidebar navigation with emoji icons
-with st.sidebar:
-    st.image("https://via.placeholder.com/150x150.png?text=Library", width=150)
-    st.subheader("Navigation")
+# Function to render the controls for adding books to a list
+def render_book_picker(key, contains, name=None):
+    """Search for books by a query and offer those for which ``contains(book_id)`` is false."""
+    query = st.text_input("Find books to add", key=f"{key}_query", placeholder="Title, author, tag...")
+    if not query:
+        return
+    books = [book for book in repo.search_books(query, limit=picker_results) if not contains(book['id'])]
+    labels = {book['id']: f"{book['title']} by {book['author']}" for book in books}
+    st.multiselect("Books", list(labels), key=f"{key}_picked", format_func=labels.get)
+    st.button("Add Books", key=f"{key}_add", on_click=add_picked, args=(key, name))
+
+# Function to render the books of a collection or the reading list
+def render_list_books(key, book_ids, name=None):
+    """List one page of ``book_ids`` with controls to reorder and remove them, singly or together."""
+    if not book_ids:
+        st.info("No books yet.")
+        return
+    num_pages = -(-len(book_ids) // list_page_size)
+    page = st.number_input("Page", min_value=1, max_value=num_pages, value=1, step=1, key=f"{key}_page") if num_pages > 1 else 1
+    offset = (page - 1) * list_page_size
+    page_ids = book_ids[offset:offset + list_page_size]
+    books = {book['id']: book for book in repo.get_books(page_ids)}
+    last = len(book_ids) - 1
+    for position, book_id in enumerate(page_ids, offset):
+        book = books.get(book_id, {'title': book_id, 'author': "unknown"})
+        col1, col2, col3, col4 = st.columns([8, 1, 1, 1])
+        col1.markdown(f"{position + 1}. **{book['title']}** by {book['author']}")
+        col2.button("⬆️", key=f"{key}_up_{book_id}", on_click=edit_list, args=("move", [book_id], name, position - 1), disabled=position == 0)
+        col3.button("⬇️", key=f"{key}_down_{book_id}", on_click=edit_list, args=("move", [book_id], name, position + 1), disabled=position == last)
+        col4.button("✖️", key=f"{key}_remove_{book_id}", on_click=edit_list, args=("remove", [book_id], name))
+    labels = {book_id: books[book_id]['title'] if book_id in books else book_id for book_id in page_ids}
+    selected = st.multiselect("Selected books", page_ids, key=f"{key}_selected_{page}", format_func=labels.get)
+    col1, col2, col3 = st.columns(3)
+    col1.button("Move to Top", key=f"{key}_top", on_click=edit_list, args=("move", selected, name, 0), disabled=not selected)
+    col2.button("Move to Bottom", key=f"{key}_bottom", on_click=edit_list, args=("move", selected, name, len(book_ids)), disabled=not selected)
+    col3.button("Remove Selected", key=f"{key}_remove", on_click=edit_list, args=("remove", selected, name), disabled=not selected)
+
+# Function to render the recommended books
+def render_recommendations(exclude=(), add=False):
+    """Show the unread books most like the highly rated ones, with an Add to Reading List button when ``add``."""
+    st.subheader("Recommended Next")
+    with phase("recommend"):
+        recommended = repo.recommend_books(recommendations_shown, exclude)
+    if not recommended:
+        st.info(f"Rate the books you have read {LIKED_RATING} stars or more to get recommendations.")
+        return
+    for book, score, liked in recommended:
+        because = f"Because you liked {liked['title']}" if liked else f"Genre: {book.get('genre', 'N/A')}"
+        if add:
+            col1, col2 = st.columns([4, 1])
+            col1.markdown(book_card(book, because), unsafe_allow_html=True)
+            col2.button("Add to Reading List", key=f"recommended_add_{book['id']}", on_click=edit_list, args=("add", [book['id']]))
+        else:
+            st.markdown(book_card(book, because), unsafe_allow_html=True)
+
+# Function to render the debug panel
+def render_debug_panel(report):
+    """Show the phase timings, I/O counters and profile of a rerun."""
+    with st.expander("🛠️ Debug", expanded=True):
+        st.caption(f"Rerun took {report['seconds'] * 1000:.0f} ms")
+        rows = [f"| {p['phase']} | {p['seconds'] * 1000:.1f} | {p['calls']} |" for p in report['phases']]
+        st.markdown("\n".join(["| Phase | ms | Calls |", "|---|---:|---:|"] + rows))
+        for name, value in sorted(report['counters'].items()):
+            st.caption(f"{name.replace('_', ' ').capitalize()}: {value:,}")
+        if 'profile' in report:
+            st.code(report['profile']['report'], language=None)
+
+# Profile the page from here; finish_rerun below stops it however the rerun ends
+if profiler is not None:
+    profiler.start()
+try:
+    # Select the library; one created in the sidebar is selected on the next rerun
+    libraries = [MAIN_LIBRARY] + list_libraries(library_root)
+    if st.session_state.get('pending_library') in libraries:
+        st.session_state.library = st.session_state.pop('pending_library')
+    if st.session_state.get('library') not in libraries:
+        st.session_state.library = MAIN_LIBRARY
+    library_name = st.session_state.library
+
+    # Initialize session state
+    with phase("load"):
+        if library_name == MAIN_LIBRARY:
+            st.session_state.repo = shared_repository(backend, db_filename if backend == "sqlite" else filename)
+        else:
+            st.session_state.repo = shared_repository("sharded", os.path.join(library_root, library_name))
+            backup_store = BackupStore(os.path.join(backup_root, "libraries", library_name))
+        repo = st.session_state.repo
+        # Pick up changes another process made to the library files.
+        if repo.is_stale():
+            repo.refresh(load_library)
+        # Point to entries set aside from the library file, once per session.
+        if library_name == MAIN_LIBRARY and not st.session_state.get('quarantine_noted') and os.path.exists(store.quarantine_path):
+            st.session_state.quarantine_noted = True
+            st.toast("Some entries of the library file were not valid books and were set aside. See Settings.", icon="⚠️")
+    if 'nav_option' not in st.session_state:
+        st.session_state.nav_option = "Dashboard"
+
+    # App header
+    st.title("📚 Personal Library Manager")
+    st.write("Organize and manage your book collection with style and ease.")
+
+    # Sidebar navigation with emoji icons
+    with st.sidebar:
+        st.image("https://via.placeholder.com/150x150.png?text=Library", width=150)
+        st.subheader("Library")
+        st.selectbox("Library", libraries, key="library", label_visibility="collapsed")
+        with st.expander("New Library"):
+            new_library = st.text_input("Library name", key="new_library_name").strip()
+            if st.button("Create Library"):
+                try:
+                    if new_library == MAIN_LIBRARY:
+                        raise ValueError(f"Library '{new_library}' already exists")
+                    create_library(library_root, new_library, library_shards, backend)
+                    st.session_state.pending_library = new_library
+                    st.rerun()
+                except ValueError as e:
+                    st.error(str(e))
+        st.subheader("Navigation")
     
-    nav_options = [
-        ("Dashboard", "🏠"),
-        ("Add Book", "➕"),
-        ("Browse Books", "📚"),
-        ("Search", "🔍"),
-        ("Collections", "📂"),
-        ("Reading List", "📋"),
-        ("Statistics", "📊"),
-        ("Settings", "⚙️")
-    ]
+        nav_options = [
+            ("Dashboard", "🏠"),
+            ("Add Book", "➕"),
+            ("Browse Books", "📚"),
+            ("Search", "🔍"),
+            ("Collections", "📂"),
+            ("Reading List", "📋"),
+            ("Statistics", "📊"),
+            ("Settings", "⚙️")
+        ]
     
-    for i, (name, icon) in enumerate(nav_options):
-        # Apply active class manually via key and styling
-        if st.button(f"{icon} {name}", key=f"nav_{i}", use_container_width=True):
-            st.session_state.nav_option = name
-            st.rerun()
-        # Highlight active navigation item
-        if st.session_state.nav_option == name:
-            st.markdown(f"""
+        for i, (name, icon) in enumerate(nav_options):
+            # Apply active class manually via key and styling
+            if st.button(f"{icon} {name}", key=f"nav_{i}", use_container_width=True):
+                st.session_state.nav_option = name
+                st.rerun()
+            # Highlight active navigation item
+            if st.session_state.nav_option == name:
+                st.markdown(f"""
             <style>
             #nav_{i} button {{
                 background-color: #3498db !important;
@@ -288,226 +570,298 @@ with st.sidebar:
             }}
             </style>
             """, unsafe_allow_html=True)
+        debug_panel = st.empty() if debug_enabled else None
 
-option = st.session_state.nav_option
+    option = st.session_state.nav_option
+    # The section below is timed as one phase named after the page.
+    rerun_metrics.begin(option)
 
-# Dashboard Section
-if option == "Dashboard":
-    st.header("🏠 Dashboard")
+    # Dashboard Section
+    if option == "Dashboard":
+        st.header("🏠 Dashboard")
     
-    total_books = len(st.session_state.library)
-    num_read = sum(1 for book in st.session_state.library if book.get('read', False))
-    genres = set(book.get('genre', '').lower() for book in st.session_state.library if book.get('genre'))
-    authors = set(book.get('author', '').lower() for book in st.session_state.library if book.get('author'))
+        total_books = repo.count_books()
+        num_read = repo.count_books(read=True)
+        num_genres = repo.count_distinct('genre')
+        num_authors = repo.count_distinct('author')
     
-    col1, col2, col3, col4 = st.columns(4)
-    with col1:
-        st.markdown(f"""
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.markdown(f"""
         <div class="dashboard-card">
             <h3>Total Books</h3>
             <h2>{total_books}</h2>
         </div>
         """, unsafe_allow_html=True)
-    with col2:
-        st.markdown(f"""
+        with col2:
+            st.markdown(f"""
         <div class="dashboard-card">
             <h3>Books Read</h3>
             <h2>{num_read}</h2>
         </div>
         """, unsafe_allow_html=True)
-    with col3:
-        st.markdown(f"""
+        with col3:
+            st.markdown(f"""
         <div class="dashboard-card">
             <h3>Genres</h3>
-            <h2>{len(genres)}</h2>
+            <h2>{num_genres}</h2>
         </div>
         """, unsafe_allow_html=True)
-    with col4:
-        st.markdown(f"""
+        with col4:
+            st.markdown(f"""
         <div class="dashboard-card">
             <h3>Authors</h3>
-            <h2>{len(authors)}</h2>
+            <h2>{num_authors}</h2>
         </div>
         """, unsafe_allow_html=True)
     
-    st.subheader("Recent Additions")
-    if st.session_state.library:
-        recent_books = sorted(st.session_state.library, key=lambda x: x.get('date_added', '0'), reverse=True)[:5]
-        for book in recent_books:
-            st.markdown(f"""
+        st.subheader("Recent Additions")
+        if total_books > 0:
+            with phase("query"):
+                recent_books = repo.recent_books(5)
+            for book in recent_books:
+                st.markdown(f"""
             <div class="book-card">
                 <div class="book-title">{book['title']}</div>
                 <div class="book-author">{book['author']}</div>
                 <div>Genre: {book.get('genre', 'N/A')} | {'Read' if book.get('read', False) else 'Unread'}</div>
             </div>
             """, unsafe_allow_html=True)
-    else:
-        st.info("No books added yet.")
-
-    if total_books > 0:
-        st.subheader("Reading Progress")
-        fig = px.pie(
-            values=[num_read, total_books - num_read],
-            names=["Read", "Unread"],
-            hole=0.5,
-            color_discrete_sequence=["#2ecc71", "#e0e0e0"]
-        )
-        fig.update_layout(
-            annotations=[dict(text=f"{(num_read/total_books*100):.1f}%", x=0.5, y=0.5, font_size=20, showarrow=False)],
-            legend=dict(orientation="h", yanchor="bottom", y=-0.2, xanchor="center", x=0.5)
-        )
-        st.plotly_chart(fig, use_container_width=True)
+            render_recommendations()
+        else:
+            st.info("No books added yet.")
+
+        if total_books > 0:
+            st.subheader("Reading Progress")
+            with phase("figures"):
+                fig = figure_cache().get(
+                    ('reading_progress', num_read, total_books),
+                    lambda: reading_progress_figure(num_read, total_books)
+                )
+            with phase("render"):
+                st.plotly_chart(fig, use_container_width=True)
+
+    # Add Book Section
+    elif option == "Add Book":
+        st.header("➕ Add Book")
+        with st.form(key="add_book_form", clear_on_submit=True):
+            col1, col2 = st.columns(2)
+            with col1:
+                title = st.text_input("Title", placeholder="Enter book title")
+                author = st.text_input("Author", placeholder="Enter author name")
+                year = st.number_input("Year", min_value=0, max_value=datetime.now().year, step=1)
+            with col2:
+                genre = st.text_input("Genre", placeholder="e.g., Fiction")
+                read = st.checkbox("Read")
+                rating = st.slider("Rating", 0, 5, 0)
+            notes = st.text_area("Notes", placeholder="Your thoughts...")
+            submit = st.form_submit_button("Add Book")
+        
+            if submit and title and author:
+                book = {
+                    'id': str(uuid.uuid4()),
+                    'title': title,
+                    'author': author,
+                    'year': year,
+                    'genre': genre,
+                    'read': read,
+                    'rating': rating,
+                    'notes': notes,
+                    'date_added': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+                try:
+                    with phase("save"):
+                        repo.add_book(book)
+                    st.success("Book added!")
+                except Exception as e:
+                    st.error(f"Error saving library: {str(e)}")
+
+    # Browse Books Section
+    elif option == "Browse Books":
+        st.header("📚 Browse Books")
+        # Facet counts are cached per library version and filter selection.
+        cache = figure_cache()
+        version = repo.version
+        with phase("facets"):
+            library_counts = cache.get(('facets', library_name, version, ()), repo.facet_counts)
+            years = [year for year, _ in library_counts['year'] if year > 0]
+            year_bounds = (min(years), max(years)) if years else None
+            selected_year = st.session_state.get("browse_year")
+            if selected_year is not None and (year_bounds is None or not year_bounds[0] <= selected_year[0] <= selected_year[1] <= year_bounds[1]):
+                del st.session_state["browse_year"]
+            filters = browse_filters(year_bounds)
+            counts = cache.get(('facets', library_name, version, filters_key(filters)), lambda: repo.facet_counts(filters))
 
-# Add Book Section
-elif option == "Add Book":
-    st.header("➕ Add Book")
-    with st.form(key="add_book_form", clear_on_submit=True):
         col1, col2 = st.columns(2)
         with col1:
-            title = st.text_input("Title", placeholder="Enter book title")
-            author = st.text_input("Author", placeholder="Enter author name")
-            year = st.number_input("Year", min_value=0, max_value=datetime.now().year, step=1)
+            sort_by = st.selectbox("Sort by", ["Title", "Author", "Year", "Genre", "Date Added"])
         with col2:
-            genre = st.text_input("Genre", placeholder="e.g., Fiction")
-            read = st.checkbox("Read")
-            rating = st.slider("Rating", 0, 5, 0)
-        notes = st.text_area("Notes", placeholder="Your thoughts...")
-        submit = st.form_submit_button("Add Book")
-        
-        if submit and title and author:
-            book = {
-                'id': str(uuid.uuid4()),
-                'title': title,
-                'author': author,
-                'year': year,
-                'genre': genre,
-                'read': read,
-                'rating': rating,
-                'notes': notes,
-                'date_added': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            st.session_state.library.append(book)
-            save_library({
-                'books': st.session_state.library,
-                'collections': st.session_state.collections,
-                'reading_list': st.session_state.reading_list
-            })
-            st.success("Book added!")
-
-# Browse Books Section
-elif option == "Browse Books":
-    st.header("📚 Browse Books")
-    col1, col2 = st.columns(2)
-    with col1:
-        sort_by = st.selectbox("Sort by", ["Title", "Author", "Year", "Genre", "Date Added"])
-    with col2:
-        filter_read = st.selectbox("Filter", ["All", "Read", "Unread"])
-    
-    books = st.session_state.library
-    if filter_read == "Read":
-        books = [b for b in books if b.get('read', False)]
-    elif filter_read == "Unread":
-        books = [b for b in books if not b.get('read', False)]
-    
-    sorted_books = sorted(books, key=lambda x: x.get(sort_by.lower(), 'date_added' if sort_by == "Date Added" else ''), reverse=True)
-    
-    for book in sorted_books:
-        st.markdown(f"""
-        <div class="book-card">
-            <div class="book-title">{book['title']}</div>
-            <div class="book-author">{book['author']}</div>
-            <div>Genre: {book.get('genre', 'N/A')} | {'⭐' * book.get('rating', 0)}</div>
-        </div>
-        """, unsafe_allow_html=True)
+            read_counts = dict(counts['read'])
+            read_counts[None] = read_counts[True] + read_counts[False]
+            read_options = {"All": None, "Read": True, "Unread": False}
+            st.selectbox(
+                "Filter", list(read_options), index=list(read_options).index(st.session_state.get("browse_read", "All")),
+                key="facet_read", on_change=keep_facet, args=("read",),
+                format_func=lambda label: f"{label} ({read_counts[read_options[label]]})"
+            )
 
-# Search Section
-elif option == "Search":
-    st.header("🔍 Search Books")
-    query = st.text_input("Search by title, author, or genre")
-    if query:
-        results = [b for b in st.session_state.library if query.lower() in (b.get('title', '') + b.get('author', '') + b.get('genre', '')).lower()]
-        for book in results:
-            st.markdown(f"""
-            <div class="book-card">
-                <div class="book-title">{book['title']}</div>
-                <div class="book-author">{book['author']}</div>
-                <div>Genre: {book.get('genre', 'N/A')} | {'Read' if book.get('read', False) else 'Unread'}</div>
-            </div>
-            """, unsafe_allow_html=True)
-    else:
-        st.info("Enter a search term.")
+        with st.expander("Filters", expanded=True):
+            facet_columns = st.columns(3)
+            for i, (name, label) in enumerate(browse_facets):
+                facet_counts = dict(counts[name])
+                selected = st.session_state.get(f"browse_{name}") or []
+                # Selected values stay listed even when the other filters leave them no books.
+                options = list(facet_counts)[:facet_option_limit]
+                options += [value for value in selected if value not in options]
+                if name == "rating":
+                    options.sort()
+                with facet_columns[i % 3]:
+                    st.multiselect(
+                        label, options, default=selected, key=f"facet_{name}", on_change=keep_facet, args=(name,),
+                        format_func=lambda value, name=name, facet_counts=facet_counts: facet_label(name, value, facet_counts.get(value, 0))
+                    )
+            if year_bounds and year_bounds[0] < year_bounds[1]:
+                with facet_columns[len(browse_facets) % 3]:
+                    st.slider(
+                        "Year", min_value=year_bounds[0], max_value=year_bounds[1],
+                        value=tuple(st.session_state.get("browse_year") or year_bounds),
+                        key="facet_year", on_change=keep_facet, args=("year",)
+                    )
+            st.button("Clear Filters", on_click=clear_browse_filters)
+
+        sort_field = sort_by.lower().replace(" ", "_")
+        total = read_counts[filters['read']]
+        offset, limit, view_mode = page_controls(f"browse:{sort_field}:{filters_key(filters)}", total)
+        with phase("query"):
+            _, page_books = repo.filter_books(filters, sort_by=sort_field, descending=True, limit=limit, offset=offset)
+        with phase("render"):
+            render_books(page_books, view_mode, lambda book: f"Genre: {book.get('genre', 'N/A')} | {'⭐' * book.get('rating', 0)}")
 
-# Collections Section
-elif option == "Collections":
-    st.header("📂 Collections")
-    if 'new_collection' not in st.session_state:
-        st.session_state.new_collection = ""
+    # Search Section
+    elif option == "Search":
+        st.header("🔍 Search Books")
+        query = st.text_input(
+            "Search by title, author, genre, notes, tags or ISBN",
+            key="search_query",
+            help="Words are matched as prefixes. Use field:word (e.g. author:tolkien) to search a single field. Misspelled titles and authors are corrected."
+        )
+        if query:
+            with phase("suggest"):
+                completions = repo.complete_query(query, search_completions)
+            if completions:
+                for col, completion in zip(st.columns(len(completions)), completions):
+                    col.button(completion, key=f"complete:{completion}", on_click=set_search_query, args=(completion,))
+            offset, limit, view_mode = page_controls(f"search:{query}")
+            # Fetch one extra result to learn whether a next page exists.
+            with phase("query"):
+                results = repo.search_books(query, limit=limit + 1, offset=offset)
+                # When nothing matches, search for the corrected spelling instead.
+                suggestion = None if results else repo.suggest_query(query)
+                if suggestion:
+                    results = repo.search_books(suggestion, limit=limit + 1, offset=offset)
+            if suggestion:
+                st.write(f"No matches for *{query}*. Showing results for **{suggestion}**.")
+                st.button(f"Search for {suggestion}", on_click=set_search_query, args=(suggestion,))
+            if results:
+                st.caption(f"Results {offset + 1}–{offset + min(len(results), limit)}" + (" (more on the next page)" if len(results) > limit else ""))
+                with phase("render"):
+                    render_books(results[:limit], view_mode, lambda book: f"Genre: {book.get('genre', 'N/A')} | {'Read' if book.get('read', False) else 'Unread'}")
+            else:
+                st.info("No matching books.")
+        else:
+            st.info("Enter a search term.")
+
+    # Collections Section
+    elif option == "Collections":
+        st.header("📂 Collections")
+        if 'new_collection' not in st.session_state:
+            st.session_state.new_collection = ""
     
-    new_collection = st.text_input("New Collection", value=st.session_state.new_collection)
-    if st.button("Create Collection") and new_collection:
-        st.session_state.collections[new_collection] = []
-        st.session_state.new_collection = ""
-        save_library({
-            'books': st.session_state.library,
-            'collections': st.session_state.collections,
-            'reading_list': st.session_state.reading_list
-        })
-        st.success(f"Collection '{new_collection}' created!")
+        new_collection = st.text_input("New Collection", value=st.session_state.new_collection)
+        if st.button("Create Collection") and new_collection:
+            st.session_state.new_collection = ""
+            try:
+                repo.set_collection(new_collection, [])
+                st.success(f"Collection '{new_collection}' created!")
+            except Exception as e:
+                st.error(f"Error saving library: {str(e)}")
     
-    for name, books in st.session_state.collections.items():
-        with st.expander(name):
-            st.write(f"{len(books)} books")
-            for book_id in books:
-                book = next((b for b in st.session_state.library if b['id'] == book_id), None)
-                if book:
-                    st.write(f"- {book['title']} by {book['author']}")
-
-# Reading List Section
-elif option == "Reading List":
-    st.header("📋 Reading List")
-    for book_id in st.session_state.reading_list:
-        book = next((b for b in st.session_state.library if b['id'] == book_id), None)
-        if book:
-            st.markdown(f"""
-            <div class="book-card">
-                <div class="book-title">{book['title']}</div>
-                <div class="book-author">{book['author']}</div>
-            </div>
-            """, unsafe_allow_html=True)
+        collections = repo.collections()
+        if collections:
+            name = st.selectbox("Collection", list(collections), key="collection_selected")
+            st.caption(f"{len(collections[name])} books")
+            key = f"collection:{name}"
+            render_book_picker(key, lambda book_id: repo.in_collection(name, book_id), name)
+            render_list_books(key, collections[name], name)
+
+    # Reading List Section
+    elif option == "Reading List":
+        st.header("📋 Reading List")
+        reading_list = repo.reading_list()
+        render_book_picker("reading_list", repo.in_reading_list)
+        render_list_books("reading_list", reading_list)
+        render_recommendations(reading_list, add=True)
+
+    # Statistics Section
+    elif option == "Statistics":
+        st.header("📊 Statistics")
+        # Aggregates and figures are rebuilt only when the selected library's version changes.
+        cache = figure_cache()
+        version = repo.version
+        with phase("aggregate"):
+            aggregates = cache.get(('aggregates', library_name, version), lambda: library_aggregates(repo))
+        for subheader, name, build_figure in STATISTICS_CHARTS:
+            if aggregates[name][0]:
+                st.subheader(subheader)
+                with phase("figures"):
+                    fig = cache.get((name, library_name, version), lambda: build_figure(aggregates[name]))
+                with phase("render"):
+                    st.plotly_chart(fig)
+
+    # Settings Section
+    elif option == "Settings":
+        st.header("⚙️ Settings")
+        active_jobs = any(not job.finished for job in job_queue().list(library_name))
+        st.fragment(run_every=job_poll_seconds if active_jobs else None)(render_jobs)(active_jobs)
+
+        download_backup = st.checkbox("Also download the backup as JSON")
+        if st.button("Backup Library"):
+            submit_job('backup', "Backup", backup_job(backup_store, repo, download=download_backup))
+
+        backup_points = backup_store.list()
+        if backup_points:
+            st.subheader("Backup Points")
+            labels = {point['id']: f"{point['created']} ({point['books']} books)" for point in backup_points}
+            selected_point = st.selectbox("Restore to a backup point", list(labels), format_func=labels.get)
+            if st.button("Restore Backup Point"):
+                submit_job('restore', f"Restore to {labels[selected_point]}", restore_point_job(backup_store, repo, selected_point))
+            keep_points = st.number_input("Backup points to keep", min_value=1, value=max(len(backup_points), 1), step=1)
+            if keep_points < len(backup_points) and st.button("Prune Older Backups"):
+                # Queued under the library's lock key, so it never runs beside a backup.
+                submit_job('prune', "Prune backups", prune_job(backup_store, int(keep_points)))
 
-# Statistics Section
-elif option == "Statistics":
-    st.header("📊 Statistics")
-    if st.session_state.library:
-        df = pd.DataFrame(st.session_state.library)
-        st.subheader("Genre Distribution")
-        fig = px.bar(df['genre'].value_counts(), title="Books by Genre")
-        st.plotly_chart(fig)
-
-# Settings Section
-elif option == "Settings":
-    st.header("⚙️ Settings")
-    if st.button("Backup Library"):
-        backup_file = backup_library()
-        if backup_file:
-            with open(backup_file, 'r') as f:
-                st.download_button("Download Backup", f, file_name=backup_file)
-    uploaded_file = st.file_uploader("Restore from Backup", type="json")
-    if uploaded_file and st.button("Restore"):
-        with open("temp_restore.json", "wb") as f:
-            f.write(uploaded_file.getvalue())
-        if restore_from_backup("temp_restore.json"):
-            st.success("Library restored!")
-            os.remove("temp_restore.json")
-            st.experimental_rerun()
+        uploaded_file = st.file_uploader("Restore from Backup", type="json")
+        merge_restore = st.checkbox("Merge into the current library instead of replacing it")
+        if uploaded_file and st.button("Restore"):
+            submit_job(
+                'restore', f"{'Merge' if merge_restore else 'Restore'} from {uploaded_file.name}",
+                restore_file_job(repo, uploaded_file.getvalue(), merge=merge_restore)
+            )
     
-    # Theme settings - fixed indentation
-    if 'theme' not in st.session_state:
-        st.session_state.theme = "Light"
+        # Theme settings - fixed indentation
+        if 'theme' not in st.session_state:
+            st.session_state.theme = "Light"
+
+        # Theme Selection
+        st.subheader("Theme")
+        theme = st.selectbox("Select Theme", ["Light", "Dark"], index=0 if st.session_state.theme == "Light" else 1)
+        if theme != st.session_state.theme:
+            st.session_state.theme = theme
+            st.rerun()  # Rerun to apply the new theme immediately
 
-    # Apply theme styles
-    if st.session_state.theme == "Dark":
-        st.markdown("""
+        # Apply theme styles
+        if st.session_state.theme == "Dark":
+            st.markdown("""
         <style>
         .main {
             background-color: #2c3e50;
@@ -523,8 +877,8 @@ elif option == "Settings":
         }
         </style>
         """, unsafe_allow_html=True)
-    else:
-        st.markdown("""
+        else:
+            st.markdown("""
         <style>
         .main {
             background-color: white;
@@ -541,97 +895,70 @@ elif option == "Settings":
         </style>
         """, unsafe_allow_html=True)
 
+        # Data Export
+        st.subheader("Data Export")
+        compress_export = st.checkbox("Compress with gzip")
+        if st.button("Export as JSON"):
+            submit_job('export', "Export as JSON", export_job(repo, 'json', compress=compress_export))
 
+        if st.button("Export as JSON Lines"):
+            if repo.count_books() > 0:
+                submit_job('export', "Export as JSON Lines", export_job(repo, 'jsonl', compress=compress_export))
+            else:
+                st.warning("No books to export.")
 
-elif option == "Settings":
-    st.header("⚙️ Settings")
-
-    # Theme Selection
-    st.subheader("Theme")
-    theme = st.selectbox("Select Theme", ["Light", "Dark"], index=0 if st.session_state.theme == "Light" else 1)
-    if theme != st.session_state.theme:
-        st.session_state.theme = theme
-        st.experimental_rerun()  # Rerun to apply the new theme immediately
+        if st.button("Export as CSV"):
+            if repo.count_books() > 0:
+                submit_job('export', "Export as CSV", export_job(repo, 'csv', compress=compress_export))
+            else:
+                st.warning("No books to export.")
 
-    # Data Export
-    st.subheader("Data Export")
-    if st.button("Export as JSON"):
-        full_data = {
-            'books': st.session_state.library,
-            'collections': st.session_state.collections,
-            'reading_list': st.session_state.reading_list
-        }
-        st.download_button(
-            label="Download JSON",
-            data=json.dumps(full_data, indent=4),
-            file_name="library.json",
-            mime="application/json"
+        # Import Books
+        st.subheader("Import Books")
+        st.write("CSV should have columns: title, author, year (optional), genre (optional), read (optional), rating (optional), notes (optional), isbn (optional), tags (comma-separated, optional)")
+        uploaded_file = st.file_uploader("Upload CSV", type="csv")
+        duplicate_option = st.radio(
+            "Books already in the library (same ISBN, or same title and author)",
+            list(duplicate_options),
+            horizontal=True
         )
-
-    if st.button("Export as CSV"):
-        if st.session_state.library:
-            df = pd.DataFrame(st.session_state.library)
-            if 'tags' in df.columns:
-                df['tags'] = df['tags'].apply(lambda x: ','.join(x) if isinstance(x, list) else '')
-            csv = df.to_csv(index=False)
-            st.download_button(
-                label="Download CSV",
-                data=csv,
-                file_name="library.csv",
-                mime="text/csv"
+        if uploaded_file and st.button("Import Books"):
+            submit_job(
+                'import', f"Import {uploaded_file.name}",
+                import_csv_job(repo, uploaded_file.getvalue(), on_duplicate=duplicate_options[duplicate_option])
             )
-        else:
-            st.warning("No books to export.")
-
-    # Import Books
-    st.subheader("Import Books")
-    st.write("CSV should have columns: title, author, year (optional), genre (optional), read (optional), rating (optional), notes (optional), isbn (optional), tags (comma-separated, optional)")
-    uploaded_file = st.file_uploader("Upload CSV", type="csv")
-    if uploaded_file:
-        try:
-            df = pd.read_csv(uploaded_file)
-            required_columns = ['title', 'author']
-            if not all(col in df.columns for col in required_columns):
-                st.error(f"CSV must contain columns: {', '.join(required_columns)}")
-            else:
-                new_books = []
-                for _, row in df.iterrows():
-                    book = {
-                        'id': str(uuid.uuid4()),
-                        'title': row['title'],
-                        'author': row['author'],
-                        'year': int(row.get('year', 0)) if pd.notna(row.get('year')) else 0,
-                        'genre': row.get('genre', ''),
-                        'read': bool(row.get('read', False)),
-                        'rating': int(row.get('rating', 0)) if pd.notna(row.get('rating')) else 0,
-                        'notes': row.get('notes', ''),
-                        'isbn': row.get('isbn', ''),
-                        'tags': [tag.strip() for tag in str(row.get('tags', '')).split(',') if tag.strip()],
-                        'date_added': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    new_books.append(book)
-                st.session_state.library.extend(new_books)
+
+        # Entries set aside when an older library file was migrated
+        quarantine = read_quarantine(store.quarantine_path) if library_name == MAIN_LIBRARY else None
+        if quarantine:
+            st.subheader("Quarantined Entries")
+            st.write(f"{len(quarantine['entries'])} entries of the library file were not valid books and were left out of the library (last updated {quarantine['updated']}).")
+            with open(store.quarantine_path, 'rb') as f:
+                st.download_button("Download Quarantine Report", f.read(), file_name="library_quarantine.json", mime="application/json")
+            if st.button("Delete Quarantine Report"):
+                os.remove(store.quarantine_path)
+                st.rerun()
+
+        # Reset Library
+        st.subheader("Reset Library")
+        if st.button("Reset Library"):
+            st.warning("Are you sure you want to reset the library? This action cannot be undone.")
+            if st.button("Confirm Reset"):
                 save_library({
-                    'books': st.session_state.library,
-                    'collections': st.session_state.collections,
-                    'reading_list': st.session_state.reading_list
+                    'books': [],
+                    'collections': {},
+                    'reading_list': []
                 })
-                st.success(f"Imported {len(new_books)} books.")
-        except Exception as e:
-            st.error(f"Error importing CSV: {str(e)}")
-
-    # Reset Library
-    st.subheader("Reset Library")
-    if st.button("Reset Library"):
-        st.warning("Are you sure you want to reset the library? This action cannot be undone.")
-        if st.button("Confirm Reset"):
-            st.session_state.library = []
-            st.session_state.collections = {}
-            st.session_state.reading_list = []
-            save_library({
-                'books': [],
-                'collections': {},
-                'reading_list': []
-            })
-            st.success("Library reset successfully.")
-            st.experimental_rerun()  # Rerun to refresh the app state
\ No newline at end of file
+                st.success("Library reset successfully.")
+                st.rerun()  # Rerun to refresh the app state
+
+    # Finish timing this rerun
+    rerun_metrics.end()
+finally:
+    # Also reached through st.rerun() and errors, so profiling always stops.
+    rerun_report = finish_rerun(rerun_metrics, profiler, metrics_path)
+
+# Show this rerun's timings in the debug panel
+if debug_panel is not None:
+    with debug_panel.container():
+        render_debug_panel(rerun_report)
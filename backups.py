@@ -0,0 +1,188 @@
+"""Incremental, deduplicated library backups stored as content-addressed buckets."""
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+
+from storage import atomic_write
+
+BACKUP_DIR = "backups"
+BUCKETS = 256
+# Tries at a backup point without locks before one is taken holding them.
+BACKUP_ATTEMPTS = 3
+# Seconds an unreferenced object is kept, in case a running backup wrote it.
+PRUNE_GRACE = 3600
+
+
+def bucket_of(book_id, buckets=BUCKETS):
+    return zlib.crc32(str(book_id).encode('utf-8')) % buckets
+
+
+class BackupStore:
+    """Content-addressed backup points for a library repository."""
+
+    def __init__(self, root=BACKUP_DIR, buckets=BUCKETS):
+        self.root = root
+        self.buckets = buckets
+        self.objects_dir = os.path.join(root, "objects")
+        self.manifest_path = os.path.join(root, "manifest.json")
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {'backups': []}
+        with open(self.manifest_path, 'r') as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        atomic_write(self.manifest_path, lambda f: f.write(json.dumps(manifest, indent=1)))
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _put(self, payload):
+        """Store ``payload`` bytes unless an identical object exists; returns (digest, bytes written)."""
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            # Refresh its age, so a prune running now keeps it for the point being written.
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(path)
+                return digest, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = gzip.compress(payload, compresslevel=6)
+        # A temp file of its own, so concurrent backups writing the same object never share one.
+        atomic_write(path, lambda f: f.write(compressed), mode='wb')
+        return digest, len(compressed)
+
+    def _get(self, digest):
+        with open(self._object_path(digest), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def list(self):
+        """Return the backup points, newest first."""
+        return list(reversed(self._read_manifest()['backups']))
+
+    def create(self, repo, progress=None):
+        """Record a backup point of ``repo``, writing only buckets that are not already stored.
+
+        ``progress`` is called with the fraction done after each bucket.
+        """
+        for _ in range(BACKUP_ATTEMPTS - 1):
+            version = repo.version
+            point = self._write_point(repo, progress)
+            if repo.version == version:
+                break
+        else:
+            # Writes kept landing mid-backup; hold the write locks for the last try.
+            with repo.batch():
+                point = self._write_point(repo, progress)
+        manifest = self._read_manifest()
+        manifest['backups'].append(point)
+        self._write_manifest(manifest)
+        return point
+
+    def _write_point(self, repo, progress):
+        """Store the buckets and lists of ``repo`` and return the point describing them."""
+        # Only the ids are grouped up front; each bucket's books are fetched,
+        # serialized and written in turn, so one bucket is in memory at a time.
+        buckets = [[] for _ in range(self.buckets)]
+        for book in repo.iter_books():
+            buckets[bucket_of(book['id'], self.buckets)].append(book['id'])
+
+        count = 0
+        digests = []
+        new_objects = 0
+        bytes_written = 0
+        for index, book_ids in enumerate(buckets):
+            if progress is not None:
+                progress(index / self.buckets)
+            books = sorted(repo.get_books(book_ids), key=lambda book: str(book['id']))
+            payload = "\n".join(json.dumps(dict(book), sort_keys=True) for book in books).encode('utf-8')
+            digest, written = self._put(payload)
+            digests.append(digest)
+            count += len(books)
+            if written:
+                new_objects += 1
+                bytes_written += written
+            buckets[index] = None
+
+        lists = json.dumps({'collections': repo.collections(), 'reading_list': repo.reading_list()}, sort_keys=True)
+        lists_digest, written = self._put(lists.encode('utf-8'))
+        if written:
+            new_objects += 1
+            bytes_written += written
+
+        now = datetime.now()
+        return {
+            'id': now.strftime("%Y%m%d_%H%M%S_%f"),
+            'created': now.strftime("%Y-%m-%d %H:%M:%S"),
+            'books': count,
+            'buckets': digests,
+            'lists': lists_digest,
+            'new_objects': new_objects,
+            'bytes_written': bytes_written,
+        }
+
+    def _point(self, backup_id):
+        for point in self._read_manifest()['backups']:
+            if point['id'] == backup_id:
+                return point
+        raise KeyError(f"No backup point {backup_id!r}")
+
+    def iter_books(self, backup_id, progress=None):
+        """Yield the books of a backup point, decompressing one bucket at a time.
+
+        ``progress`` is called with the fraction read after each bucket.
+        """
+        buckets = self._point(backup_id)['buckets']
+        for index, digest in enumerate(buckets):
+            payload = self._get(digest)
+            if payload:
+                for line in payload.decode('utf-8').split("\n"):
+                    yield json.loads(line)
+            if progress is not None:
+                progress((index + 1) / len(buckets))
+
+    def read(self, backup_id, progress=None):
+        """Return a backup point as library data, with its books in a list."""
+        lists = json.loads(self._get(self._point(backup_id)['lists']))
+        books = list(self.iter_books(backup_id, progress))
+        return {'books': books, 'collections': lists['collections'], 'reading_list': lists['reading_list']}
+
+    def restore(self, backup_id, repo, progress=None):
+        """Replace the contents of ``repo`` with a backup point, streaming its books into ``repo.replace``."""
+        lists = json.loads(self._get(self._point(backup_id)['lists']))
+        repo.replace({
+            'books': self.iter_books(backup_id, progress),
+            'collections': lists['collections'],
+            'reading_list': lists['reading_list']
+        })
+
+    def prune(self, keep):
+        """Keep the newest ``keep`` backup points and delete objects no longer referenced and older than ``PRUNE_GRACE``."""
+        manifest = self._read_manifest()
+        manifest['backups'] = manifest['backups'][-keep:] if keep > 0 else []
+        self._write_manifest(manifest)
+        referenced = set()
+        for point in manifest['backups']:
+            referenced.update(point['buckets'])
+            referenced.add(point['lists'])
+        removed = 0
+        # Objects and temp files younger than PRUNE_GRACE may belong to a backup still being written.
+        cutoff = time.time() - PRUNE_GRACE
+        if os.path.isdir(self.objects_dir):
+            for prefix in os.listdir(self.objects_dir):
+                directory = os.path.join(self.objects_dir, prefix)
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    if name in referenced or name.startswith(".tmp-"):
+                        continue
+                    with contextlib.suppress(FileNotFoundError):
+                        if os.path.getmtime(path) < cutoff:
+                            os.remove(path)
+                            removed += 1
+        return removed
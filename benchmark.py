@@ -0,0 +1,293 @@
+"""Benchmarks of the storage, query and page operations over synthetic libraries.
+
+    python benchmark.py --sizes 10000 100000 --output bench.json
+    python benchmark.py --sizes 10000 --output new.json --compare bench.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from backups import BackupStore
+from charts import library_aggregates
+from exporter import FORMATS, write_export
+from jobs import Job, export_job, import_csv_job
+from repository import SORT_FIELDS, JsonRepository, SqliteRepository
+from sharding import ShardedRepository, create_library
+from storage import JournalStore, apply_journal
+from synthetic import write_library
+
+SIZES = [10_000, 100_000]
+BACKENDS = ['json', 'sqlite', 'sharded']
+# Timed runs per benchmark; the median is reported.
+REPEAT = 3
+# A benchmark this many times slower than the baseline is reported as a regression.
+REGRESSION_RATIO = 1.25
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+SEARCH_QUERIES = ["river", "author:ada", "golden night", "tags:classic"]
+# Misspelled and half-typed queries for the "did you mean" suggestions and completions.
+SEARCH_TYPOS = ["rivr", "author:adda", "goldne nigth", "gol"]
+BROWSE_FILTERS = [
+    {'genre': ['Fiction', 'Mystery']},
+    {'genre': ['Fantasy'], 'year': (1980, 2010), 'rating': [4, 5]},
+    {'tags': ['classic'], 'read': False},
+    {'collection': ['Favorites', 'Book Club'], 'genre': ['Fiction']},
+]
+PAGES = ["Dashboard", "Browse Books", "Search", "Collections", "Reading List", "Statistics", "Settings"]
+PAGE_SIZE = 25
+# Named library the sharded benchmarks use.
+SHARDED_LIBRARY = "Benchmark"
+
+
+class Benchmark:
+    """Times the operations of one library size on one backend."""
+
+    def __init__(self, size, backend, workdir, repeat=REPEAT):
+        self.size = size
+        self.backend = backend
+        self.workdir = workdir
+        self.repeat = repeat
+        self.library_path = os.path.join(workdir, "library.json")
+        self.db_path = os.path.join(workdir, "library.db")
+        self.libraries_path = os.path.join(workdir, "libraries")
+        self.sharded_path = os.path.join(self.libraries_path, SHARDED_LIBRARY)
+        self.results = []
+
+    def time(self, name, run, repeat=None, setup=None):
+        """Time ``run()`` ``repeat`` times, calling ``setup()`` untimed before each run."""
+        runs = []
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            run()
+            runs.append(time.perf_counter() - started)
+        self.results.append({
+            'size': self.size,
+            'backend': self.backend,
+            'name': name,
+            'seconds': statistics.median(runs),
+            'runs': runs,
+        })
+        print(f"  {self.backend:6} {self.size:>9,} {name:32} {statistics.median(runs):9.4f}s", file=sys.stderr)
+
+    def open_repository(self, binary_snapshot=False):
+        if self.backend == 'sqlite':
+            return SqliteRepository(self.db_path)
+        if self.backend == 'sharded':
+            return ShardedRepository.open(self.sharded_path, binary_snapshot=binary_snapshot)
+        return JsonRepository.open(JournalStore(self.library_path, binary_snapshot=binary_snapshot))
+
+    def run_library(self):
+        """Time the repository operations that back each page."""
+        if self.backend == 'sqlite':
+            store = JournalStore(self.library_path, binary_snapshot=False)
+            self.time("load_library (seed sqlite)", lambda: SqliteRepository(self.db_path).replace(apply_journal(store.open())), repeat=1)
+            self.time("load_library", self.open_repository)
+        elif self.backend == 'sharded':
+            store = JournalStore(self.library_path, binary_snapshot=False)
+            create_library(self.libraries_path, SHARDED_LIBRARY)
+            self.time("load_library (seed shards)", lambda: self.open_repository().replace(apply_journal(store.open())), repeat=1)
+            self.time("load_library", self.open_repository)
+            self.open_repository(binary_snapshot=True)
+            self.time("load_library (binary snapshot)", lambda: self.open_repository(binary_snapshot=True))
+        else:
+            self.time("load_library", self.open_repository)
+            self.open_repository(binary_snapshot=True)
+            self.time("load_library (binary snapshot)", lambda: self.open_repository(binary_snapshot=True))
+        repo = self.open_repository(binary_snapshot=True)
+
+        def dashboard():
+            repo.count_books()
+            repo.count_books(read=True)
+            repo.count_distinct('genre')
+            repo.count_distinct('author')
+            repo.genre_counts()
+            repo.recent_books(5)
+
+        self.time("dashboard aggregates", dashboard)
+        self.time("recommendations (first)", lambda: repo.recommend_books(5), repeat=1)
+        self.time("recommendations", lambda: repo.recommend_books(5))
+        self.time("statistics aggregates", lambda: library_aggregates(repo))
+
+        for field in SORT_FIELDS:
+            def browse(field=field):
+                for read in (None, True, False):
+                    repo.query_books(read=read, sort_by=field, descending=True, limit=PAGE_SIZE)
+            self.time(f"browse sort={field}", browse)
+        self.time("browse deep page", lambda: repo.query_books(sort_by='title', limit=PAGE_SIZE, offset=self.size // 2))
+
+        def facets():
+            for filters in BROWSE_FILTERS:
+                repo.facet_counts(filters)
+                repo.filter_books(filters, sort_by='title', descending=True, limit=PAGE_SIZE)
+
+        self.time("browse facets", facets)
+
+        self.time("search (first query)", lambda: repo.search_books(SEARCH_QUERIES[0], limit=PAGE_SIZE + 1), repeat=1)
+        self.time("search", lambda: [repo.search_books(query, limit=PAGE_SIZE + 1) for query in SEARCH_QUERIES])
+        self.time("search suggestions (first)", lambda: repo.suggest_query(SEARCH_TYPOS[0]), repeat=1)
+        self.time("search suggestions", lambda: [
+            (repo.suggest_query(query), repo.complete_query(query)) for query in SEARCH_TYPOS
+        ])
+
+        for fmt in FORMATS:
+            self.time(f"export {fmt}", lambda fmt=fmt: run_job(export_job(repo, fmt)))
+
+        csv_file = io.BytesIO()
+        write_export(repo, 'csv', csv_file)
+        csv_data = csv_file.getvalue()
+        targets = []
+
+        def new_target():
+            directory = tempfile.mkdtemp(dir=self.workdir)
+            if self.backend == 'sqlite':
+                targets.append(SqliteRepository(os.path.join(directory, "import.db")))
+            elif self.backend == 'sharded':
+                targets.append(ShardedRepository.open(create_library(directory, SHARDED_LIBRARY), binary_snapshot=False))
+            else:
+                targets.append(JsonRepository.open(JournalStore(os.path.join(directory, "import.json"), binary_snapshot=False)))
+
+        self.time("import csv", lambda: run_job(import_csv_job(targets[-1], csv_data)), setup=new_target)
+        del targets[:]
+
+        backups = BackupStore(os.path.join(self.workdir, "backups"))
+        self.time("backup (first)", lambda: backups.create(repo), repeat=1)
+        self.time("backup (unchanged)", lambda: backups.create(repo))
+        point = backups.list()[0]['id']
+        self.time("restore", lambda: backups.restore(point, repo), repeat=1)
+        self.time("save_library", lambda: repo.replace(repo.export_data()), repeat=1)
+
+    def run_pages(self):
+        """Time full script runs of every page through ``AppTest``."""
+        import streamlit as st
+        from streamlit.testing.v1 import AppTest
+
+        os.environ.update({
+            'LIBRARY_BACKEND': 'sqlite' if self.backend == 'sqlite' else 'json',
+            'LIBRARY_ROOT': self.libraries_path,
+            'LIBRARY_DB': self.db_path,
+            'LIBRARY_BACKUPS': os.path.join(self.workdir, "backups"),
+        })
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            app = AppTest.from_file(APP_PATH, default_timeout=600)
+            if self.backend == 'sharded':
+                app.session_state["library"] = SHARDED_LIBRARY
+
+            def run(page=None, query=None):
+                if page is not None:
+                    app.session_state["nav_option"] = page
+                app.run()
+                if query is not None:
+                    app.main.text_input[0].set_value(query).run()
+                if app.exception:
+                    raise RuntimeError(f"{page} failed: {app.exception[0].value}")
+
+            # Drop the repository and figures another size or backend left in the process caches.
+            self.time("page cold start", run, repeat=1, setup=st.cache_resource.clear)
+            for page in PAGES:
+                query = SEARCH_QUERIES[0] if page == "Search" else None
+                self.time(f"page {page}", lambda page=page, query=query: run(page, query))
+        finally:
+            os.chdir(cwd)
+
+
+def run_job(run):
+    """Run a job the way the job queue does, in this thread, and delete any file it offers for download."""
+    job = Job('benchmark', "Benchmark")
+    job.result = run(job)
+    job.discard()
+    return job.result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(APP_PATH)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes=SIZES, backends=BACKENDS, repeat=REPEAT, pages=True, seed=0):
+    """Run every benchmark and return the report."""
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'seed': seed,
+        },
+        'results': []
+    }
+    for size in sizes:
+        for backend in backends:
+            workdir = tempfile.mkdtemp(prefix=f"bench-{backend}-{size}-")
+            try:
+                write_library(os.path.join(workdir, "library.json"), size, seed)
+                bench = Benchmark(size, backend, workdir, repeat)
+                bench.run_library()
+                if pages:
+                    bench.run_pages()
+                report['results'].extend(bench.results)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def compare(report, baseline, ratio=REGRESSION_RATIO):
+    """Print each result against ``baseline``; return the keys that got slower than ``ratio``."""
+    previous = {(r['size'], r['backend'], r['name']): r['seconds'] for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        key = (result['size'], result['backend'], result['name'])
+        if key not in previous:
+            continue
+        change = result['seconds'] / previous[key] if previous[key] else float('inf')
+        flag = "  SLOWER" if change > ratio else ""
+        print(f"{result['backend']:6} {result['size']:>9,} {result['name']:32} {previous[key]:9.4f}s -> {result['seconds']:9.4f}s  x{change:.2f}{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the library on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="library sizes in books")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="timed runs per benchmark")
+    parser.add_argument("--no-pages", action="store_true", help="skip the AppTest page runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against an earlier JSON report")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.backends, args.repeat, not args.no_pages, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
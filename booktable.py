@@ -0,0 +1,459 @@
+"""Columnar in-memory book table for the JSON backend."""
+from collections.abc import Mapping
+from itertools import islice
+from operator import attrgetter
+
+import numpy as np
+
+COLUMNS = ['id', 'title', 'author', 'year', 'genre', 'read', 'rating', 'notes', 'isbn', 'tags', 'date_added']
+
+# Layout of stored dates; other date strings are kept verbatim as overrides.
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Books encoded per step while a table is built from a stream.
+LOAD_BATCH = 10_000
+
+_INT32_MIN, _INT32_MAX = -2 ** 31, 2 ** 31 - 1
+# int64 value that reads as NaT when the date column is viewed as datetime64.
+_NAT = np.iinfo(np.int64).min
+
+
+class _Missing:
+    def __repr__(self):
+        return '<missing>'
+
+    def __reduce__(self):
+        # Unpickle to the module's ``MISSING``, so ``is MISSING`` checks hold after a binary snapshot.
+        return 'MISSING'
+
+
+# Marks a column key that is absent from the book.
+MISSING = _Missing()
+
+
+class Book(Mapping):
+    """Snapshot of one table row, usable wherever a book dict is read.
+
+    Changing a ``Book`` does not change the table; write through the repository.
+    """
+
+    __slots__ = COLUMNS + ['_extra']
+
+    def __init__(self, values, extra=None):
+        (self.id, self.title, self.author, self.year, self.genre, self.read, self.rating,
+         self.notes, self.isbn, self.tags, self.date_added) = values
+        self._extra = extra
+
+    def __getitem__(self, key):
+        if key in _COLUMN_SET:
+            value = getattr(self, key)
+            if value is MISSING:
+                raise KeyError(key)
+            return value
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for name in COLUMNS:
+            if getattr(self, name) is not MISSING:
+                yield name
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Book({self.to_dict()!r})"
+
+    def to_dict(self):
+        """Return the book as a plain (JSON serializable) dict."""
+        book = {name: value for name, value in zip(COLUMNS, _get_columns(self)) if value is not MISSING}
+        if self._extra:
+            book.update(self._extra)
+        return book
+
+
+_COLUMN_SET = frozenset(COLUMNS)
+_COLUMN_INDEX = {name: i for i, name in enumerate(COLUMNS)}
+_get_columns = attrgetter(*COLUMNS)
+
+
+class _Array:
+    """Growable NumPy array with amortized O(1) appends."""
+
+    def __init__(self, dtype):
+        self.data = np.zeros(0, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        needed = self.size + len(values)
+        if needed > len(self.data):
+            grown = np.zeros(max(needed, 2 * len(self.data), 1024), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:needed] = values
+        self.size = needed
+
+    def move_last(self, row):
+        """Drop the last element after copying it into ``row``."""
+        self.size -= 1
+        self.data[row] = self.data[self.size]
+
+    def view(self):
+        return self.data[:self.size]
+
+
+class _Categories:
+    """Integer codes into a growing list of distinct string values; -1 marks a non-string."""
+
+    def __init__(self):
+        self.codes = _Array(np.int32)
+        self.values = []
+        self.lookup = {}
+
+    def encode(self, value):
+        if not isinstance(value, str):
+            return -1
+        code = self.lookup.get(value)
+        if code is None:
+            code = self.lookup[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def _encode_dates(values):
+    """Return int64 seconds for dates in ``DATE_FORMAT`` and a mask of the ones that fit."""
+    candidates = [v if isinstance(v, str) and len(v) == 19 and v[10] == ' ' else '1970-01-01 00:00:00' for v in values]
+    try:
+        parsed = np.array(candidates, dtype='datetime64[s]')
+    except ValueError:
+        parsed = np.array([_parse_date(v) for v in candidates], dtype='datetime64[s]')
+    formatted = np.datetime_as_string(parsed, unit='s')
+    fits = [isinstance(v, str) and f[:10] + ' ' + f[11:] == v for v, f in zip(values, formatted.tolist())]
+    return parsed.astype(np.int64), fits
+
+
+def _parse_date(value):
+    try:
+        return np.datetime64(value, 's')
+    except ValueError:
+        return np.datetime64(0, 's')
+
+
+def _format_dates(seconds):
+    formatted = np.datetime_as_string(np.asarray(seconds, dtype=np.int64).astype('datetime64[s]'), unit='s')
+    return [f[:10] + ' ' + f[11:] for f in formatted.tolist()]
+
+
+def _fits_int32(value):
+    return type(value) is int and _INT32_MIN <= value <= _INT32_MAX
+
+
+class BookTable:
+    """Books stored column by column, addressed by id."""
+
+    def __init__(self, books=()):
+        self.ids = []
+        self.titles = []
+        self.notes = []
+        self.isbns = []
+        self.tags = []
+        self.authors = _Categories()
+        self.genres = _Categories()
+        self.year = _Array(np.int32)
+        self.rating = _Array(np.int32)
+        self.read = _Array(np.bool_)
+        self.date_added = _Array(np.int64)
+        # Row -> {field: raw value, or MISSING} for values the columns cannot hold.
+        self.overrides = {}
+        self.rows = {}
+        books = iter(books)
+        while True:
+            batch = list(islice(books, LOAD_BATCH))
+            if not batch:
+                break
+            self.put_many(batch)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, book_id):
+        return book_id in self.rows
+
+    def __iter__(self):
+        for start in range(0, len(self), 1000):
+            yield from self.books(range(start, min(start + 1000, len(self))))
+
+    def iter_dicts(self, batch_size=1000):
+        """Yield every book as a plain dict, one batch of rows at a time."""
+        for start in range(0, len(self), batch_size):
+            yield from self.dicts(range(start, min(start + batch_size, len(self))))
+
+    def _encode(self, books):
+        """Split books into column values plus per-row overrides."""
+        raw = {name: [book.get(name, MISSING) for book in books] for name in COLUMNS}
+        overrides = [None] * len(books)
+
+        def override(i, name, value):
+            if overrides[i] is None:
+                overrides[i] = {}
+            overrides[i][name] = value
+
+        for i, book in enumerate(books):
+            for key in book:
+                if key not in _COLUMN_SET:
+                    override(i, key, book[key])
+        for name in ('id', 'title', 'notes', 'isbn'):
+            for i, value in enumerate(raw[name]):
+                if value is MISSING:
+                    override(i, name, MISSING)
+        columns = {name: raw[name] for name in ('id', 'title', 'notes', 'isbn')}
+
+        tags = []
+        for i, value in enumerate(raw['tags']):
+            if type(value) is list:
+                tags.append(tuple(value))
+            else:
+                tags.append(())
+                override(i, 'tags', value)
+        columns['tags'] = tags
+
+        for name, categories in (('author', self.authors), ('genre', self.genres)):
+            codes = [categories.encode(value) for value in raw[name]]
+            for i, code in enumerate(codes):
+                if code < 0:
+                    override(i, name, raw[name][i])
+            columns[name] = codes
+
+        for name in ('year', 'rating'):
+            values = []
+            for i, value in enumerate(raw[name]):
+                if _fits_int32(value):
+                    values.append(value)
+                else:
+                    values.append(0)
+                    override(i, name, value)
+            columns[name] = values
+
+        read = []
+        for i, value in enumerate(raw['read']):
+            read.append(bool(value) if value is not MISSING else False)
+            if type(value) is not bool:
+                override(i, 'read', value)
+        columns['read'] = read
+
+        seconds, fits = _encode_dates(raw['date_added'])
+        for i, fit in enumerate(fits):
+            if not fit:
+                seconds[i] = _NAT
+                override(i, 'date_added', raw['date_added'][i])
+        columns['date_added'] = seconds
+        return columns, overrides
+
+    def put_many(self, books):
+        """Add books, replacing rows with the same id in place; returns the replaced books (or ``None``)."""
+        if not books:
+            return []
+        columns, overrides = self._encode(books)
+        previous = []
+        appended = []
+        for i, book in enumerate(books):
+            book_id = book['id']
+            row = self.rows.get(book_id)
+            if row is None:
+                previous.append(None)
+                # A batch may name the same id twice; the later copy wins.
+                self.rows[book_id] = len(self.ids) + len(appended)
+                appended.append(i)
+            elif row >= len(self.ids):
+                previous.append(None)
+                appended[row - len(self.ids)] = i
+            else:
+                previous.append(self.book(row))
+                self._write_row(row, columns, overrides, i)
+        if appended:
+            start = len(self.ids)
+            for row, i in enumerate(appended, start):
+                if overrides[i] is not None:
+                    self.overrides[row] = overrides[i]
+            self.ids.extend(columns['id'][i] for i in appended)
+            self.titles.extend(columns['title'][i] for i in appended)
+            self.notes.extend(columns['notes'][i] for i in appended)
+            self.isbns.extend(columns['isbn'][i] for i in appended)
+            self.tags.extend(columns['tags'][i] for i in appended)
+            self.authors.codes.extend([columns['author'][i] for i in appended])
+            self.genres.codes.extend([columns['genre'][i] for i in appended])
+            self.year.extend([columns['year'][i] for i in appended])
+            self.rating.extend([columns['rating'][i] for i in appended])
+            self.read.extend([columns['read'][i] for i in appended])
+            self.date_added.extend(columns['date_added'][appended])
+        return previous
+
+    def _write_row(self, row, columns, overrides, i):
+        self.ids[row] = columns['id'][i]
+        self.titles[row] = columns['title'][i]
+        self.notes[row] = columns['notes'][i]
+        self.isbns[row] = columns['isbn'][i]
+        self.tags[row] = columns['tags'][i]
+        self.authors.codes.data[row] = columns['author'][i]
+        self.genres.codes.data[row] = columns['genre'][i]
+        self.year.data[row] = columns['year'][i]
+        self.rating.data[row] = columns['rating'][i]
+        self.read.data[row] = columns['read'][i]
+        self.date_added.data[row] = columns['date_added'][i]
+        if overrides[i] is None:
+            self.overrides.pop(row, None)
+        else:
+            self.overrides[row] = overrides[i]
+
+    def remove(self, book_id):
+        """Remove a book by moving the last row into its slot; returns the removed book."""
+        row = self.rows.pop(book_id, None)
+        if row is None:
+            return None
+        removed = self.book(row)
+        last = len(self.ids) - 1
+        for column in (self.ids, self.titles, self.notes, self.isbns, self.tags):
+            column[row] = column[last]
+            column.pop()
+        for array in (self.authors.codes, self.genres.codes, self.year, self.rating, self.read, self.date_added):
+            array.move_last(row)
+        moved = self.overrides.pop(last, None)
+        self.overrides.pop(row, None)
+        if row < last:
+            self.rows[self.ids[row]] = row
+            if moved is not None:
+                self.overrides[row] = moved
+        return removed
+
+    def row_of(self, book_id):
+        return self.rows.get(book_id)
+
+    def get(self, book_id):
+        row = self.rows.get(book_id)
+        return None if row is None else self.book(row)
+
+    def get_many(self, book_ids):
+        """Return the books for ``book_ids`` in order, skipping unknown ids."""
+        rows = self.rows
+        return self.books([rows[book_id] for book_id in book_ids if book_id in rows])
+
+    def book(self, row):
+        return self.books([row])[0]
+
+    def _row_values(self, rows):
+        """Yield ``(column values, overrides)`` for each of ``rows``."""
+        authors, genres = self.authors.values + [None], self.genres.values + [None]
+        ids, titles, notes, isbns, tags = self.ids, self.titles, self.notes, self.isbns, self.tags
+        columns = zip(
+            self.authors.codes.data[rows].tolist(),
+            self.year.data[rows].tolist(),
+            self.genres.codes.data[rows].tolist(),
+            self.read.data[rows].tolist(),
+            self.rating.data[rows].tolist(),
+            _format_dates(self.date_added.data[rows])
+        )
+        overrides = self.overrides
+        for row, (author, year, genre, read, rating, date_added) in zip(rows, columns):
+            values = [
+                ids[row], titles[row], authors[author], year, genres[genre], read, rating,
+                notes[row], isbns[row], list(tags[row]), date_added
+            ]
+            yield values, overrides.get(row)
+
+    def books(self, rows):
+        """Materialize ``Book`` snapshots for a sequence of rows."""
+        rows = list(rows)
+        if not rows:
+            return []
+        result = []
+        for values, overrides in self._row_values(rows):
+            extra = None
+            if overrides:
+                for key, value in overrides.items():
+                    index = _COLUMN_INDEX.get(key)
+                    if index is not None:
+                        values[index] = value
+                    else:
+                        if extra is None:
+                            extra = {}
+                        extra[key] = value
+            result.append(Book(values, extra))
+        return result
+
+    def dicts(self, rows):
+        """Return plain book dicts for a sequence of rows, as stored in the library file."""
+        rows = list(rows)
+        if not rows:
+            return []
+        result = []
+        for values, overrides in self._row_values(rows):
+            book = dict(zip(COLUMNS, values))
+            if overrides:
+                for key, value in overrides.items():
+                    if value is MISSING:
+                        del book[key]
+                    else:
+                        book[key] = value
+            result.append(book)
+        return result
+
+    def values(self, field, rows):
+        """Return the stored values of one field for ``rows`` (``None`` where the key is absent)."""
+        rows = list(rows)
+        if field in ('title', 'notes', 'isbn', 'id'):
+            column = {'title': self.titles, 'notes': self.notes, 'isbn': self.isbns, 'id': self.ids}[field]
+            values = [column[row] for row in rows]
+        elif field in ('author', 'genre'):
+            categories = self.authors if field == 'author' else self.genres
+            lookup = categories.values + [None]
+            values = [lookup[code] for code in categories.codes.data[rows].tolist()]
+        elif field in ('year', 'rating', 'read'):
+            values = getattr(self, field).data[rows].tolist()
+        elif field == 'date_added':
+            values = _format_dates(self.date_added.data[rows])
+        elif field == 'tags':
+            values = [list(self.tags[row]) for row in rows]
+        else:
+            values = [None] * len(rows)
+        if self.overrides:
+            for j, row in enumerate(rows):
+                overrides = self.overrides.get(row)
+                if overrides and field in overrides:
+                    value = overrides[field]
+                    values[j] = None if value is MISSING else value
+        return values
+
+    def has_overrides(self, field):
+        """True when some row holds its ``field`` value as an override rather than in the column."""
+        return any(field in overrides for overrides in self.overrides.values())
+
+    def read_rows(self, read):
+        """Return the rows whose read flag (as truth value) equals ``read``."""
+        return np.flatnonzero(self.read.view() == bool(read))
+
+    def frame(self, columns=None):
+        """Return a copy of the table as a pandas DataFrame.
+
+        Genre and author are categoricals.  Values held as overrides show as
+        the column default (0, False, NaT or a missing category).
+        """
+        import pandas as pd
+
+        columns = columns or COLUMNS
+        data = {}
+        for name in columns:
+            if name in ('year', 'rating', 'read'):
+                data[name] = getattr(self, name).view().copy()
+            elif name == 'date_added':
+                data[name] = self.date_added.view().astype('datetime64[s]')
+            elif name in ('author', 'genre'):
+                categories = self.authors if name == 'author' else self.genres
+                data[name] = pd.Categorical.from_codes(categories.codes.view().copy(), categories=list(categories.values), validate=False)
+            elif name == 'tags':
+                data[name] = [list(tags) for tags in self.tags]
+            else:
+                data[name] = list({'id': self.ids, 'title': self.titles, 'notes': self.notes, 'isbn': self.isbns}[name])
+        return pd.DataFrame(data, copy=False)
@@ -0,0 +1,141 @@
+"""Chart figures for the Dashboard and Statistics pages."""
+import threading
+from collections import OrderedDict
+
+import plotly.graph_objects as go
+
+# Entries (figures and aggregates) kept by a figure cache.
+FIGURE_CACHE_CAPACITY = 64
+
+# Bars shown on the top-authors and read-rate charts.
+TOP_AUTHORS = 10
+TOP_GENRES = 15
+
+READ_COLOR = "#2ecc71"
+UNREAD_COLOR = "#e0e0e0"
+
+
+class FigureCache:
+    """Thread-safe LRU cache for values derived from the library.
+
+    Keys should include the repository ``version`` so that any write makes
+    the old entries unreachable; they then age out of the cache.
+    """
+
+    def __init__(self, capacity=FIGURE_CACHE_CAPACITY):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """Return the cached value for ``key``, calling ``build()`` to create it on a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        # Built outside the lock so a slow aggregation does not block other sessions.
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def library_aggregates(repo):
+    """Compute the Statistics aggregates from a single read of the book columns.
+
+    Returns a dict of ``(labels, values)`` pairs (``read_rate`` also carries
+    the number of books per genre), each ready to be charted.
+    """
+    frame = repo.book_frame(['author', 'genre', 'year', 'rating', 'read'])
+    ratings = frame['rating'][frame['rating'] > 0].value_counts().sort_index()
+    years = frame['year'][frame['year'] > 0].value_counts().sort_index()
+    authors = frame['author'][frame['author'].notna() & (frame['author'] != '')]
+    authors = authors.value_counts(sort=True).head(TOP_AUTHORS)
+    genres = frame[frame['genre'].notna() & (frame['genre'] != '')]
+    read_rate = genres.groupby('genre', observed=True)['read'].agg(['mean', 'size'])
+    read_rate = read_rate.sort_values('size', ascending=False, kind='stable').head(TOP_GENRES)
+    genre_counts = repo.genre_counts()
+    return {
+        'genres': ([genre for genre, _ in genre_counts], [count for _, count in genre_counts]),
+        'ratings': (ratings.index.tolist(), ratings.tolist()),
+        'years': (years.index.tolist(), years.tolist()),
+        'read_rate': (read_rate.index.tolist(), (read_rate['mean'] * 100).tolist(), read_rate['size'].tolist()),
+        'authors': (authors.index.tolist(), authors.tolist()),
+    }
+
+
+def reading_progress_figure(num_read, total_books):
+    fig = go.Figure(go.Pie(
+        values=[num_read, total_books - num_read],
+        labels=["Read", "Unread"],
+        hole=0.5,
+        marker=dict(colors=[READ_COLOR, UNREAD_COLOR])
+    ))
+    fig.update_layout(
+        annotations=[dict(text=f"{(num_read/total_books*100):.1f}%", x=0.5, y=0.5, font_size=20, showarrow=False)],
+        legend=dict(orientation="h", yanchor="bottom", y=-0.2, xanchor="center", x=0.5)
+    )
+    return fig
+
+
+def _bar_figure(x, y, title, x_title, y_title, **bar):
+    fig = go.Figure(go.Bar(x=x, y=y, **bar))
+    fig.update_layout(title=title, xaxis_title=x_title, yaxis_title=y_title)
+    return fig
+
+
+def genre_figure(aggregate):
+    genres, counts = aggregate
+    return _bar_figure(genres, counts, "Books by Genre", "genre", "count")
+
+
+def rating_figure(aggregate):
+    ratings, counts = aggregate
+    fig = _bar_figure(ratings, counts, "Ratings Distribution", "rating", "count")
+    fig.update_xaxes(dtick=1)
+    return fig
+
+
+def year_figure(aggregate):
+    years, counts = aggregate
+    return _bar_figure(years, counts, "Books by Publication Year", "year", "count")
+
+
+def read_rate_figure(aggregate):
+    genres, percents, sizes = aggregate
+    fig = _bar_figure(
+        genres, percents, "Read Rate by Genre", "genre", "% read",
+        marker_color=READ_COLOR,
+        customdata=sizes,
+        hovertemplate="%{x}: %{y:.1f}% of %{customdata} books read<extra></extra>"
+    )
+    fig.update_yaxes(range=[0, 100])
+    return fig
+
+
+def author_figure(aggregate):
+    authors, counts = aggregate
+    fig = _bar_figure(counts, authors, "Top Authors", "books", "author", orientation='h')
+    fig.update_yaxes(autorange="reversed")
+    return fig
+
+
+# Statistics page charts, in display order: (subheader, aggregate name, figure builder).
+STATISTICS_CHARTS = [
+    ("Genre Distribution", 'genres', genre_figure),
+    ("Ratings", 'ratings', rating_figure),
+    ("Publication Years", 'years', year_figure),
+    ("Read Rate by Genre", 'read_rate', read_rate_figure),
+    ("Top Authors", 'authors', author_figure),
+]
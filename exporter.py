@@ -0,0 +1,94 @@
+"""Streaming exporters for the library."""
+import csv
+import gzip
+import io
+import json
+
+# Books written between two progress reports.
+PROGRESS_INTERVAL = 1000
+
+CSV_COLUMNS = ['id', 'title', 'author', 'year', 'genre', 'read', 'rating', 'notes', 'isbn', 'tags', 'date_added']
+
+# Export formats: file extension and MIME type.
+FORMATS = {
+    'json': ('json', 'application/json'),
+    'jsonl': ('jsonl', 'application/x-ndjson'),
+    'csv': ('csv', 'text/csv'),
+}
+
+
+def iter_json(repo, books=None):
+    """Yield the full library (books, collections, reading list) as JSON text, one book per line."""
+    yield '{"books": ['
+    first = True
+    for book in repo.iter_books() if books is None else books:
+        yield ('\n' if first else ',\n') + json.dumps(book)
+        first = False
+    yield '\n], "collections": '
+    yield json.dumps(repo.collections())
+    yield ', "reading_list": '
+    yield json.dumps(repo.reading_list())
+    yield '}\n'
+
+
+def iter_jsonl(repo, books=None):
+    """Yield one JSON object per book, one per line."""
+    for book in repo.iter_books() if books is None else books:
+        yield json.dumps(book) + '\n'
+
+
+def iter_csv(repo, books=None):
+    """Yield CSV text, one row per book, with tags joined by commas."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    for book in repo.iter_books() if books is None else books:
+        tags = book.get('tags')
+        writer.writerow(dict(book, tags=','.join(tags) if isinstance(tags, list) else ''))
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+EXPORTERS = {
+    'json': iter_json,
+    'jsonl': iter_jsonl,
+    'csv': iter_csv,
+}
+
+
+def _counted(books, progress):
+    count = 0
+    for book in books:
+        yield book
+        count += 1
+        if count % PROGRESS_INTERVAL == 0:
+            progress(count)
+
+
+def write_export(repo, fmt, f, compress=False, progress=None):
+    """Write an export of ``repo`` in ``fmt`` to the binary file ``f``.
+
+    ``progress`` is called with the number of books written so far every
+    ``PROGRESS_INTERVAL`` books.
+    """
+    books = repo.iter_books()
+    if progress is not None:
+        books = _counted(books, progress)
+    target = gzip.GzipFile(fileobj=f, mode='wb') if compress else f
+    try:
+        for piece in EXPORTERS[fmt](repo, books):
+            target.write(piece.encode('utf-8'))
+    finally:
+        if compress:
+            target.close()
+
+
+def export_name(fmt, compress=False):
+    """Return the ``(file_name, mime)`` of an export in ``fmt``."""
+    extension, mime = FORMATS[fmt]
+    if compress:
+        return f"library.{extension}.gz", 'application/gzip'
+    return f"library.{extension}", mime
@@ -0,0 +1,481 @@
+"""Faceted filtering, facet counts and sorting for Browse Books.
+
+A filter is a dict of facets, and a book matches when it matches every facet
+given:
+- ``genre``, ``author``: stored values, any of which matches
+- ``year``: ``(lowest, highest)``, inclusive; either end may be ``None``
+- ``rating``: ratings (0 for unrated), any of which matches
+- ``read``: ``True`` or ``False``
+- ``tags``: tags, at least one of which the book must carry
+- ``collection``: collection names; the book must be in one of them
+- ``ids``: book ids the result is restricted to
+"""
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
+
+import numpy as np
+
+FACETS = ['genre', 'author', 'year', 'rating', 'read', 'tags', 'collection']
+# Facets plus the filters that have no counts of their own.
+FILTERS = FACETS + ['ids']
+
+# Share of the table a write may touch before the indexes are built anew rather than updated.
+REBUILD_FRACTION = 0.25
+
+_INT32_MIN, _INT32_MAX = -2 ** 31, 2 ** 31 - 1
+# Pairs of a value and a position below 2 ** 32 pack into one int64 key.
+_PAIR_BASE = 2 ** 32
+# New distinct sort keys inserted one by one; more are merged in one pass.
+_INSORT_LIMIT = 64
+_NO_ROWS = np.zeros(0, dtype=np.intp)
+
+
+def normalize_filters(filters):
+    """Return ``filters`` with unset facets dropped and values in a canonical, hashable form.
+
+    An empty value list leaves its facet unset, except for ``ids``, where it
+    matches no book.  Raises ``ValueError`` for an unknown facet.
+    """
+    result = {}
+    for name, value in (filters or {}).items():
+        if name not in FILTERS:
+            raise ValueError(f"Unsupported facet: {name}")
+        if value is None:
+            continue
+        if name == 'read':
+            result[name] = bool(value)
+        elif name == 'year':
+            lowest, highest = value
+            if lowest is not None or highest is not None:
+                result[name] = (None if lowest is None else int(lowest), None if highest is None else int(highest))
+        else:
+            values = (value,) if isinstance(value, str) else tuple(dict.fromkeys(value))
+            if name == 'rating':
+                values = tuple(int(rating) for rating in values)
+            if values or name == 'ids':
+                result[name] = values
+    return result
+
+
+def filters_key(filters):
+    """Return a hashable key for ``filters``, equal for equivalent filters."""
+    return tuple(sorted(normalize_filters(filters).items()))
+
+
+def order_counts(field, counts):
+    """Turn a ``{value: count}`` mapping for ``field`` into the ``(value, count)`` list ``facet_counts`` returns.
+
+    Years and ratings are listed by value, read state as ``True`` then
+    ``False``, and everything else most common first.  Zero counts, and
+    empty or non-string values of the other facets, are left out.
+    """
+    if field == 'read':
+        return [(True, counts.get(True, 0)), (False, counts.get(False, 0))]
+    if field in ('year', 'rating'):
+        return sorted((value, count) for value, count in counts.items() if count and value is not None)
+    pairs = sorted((value, count) for value, count in counts.items() if count and isinstance(value, str) and value)
+    # A stable sort by count keeps equally common values in value order.
+    pairs.sort(key=itemgetter(1), reverse=True)
+    return pairs
+
+
+class _SortedColumn:
+    """The positions of one integer column ordered by value, positions ascending within a value."""
+
+    def __init__(self, values):
+        self.values = values
+        self.order = np.argsort(values, kind='stable')
+        self.sorted = values[self.order]
+
+    def bounds(self, lowest, highest):
+        """Return the slice of ``order`` holding the values ``lowest`` to ``highest``."""
+        return (
+            int(np.searchsorted(self.sorted, lowest, 'left')),
+            int(np.searchsorted(self.sorted, highest, 'right'))
+        )
+
+    def update(self, values, kept, added):
+        """Follow the column after a write.
+
+        ``kept`` maps each old position to its new one, or to -1 when the
+        position was dropped or its value changed.  ``added`` lists the new
+        positions whose ``values`` are to be inserted.
+        """
+        moved = kept[self.order]
+        keep = moved >= 0
+        order, ordered = moved[keep], self.sorted[keep]
+        added_values = values[added]
+        by_value = np.lexsort((added, added_values))
+        added, added_values = added[by_value], added_values[by_value]
+        # Remapping keeps the order by value, then position, so one search places every insert.
+        at = np.searchsorted(_pair_keys(ordered, order), _pair_keys(added_values, added))
+        self.values = values
+        self.order = np.insert(order, at, added)
+        self.sorted = np.insert(ordered, at, added_values)
+
+
+def _pair_keys(values, positions):
+    """Return int64 keys ordering ``(value, position)`` pairs of an int32 column."""
+    return values.astype(np.int64) * _PAIR_BASE + positions
+
+
+class _Ranks:
+    """Every row's rank among the distinct sort keys seen.
+
+    Keys no row holds any more keep their rank, so ranks order the rows but
+    may skip numbers.  ``numeric`` keys are an int64 array, others a list.
+    """
+
+    def __init__(self, keys, numeric):
+        self.numeric = numeric
+        if numeric:
+            self.distinct, ranks = np.unique(keys, return_inverse=True)
+        else:
+            self.distinct = sorted(set(keys))
+            lookup = {key: rank for rank, key in enumerate(self.distinct)}
+            ranks = np.array([lookup[key] for key in keys], dtype=np.int64)
+        self.ranks = ranks.reshape(-1).astype(np.int64)
+
+    def update(self, size, rows, keys):
+        """Resize to ``size`` rows and give ``rows`` the ranks of their new ``keys``."""
+        if self.numeric:
+            new = np.setdiff1d(keys, self.distinct)
+            inserted = np.searchsorted(self.distinct, new)
+            self.distinct = np.insert(self.distinct, inserted, new)
+        else:
+            distinct = self.distinct
+            new = sorted({key for key in keys if _find(distinct, key) is None})
+            inserted = np.array([bisect_left(distinct, key) for key in new], dtype=np.int64)
+            if len(new) <= _INSORT_LIMIT:
+                for key in new:
+                    insort(distinct, key)
+            else:
+                # Two sorted runs, which the sort merges in linear time.
+                self.distinct = sorted(distinct + new)
+        ranks = self.ranks[:size]
+        if len(new):
+            ranks = ranks + np.searchsorted(inserted, ranks, 'right')
+        if size > len(ranks):
+            ranks = np.concatenate([ranks, np.zeros(size - len(ranks), dtype=np.int64)])
+        if self.numeric:
+            ranks[rows] = np.searchsorted(self.distinct, keys)
+        else:
+            ranks[rows] = [bisect_left(self.distinct, key) for key in keys]
+        self.ranks = ranks
+
+
+def _find(ordered, key):
+    """Return the index of ``key`` in the sorted list ``ordered``, or ``None``."""
+    index = bisect_left(ordered, key)
+    return index if index < len(ordered) and ordered[index] == key else None
+
+
+class FacetIndex:
+    """Sorted-array indexes and presorted orderings over a ``BookTable``, built on first use.
+
+    The owner calls ``update`` after every write to the table.
+    """
+
+    def __init__(self, table, sort_key):
+        self.table = table
+        self.sort_key = sort_key
+        self._clear()
+
+    def _clear(self):
+        self.size = len(self.table)
+        self._columns = {}
+        self._tags = None
+        self._keys = {}
+        self._orders = {}
+        self._ids = None
+
+    def _values(self, field):
+        table = self.table
+        if field in ('genre', 'author'):
+            return (table.genres if field == 'genre' else table.authors).codes.view()
+        if field == 'read':
+            return table.read.view().view(np.int8)
+        return getattr(table, field).view()
+
+    def column(self, field):
+        column = self._columns.get(field)
+        if column is None:
+            column = self._columns[field] = _SortedColumn(self._values(field))
+        return column
+
+    def tag_pairs(self):
+        """Return ``(tags, lookup, rows, column)`` for the string tags.
+
+        ``tags`` lists the distinct tags and ``lookup`` maps each to its
+        code.  ``rows`` holds one entry per tag a row carries, and ``column``
+        sorts the matching tag codes.  The rows carrying one tag are
+        ``rows[column.order[start:stop]]``.
+        """
+        if self._tags is None:
+            tags, lookup = [], {}
+            rows, codes = self._pairs(range(len(self.table)), tags, lookup)
+            self._tags = (tags, lookup, rows, _SortedColumn(codes))
+        return self._tags
+
+    def _pairs(self, rows, tags, lookup):
+        """Return the ``(rows, codes)`` arrays of the string tags of ``rows``, adding new tags to ``tags`` and ``lookup``."""
+        pair_rows, codes = [], []
+        table_tags = self.table.tags
+        for row in rows:
+            for tag in dict.fromkeys(table_tags[row]):
+                if isinstance(tag, str):
+                    code = lookup.get(tag)
+                    if code is None:
+                        code = lookup[tag] = len(tags)
+                        tags.append(tag)
+                    pair_rows.append(row)
+                    codes.append(code)
+        return np.array(pair_rows, dtype=np.intp), np.array(codes, dtype=np.int32)
+
+    def id_rows(self, book_ids):
+        rows = self.table.rows
+        return np.unique(np.array([rows[book_id] for book_id in book_ids if book_id in rows], dtype=np.intp))
+
+    # Filtering
+
+    def _value_predicate(self, field, values):
+        column = self.column(field)
+        spans = [column.bounds(value, value) for value in values]
+        size = sum(stop - start for start, stop in spans)
+
+        def rows():
+            return np.sort(np.concatenate([column.order[start:stop] for start, stop in spans] or [_NO_ROWS]))
+
+        return size, rows, lambda rows: np.isin(column.values[rows], values)
+
+    def _predicate(self, name, value, collections):
+        """Return ``(size, rows, keep)`` for one facet.
+
+        ``size`` bounds the number of rows the facet matches, ``rows()``
+        returns them in ascending order and ``keep(rows)`` masks the given rows
+        that match.
+        """
+        if name in ('genre', 'author'):
+            lookup = (self.table.genres if name == 'genre' else self.table.authors).lookup
+            return self._value_predicate(name, [lookup[v] for v in value if isinstance(v, str) and v in lookup])
+        if name == 'rating':
+            return self._value_predicate(name, [v for v in value if _INT32_MIN <= v <= _INT32_MAX])
+        if name == 'read':
+            return self._value_predicate(name, [int(value)])
+        if name == 'year':
+            lowest = _INT32_MIN if value[0] is None else max(value[0], _INT32_MIN)
+            highest = _INT32_MAX if value[1] is None else min(value[1], _INT32_MAX)
+            column = self.column('year')
+            start, stop = column.bounds(lowest, highest) if lowest <= highest else (0, 0)
+
+            def keep(rows):
+                years = column.values[rows]
+                return (years >= lowest) & (years <= highest)
+
+            return stop - start, lambda: np.sort(column.order[start:stop]), keep
+        if name == 'tags':
+            _, lookup, pair_rows, column = self.tag_pairs()
+            spans = [column.bounds(code, code) for code in {lookup[tag] for tag in value if isinstance(tag, str) and tag in lookup}]
+            matched = []
+
+            def rows():
+                if not matched:
+                    found = [pair_rows[column.order[start:stop]] for start, stop in spans]
+                    matched.append(np.unique(np.concatenate(found)) if found else _NO_ROWS)
+                return matched[0]
+
+            return sum(stop - start for start, stop in spans), rows, lambda rows_: np.isin(rows_, rows(), assume_unique=True)
+        if name == 'collection':
+            value = [book_id for collection in value for book_id in collections.get(collection, ())]
+        matched = self.id_rows(value)
+        return len(matched), lambda: matched, lambda rows: np.isin(rows, matched, assume_unique=True)
+
+    def match(self, filters, collections=None, skip=None):
+        """Return the ascending rows matching every facet of normalized ``filters`` but ``skip``.
+
+        Returns ``None`` when no facet applies, meaning every row matches.
+        """
+        predicates = [
+            self._predicate(name, value, collections or {})
+            for name, value in filters.items() if name != skip
+        ]
+        if not predicates:
+            return None
+        # Start from the most selective facet and narrow its rows by the others.
+        predicates.sort(key=lambda predicate: predicate[0])
+        rows = predicates[0][1]()
+        for _, _, keep in predicates[1:]:
+            if not len(rows):
+                break
+            rows = rows[keep(rows)]
+        return rows
+
+    # Sorting
+
+    def _row_keys(self, field, rows, numeric=None):
+        """Return the sort keys of ``rows`` and whether they are numeric.
+
+        Keys are numeric when the table holds the field as numbers and no
+        value is an override; ``numeric`` says whether that held before, so
+        only ``rows`` need checking.  Other keys are ``sort_key`` applied to
+        the stored values.
+        """
+        if field in ('year', 'rating', 'date_added'):
+            if numeric is None:
+                numeric = not self.table.has_overrides(field)
+            overrides = self.table.overrides
+            if numeric and not any(field in overrides.get(row, ()) for row in rows.tolist()):
+                return self._values(field)[rows].astype(np.int64), True
+        return list(map(self.sort_key(field), self.table.values(field, rows))), False
+
+    def sort_keys(self, field):
+        """Return every row's rank by ``field``; equal values share a rank, and ranks may skip numbers."""
+        ranks = self._keys.get(field)
+        if ranks is None:
+            ranks = self._keys[field] = _Ranks(*self._row_keys(field, np.arange(len(self.table))))
+        return ranks.ranks
+
+    def id_ranks(self):
+        """Return every row's rank by book id."""
+        if self._ids is None:
+            self._ids = _Ranks(self.table.ids, numeric=False)
+        return self._ids.ranks
+
+    def _ranking(self, field):
+        """Return ``(positions, order)``: every row's unique position by ``field`` then book id, and the rows in that order."""
+        ranking = self._orders.get(field)
+        if ranking is None:
+            positions = self.sort_keys(field) * _PAIR_BASE + self.id_ranks()
+            ranking = self._orders[field] = (positions, np.argsort(positions))
+        return ranking
+
+    def order(self, field, descending=False):
+        """Return every row sorted by ``field``, ties by book id."""
+        order = self._ranking(field)[1]
+        return order[::-1] if descending else order
+
+    def _cursor(self, field, after, descending):
+        """Return where ``after``, a ``(value, book_id)`` pair, falls in the ascending order.
+
+        A row equal to the pair counts as before it, or as after it when
+        ``descending``.  The pair need not be in the table any more.
+        """
+        table, key = self.table, self.sort_key(field)
+        bisect = bisect_left if descending else bisect_right
+        return bisect(
+            self.order(field), (key(after[0]), after[1]),
+            key=lambda row: (key(table.values(field, [row])[0]), table.ids[row])
+        )
+
+    def sort(self, rows, field, descending=False, offset=0, limit=None, after=None):
+        """Return one page of ``rows`` (``None`` for every row) sorted by ``field``, ties by book id.
+
+        ``after`` is the ``(value, book_id)`` of the last book of the previous
+        page; the page then starts with the book that follows it.
+        """
+        stop = None if limit is None else offset + limit
+        positions, order = self._ranking(field)
+        if after is not None:
+            cursor = self._cursor(field, after, descending)
+            if rows is None:
+                return (order[:cursor][::-1] if descending else order[cursor:])[offset:stop]
+            if descending:
+                bound = positions[order[cursor]] if cursor < len(order) else np.iinfo(np.int64).max
+                rows = rows[positions[rows] < bound]
+            else:
+                bound = positions[order[cursor - 1]] if cursor else -1
+                rows = rows[positions[rows] > bound]
+        elif rows is None:
+            return self.order(field, descending)[offset:stop]
+        rows = rows[np.argsort(positions[rows])]
+        return (rows[::-1] if descending else rows)[offset:stop]
+
+    # Writes
+
+    def update(self, rows):
+        """Follow the table after a write that changed, appended or moved ``rows``; rows past its end were removed."""
+        size, table = len(self.table), self.table
+        rows = np.unique(np.array([row for row in rows if row < size], dtype=np.intp))
+        if len(rows) > REBUILD_FRACTION * size:
+            # Building anew is cheaper than placing this many rows.
+            self._clear()
+            return
+        kept = np.arange(self.size)
+        kept[size:] = -1
+        kept[rows[rows < self.size]] = -1
+        for field, column in self._columns.items():
+            column.update(self._values(field), kept, rows)
+        if self._tags is not None:
+            tags, lookup, pair_rows, column = self._tags
+            keep = kept[pair_rows] >= 0
+            added_rows, added_codes = self._pairs(rows.tolist(), tags, lookup)
+            moved = np.full(len(pair_rows), -1, dtype=np.intp)
+            moved[keep] = np.arange(np.count_nonzero(keep))
+            pair_rows = np.concatenate([pair_rows[keep], added_rows])
+            column.update(
+                np.concatenate([column.values[keep], added_codes]), moved,
+                np.arange(len(pair_rows) - len(added_rows), len(pair_rows))
+            )
+            self._tags = (tags, lookup, pair_rows, column)
+        if self._ids is not None:
+            self._ids.update(size, rows, [table.ids[row] for row in rows.tolist()])
+        for field, ranks in list(self._keys.items()):
+            keys, numeric = self._row_keys(field, rows, ranks.numeric)
+            if numeric != ranks.numeric:
+                # A row now holds the field as an override; the field is ranked anew when next sorted.
+                del self._keys[field]
+                self._orders.pop(field, None)
+                continue
+            ranks.update(size, rows, keys)
+        for field, (_, order) in list(self._orders.items()):
+            positions = self._keys[field].ranks * _PAIR_BASE + self.id_ranks()
+            # Ranks only ever shift up together, so the rows kept stay in order.
+            order = order[kept[order] >= 0]
+            placed = rows[np.argsort(positions[rows])]
+            order = np.insert(order, np.searchsorted(positions[order], positions[placed]), placed)
+            self._orders[field] = (positions, order)
+        self.size = size
+
+    # Counting
+
+    def counts(self, filters, collections=None):
+        """Return the disjunctive counts of every facet for normalized ``filters``."""
+        collections = collections or {}
+        base = self.match(filters, collections)
+        return {
+            field: self._count(field, self.match(filters, collections, skip=field) if field in filters else base, collections)
+            for field in FACETS
+        }
+
+    def _count(self, field, rows, collections):
+        if field == 'tags':
+            tags, _, pair_rows, column = self.tag_pairs()
+            codes = column.values
+            if rows is not None:
+                selected = np.zeros(len(self.table), dtype=bool)
+                selected[rows] = True
+                codes = codes[selected[pair_rows]]
+            found = np.bincount(codes, minlength=len(tags))
+            codes = np.flatnonzero(found)
+            counts = dict(zip([tags[code] for code in codes.tolist()], found[codes].tolist()))
+        elif field == 'collection':
+            counts = {}
+            for name, book_ids in collections.items():
+                members = self.id_rows(book_ids)
+                counts[name] = len(members) if rows is None else int(np.count_nonzero(np.isin(members, rows, assume_unique=True)))
+        else:
+            values = self._values(field)
+            if rows is not None:
+                values = values[rows]
+            if field in ('genre', 'author'):
+                categories = (self.table.genres if field == 'genre' else self.table.authors).values
+                found = np.bincount(values[values >= 0], minlength=len(categories))
+                codes = np.flatnonzero(found)
+                counts = dict(zip([categories[code] for code in codes.tolist()], found[codes].tolist()))
+            elif field == 'read':
+                read = int(np.count_nonzero(values))
+                counts = {True: read, False: len(values) - read}
+            else:
+                distinct, found = np.unique(values, return_counts=True)
+                counts = dict(zip(distinct.tolist(), found.tolist()))
+        return order_counts(field, counts)
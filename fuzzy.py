@@ -0,0 +1,222 @@
+"""Typo-tolerant lookup and completion of search words."""
+import bisect
+from collections import Counter
+
+import numpy as np
+
+# Longest words allowed no typo, and one typo; longer words allow two.
+EXACT_LENGTH = 2
+ONE_TYPO_LENGTH = 5
+# Longer words are completed but never matched with typos.
+MAX_WORD_LENGTH = 32
+# Most words ``TermIndex.complete`` returns for one prefix.
+MAX_COMPLETIONS = 1000
+
+
+def allowed_distance(word):
+    """Return the most edits a match for ``word`` may be away: 0, 1 or 2 by its length."""
+    if len(word) <= EXACT_LENGTH:
+        return 0
+    return 1 if len(word) <= ONE_TYPO_LENGTH else 2
+
+
+# Distinct letters a trigram key can pack; words with further letters are not matched with typos.
+_LETTER_LIMIT = 2 ** 16
+_POSITIONS = 64
+
+
+def trigrams(word):
+    """Return the padded trigrams of ``word`` in order; the position of each is its index."""
+    padded = f"  {word}  "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def _pack(first, second, third, position):
+    """Pack the dense letter codes of a trigram and its position into one integer key."""
+    return ((first * _LETTER_LIMIT + second) * _LETTER_LIMIT + third) * _POSITIONS + position
+
+
+def word_codes(word, width=MAX_WORD_LENGTH):
+    """Return the code points of ``word`` as a zero-padded ``int32`` row of ``width``."""
+    return np.array([word], dtype=f"U{width}").view(np.int32)
+
+
+def edit_distances(word, codes, lengths, limit):
+    """Return the edit distance from ``word`` to each row of ``codes``, counting adjacent swaps as one edit.
+
+    Distances above ``limit`` come back as ``limit + 1``.
+    """
+    count = len(lengths)
+    width = int(lengths.max()) if count else 0
+    # One contiguous row per letter position keeps the column steps fast.
+    codes = np.ascontiguousarray(codes[:, :width].T)
+    letters = [ord(char) for char in word]
+    far = limit + 1
+    before = None
+    previous = np.minimum(np.arange(width + 1, dtype=np.int32), far)[:, None].repeat(count, axis=1)
+    for i, letter in enumerate(letters, 1):
+        current = np.full_like(previous, far)
+        if i <= limit:
+            current[0] = i
+        for j in range(max(i - limit, 1), min(i + limit, width) + 1):
+            value = np.minimum(previous[j], current[j - 1]) + 1
+            np.minimum(value, previous[j - 1] + (codes[j - 1] != letter), out=value)
+            if i > 1 and j > 1:
+                swapped = (codes[j - 2] == letter) & (codes[j - 1] == letters[i - 2])
+                np.minimum(value, np.where(swapped, before[j - 2] + 1, value), out=value)
+            current[j] = value
+        before, previous = previous, current
+    return np.minimum(previous[lengths, np.arange(count)], far)
+
+
+class TermIndex:
+    """Positional trigram index over a reference-counted vocabulary of words, with prefix completion."""
+
+    def __init__(self, terms=()):
+        self.counts = Counter(terms)
+        self.ids = {}
+        self.words = []
+        # Dense codes of the letters seen; 0 is the padding.
+        self.letters = {}
+        self.postings = {}
+        self._pending = {}
+        self._sorted = None
+        words = [term for term in self.counts if len(term) <= MAX_WORD_LENGTH]
+        capacity = max(len(words), 64)
+        self.lengths = np.zeros(capacity, dtype=np.intp)
+        self.codes = np.zeros((capacity, MAX_WORD_LENGTH), dtype=np.int32)
+        if words:
+            self._bulk_index(words)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, term):
+        return term in self.counts
+
+    def _bulk_index(self, words):
+        count = len(words)
+        self.words = list(words)
+        self.ids = {term: term_id for term_id, term in enumerate(words)}
+        self.lengths[:count] = np.fromiter(map(len, words), dtype=np.intp, count=count)
+        self.codes[:count] = np.array(words, dtype=f"U{MAX_WORD_LENGTH}").view(np.int32).reshape(count, MAX_WORD_LENGTH)
+        letters = np.unique(self.codes[:count])
+        letters = letters[letters != 0]
+        if len(letters) >= _LETTER_LIMIT:
+            for term in words:
+                self._index_pending(self.ids[term], term)
+            return
+        self.letters = {chr(code): dense for dense, code in enumerate(letters.tolist(), 1)}
+        padded = np.zeros((count, MAX_WORD_LENGTH + 4), dtype=np.int64)
+        padded[:, 2:MAX_WORD_LENGTH + 2] = np.searchsorted(letters, self.codes[:count]) + 1
+        padded[:, 2:MAX_WORD_LENGTH + 2][self.codes[:count] == 0] = 0
+        positions = np.arange(MAX_WORD_LENGTH + 2)
+        keys = _pack(padded[:, :-2], padded[:, 1:-1], padded[:, 2:], positions)
+        valid = positions < (self.lengths[:count, None] + 2)
+        keys = keys[valid]
+        ids = np.nonzero(valid)[0]
+        order = np.argsort(keys, kind='stable')
+        keys, ids = keys[order], ids[order]
+        starts = np.flatnonzero(np.diff(keys)) + 1
+        self.postings = dict(zip(keys[np.concatenate([[0], starts])].tolist(), np.split(ids, starts)))
+
+    def _keys(self, word, add=False):
+        """Return the keys of ``word``'s trigrams, or ``None`` if it has a letter never indexed."""
+        dense = [0, 0]
+        for char in word:
+            code = self.letters.get(char)
+            if code is None:
+                if not add or len(self.letters) + 1 >= _LETTER_LIMIT:
+                    return None
+                code = self.letters[char] = len(self.letters) + 1
+            dense.append(code)
+        dense += [0, 0]
+        return [
+            int(_pack(dense[i], dense[i + 1], dense[i + 2], i))
+            for i in range(len(dense) - 2)
+        ]
+
+    def _index_pending(self, term_id, term):
+        keys = self._keys(term, add=True)
+        for key in keys or ():
+            self._pending.setdefault(key, []).append(term_id)
+
+    def add(self, term):
+        if term in self.counts:
+            self.counts[term] += 1
+            return
+        self.counts[term] = 1
+        self._sorted = None
+        if len(term) > MAX_WORD_LENGTH:
+            return
+        term_id = self.ids[term] = len(self.words)
+        self.words.append(term)
+        if term_id == len(self.lengths):
+            self.lengths = np.concatenate([self.lengths, np.zeros_like(self.lengths)])
+            self.codes = np.concatenate([self.codes, np.zeros_like(self.codes)])
+        self.lengths[term_id] = len(term)
+        self.codes[term_id] = word_codes(term)
+        self._index_pending(term_id, term)
+
+    def remove(self, term):
+        count = self.counts.get(term)
+        if count is None:
+            return
+        if count > 1:
+            self.counts[term] = count - 1
+            return
+        del self.counts[term]
+        self._sorted = None
+        term_id = self.ids.pop(term, None)
+        if term_id is not None:
+            # The id stays in the posting lists; an impossible length hides it.
+            self.words[term_id] = None
+            self.lengths[term_id] = -2 * MAX_WORD_LENGTH
+
+    def _posting_array(self, key):
+        pending = self._pending.pop(key, None)
+        array = self.postings.get(key)
+        if pending:
+            array = self.postings[key] = np.concatenate([array, pending]) if array is not None else np.array(pending, dtype=np.intp)
+        return array
+
+    def similar(self, word, max_distance=None):
+        """Return ``(term, distance)`` for the other words within ``max_distance`` edits of ``word``, closest first.
+
+        ``max_distance`` defaults to ``allowed_distance(word)``.
+        """
+        if max_distance is None:
+            max_distance = allowed_distance(word)
+        if max_distance < 1 or len(word) > MAX_WORD_LENGTH:
+            return []
+        dense = [0, 0] + [self.letters.get(char, -1) for char in word] + [0, 0]
+        arrays = []
+        for position in range(len(dense) - 2):
+            gram = dense[position:position + 3]
+            if -1 in gram:
+                continue
+            for shift in range(max(position - max_distance, 0), position + max_distance + 1):
+                array = self._posting_array(int(_pack(*gram, shift)))
+                if array is not None:
+                    arrays.append(array)
+        if not arrays:
+            return []
+        shared = np.bincount(np.concatenate(arrays))
+        candidates = np.flatnonzero(shared >= max(len(word) + 2 - 4 * max_distance, 1))
+        candidates = candidates[np.abs(self.lengths[candidates] - len(word)) <= max_distance]
+        distances = edit_distances(word, self.codes[candidates], self.lengths[candidates], max_distance)
+        close = distances <= max_distance
+        found = sorted(zip(distances[close].tolist(), [self.words[i] for i in candidates[close].tolist()]))
+        return [(term, distance) for distance, term in found if term != word]
+
+    def complete(self, prefix, limit=MAX_COMPLETIONS):
+        """Return up to ``limit`` words starting with ``prefix``, in order."""
+        if self._sorted is None:
+            self._sorted = sorted(self.counts)
+        start = bisect.bisect_left(self._sorted, prefix)
+        matches = []
+        for term in self._sorted[start:start + limit]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return matches
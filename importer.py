@@ -0,0 +1,165 @@
+"""Chunked CSV import pipeline."""
+import os
+import time
+import uuid
+from datetime import datetime
+
+
+REQUIRED_COLUMNS = ['title', 'author']
+OPTIONAL_COLUMNS = ['year', 'genre', 'read', 'rating', 'notes', 'isbn', 'tags']
+CHUNK_SIZE = 10_000
+
+# Values of the "read" column that mean the book has been read.
+TRUE_VALUES = ['true', 'yes', 'y', '1', '1.0', 'read', 'x']
+
+
+class ImportReport:
+    """Progress and outcome of a CSV import."""
+
+    def __init__(self):
+        self.rows_read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.duplicates = 0
+        self.chunks_done = 0
+        # Index of the chunk to resume from after an interrupted import.
+        self.next_chunk = 0
+        # (row number, reason, row values) for rows that were not imported.
+        self.error_rows = []
+        self.failed_chunk = None
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def imported(self):
+        return self.inserted + self.updated
+
+    @property
+    def complete(self):
+        return self.error is None
+
+    @property
+    def rows_per_second(self):
+        return self.rows_read / self.elapsed if self.elapsed else 0.0
+
+    def error_frame(self):
+        """Return the rejected rows as a DataFrame, for download."""
+        import pandas as pd
+
+        return pd.DataFrame(
+            [dict(values, row=row, reason=reason) for row, reason, values in self.error_rows]
+        )
+
+
+def new_ids(count):
+    """Generate ``count`` random UUID4 strings from a single entropy read."""
+    entropy = os.urandom(16 * count)
+    return [str(uuid.UUID(bytes=entropy[i:i + 16], version=4)) for i in range(0, 16 * count, 16)]
+
+
+def _numeric(column, low=None, high=None):
+    import pandas as pd
+
+    values = pd.to_numeric(column, errors='coerce').fillna(0)
+    if low is not None or high is not None:
+        values = values.clip(low, high)
+    return values.astype(int)
+
+
+def _split_tags(column):
+    return [
+        [tag.strip() for tag in value.split(',') if tag.strip()]
+        for value in column.fillna('').astype(str)
+    ]
+
+
+def normalize_chunk(df, date_added):
+    """Turn one chunk of raw CSV rows into book dicts.
+
+    Returns ``(books, error_rows)``.  Rows are numbered from 1 after the
+    header, using the running index pandas assigns across chunks.
+    """
+    import pandas as pd
+
+    df = df.copy()
+    df.columns = [str(column).strip().lower() for column in df.columns]
+    for column in OPTIONAL_COLUMNS:
+        if column not in df.columns:
+            df[column] = None
+
+    title = df['title'].fillna('').astype(str).str.strip()
+    author = df['author'].fillna('').astype(str).str.strip()
+    valid = (title != '') & (author != '')
+    error_rows = [
+        (int(index) + 1, "missing title or author", row)
+        for index, row in df[~valid].fillna('').to_dict('index').items()
+    ]
+    df = df[valid]
+    if df.empty:
+        return [], error_rows
+
+    books = pd.DataFrame({
+        'id': new_ids(len(df)),
+        'title': title[valid],
+        'author': author[valid],
+        'year': _numeric(df['year']),
+        'genre': df['genre'].fillna('').astype(str),
+        'read': df['read'].fillna('').astype(str).str.strip().str.lower().isin(TRUE_VALUES),
+        'rating': _numeric(df['rating'], 0, 5),
+        'notes': df['notes'].fillna('').astype(str),
+        'isbn': df['isbn'].fillna('').astype(str).str.strip(),
+        'tags': _split_tags(df['tags']),
+        'date_added': date_added,
+    }, index=df.index)
+    # to_dict boxes numpy scalars into plain Python values, so books serialize as JSON.
+    return books.to_dict('records'), error_rows
+
+
+def read_header(source):
+    """Return the normalized column names of a CSV source and rewind it."""
+    import pandas as pd
+
+    columns = pd.read_csv(source, nrows=0).columns
+    source.seek(0)
+    return [str(column).strip().lower() for column in columns]
+
+
+def import_csv(source, repo, on_duplicate='skip', chunksize=CHUNK_SIZE, start_chunk=0, report=None, progress=None):
+    """Import books from a CSV file-like ``source`` into ``repo`` chunk by chunk.
+
+    ``on_duplicate`` is passed to ``repo.import_books``.  ``progress`` is called with the report after every chunk.  A failure while
+    writing a chunk stops the import; calling again with
+    ``start_chunk=report.next_chunk`` and the same ``report`` resumes it.
+    """
+    import pandas as pd
+
+    report = report or ImportReport()
+    started = time.perf_counter()
+    date_added = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    reader = pd.read_csv(source, chunksize=chunksize, dtype=str, skipinitialspace=True)
+    for chunk_index, chunk in enumerate(reader):
+        if chunk_index < start_chunk:
+            continue
+        books, error_rows = normalize_chunk(chunk, date_added)
+        try:
+            counts = repo.import_books(books, on_duplicate=on_duplicate) if books else {}
+        except Exception as e:
+            report.failed_chunk = chunk_index
+            report.error = str(e)
+            break
+        report.rows_read += len(chunk)
+        report.inserted += counts.get('inserted', 0)
+        report.updated += counts.get('updated', 0)
+        report.duplicates += counts.get('duplicates', 0)
+        report.error_rows.extend(error_rows)
+        report.chunks_done += 1
+        report.next_chunk = chunk_index + 1
+        report.elapsed += time.perf_counter() - started
+        started = time.perf_counter()
+        if progress is not None:
+            progress(report)
+    else:
+        report.failed_chunk = None
+        report.error = None
+    report.elapsed += time.perf_counter() - started
+    return report
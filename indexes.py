@@ -0,0 +1,167 @@
+"""In-memory indexes maintained alongside the JSON library."""
+import re
+
+
+class MembershipIndex:
+    """Reverse index from book id to the named lists (collections) that contain it."""
+
+    def __init__(self, lists=None):
+        self.owners = {}
+        for name, book_ids in (lists or {}).items():
+            self.add(name, book_ids)
+
+    def add(self, name, book_ids):
+        for book_id in book_ids:
+            counts = self.owners.setdefault(book_id, {})
+            counts[name] = counts.get(name, 0) + 1
+
+    def remove(self, name, book_ids):
+        for book_id in book_ids:
+            counts = self.owners.get(book_id)
+            if counts is None or name not in counts:
+                continue
+            counts[name] -= 1
+            if counts[name] <= 0:
+                del counts[name]
+            if not counts:
+                del self.owners[book_id]
+
+    def owners_of(self, book_id):
+        """Return the names of the lists containing ``book_id``."""
+        return list(self.owners.get(book_id, ()))
+
+    def __contains__(self, book_id):
+        return book_id in self.owners
+
+
+class OrderedIdSet:
+    """Book ids in order and without repeats, as collections and the reading list hold them.
+
+    Callers serialize changes and ``ids()`` calls.
+    """
+
+    def __init__(self, book_ids=()):
+        self._ids = dict.fromkeys(book_ids)
+        self._list = None
+
+    def __contains__(self, book_id):
+        return book_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def ids(self):
+        if self._list is None:
+            self._list = list(self._ids)
+        return self._list
+
+    def _reorder(self, book_ids):
+        self._ids = dict.fromkeys(book_ids)
+        self._list = None
+
+    def add(self, book_ids, position=None):
+        """Insert the ids not yet present at ``position`` (the end for ``None``); returns them."""
+        added = [book_id for book_id in dict.fromkeys(book_ids) if book_id not in self._ids]
+        if not added:
+            return added
+        if position is None or position >= len(self._ids):
+            self._ids.update(dict.fromkeys(added))
+            self._list = None
+        else:
+            order = self.ids()
+            position = max(position, 0)
+            self._reorder(order[:position] + added + order[position:])
+        return added
+
+    def remove(self, book_ids):
+        """Remove the given ids that are present; returns them."""
+        removed = [book_id for book_id in dict.fromkeys(book_ids) if book_id in self._ids]
+        for book_id in removed:
+            del self._ids[book_id]
+        if removed:
+            self._list = None
+        return removed
+
+    def move(self, book_ids, position):
+        """Move the given ids that are present to ``position`` among the others, in the given order; returns them."""
+        moved = [book_id for book_id in dict.fromkeys(book_ids) if book_id in self._ids]
+        if moved:
+            moving = set(moved)
+            rest = [book_id for book_id in self.ids() if book_id not in moving]
+            position = min(max(position, 0), len(rest))
+            self._reorder(rest[:position] + moved + rest[position:])
+        return moved
+
+
+_NON_ISBN_RE = re.compile(r"[^0-9X]+")
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+
+def normalize_isbn(isbn):
+    """Reduce an ISBN to its digits (and a trailing check character X)."""
+    if isbn is None:
+        return ''
+    return _NON_ISBN_RE.sub('', str(isbn).upper())
+
+
+def normalize_text(text):
+    """Lowercase text and reduce it to space-separated alphanumeric words."""
+    if text is None:
+        return ''
+    return _NON_WORD_RE.sub(' ', str(text).lower()).strip()
+
+
+def dedup_keys(book):
+    """Return the duplicate-detection keys of a book, strongest first."""
+    keys = []
+    isbn = normalize_isbn(book.get('isbn'))
+    if isbn:
+        keys.append('isbn:' + isbn)
+    title, author = normalize_text(book.get('title')), normalize_text(book.get('author'))
+    if title and author:
+        keys.append(f'ta:{title}|{author}')
+    return keys
+
+
+class DedupIndex:
+    """Hash index from ISBN and normalized (title, author) keys to book ids.
+
+    A key maps to the id of the one book that has it or, once several books
+    share it, to a dict of their ids in insertion order.  Removing one of
+    them keeps the key for the others.
+    """
+
+    def __init__(self, books=()):
+        self.keys = {}
+        for book in books:
+            self.add(book)
+
+    def add(self, book):
+        book_id = book['id']
+        for key in dedup_keys(book):
+            book_ids = self.keys.get(key)
+            if book_ids is None:
+                self.keys[key] = book_id
+            elif isinstance(book_ids, dict):
+                book_ids[book_id] = None
+            elif book_ids != book_id:
+                self.keys[key] = {book_ids: None, book_id: None}
+
+    def remove(self, book):
+        book_id = book['id']
+        for key in dedup_keys(book):
+            book_ids = self.keys.get(key)
+            if book_ids == book_id:
+                del self.keys[key]
+            elif isinstance(book_ids, dict) and book_ids.pop(book_id, 0) is None and len(book_ids) == 1:
+                self.keys[key] = next(iter(book_ids))
+
+    def find(self, book):
+        """Return the id of a stored book that duplicates ``book``, or ``None``; the earliest added wins."""
+        for key in dedup_keys(book):
+            book_ids = self.keys.get(key)
+            if isinstance(book_ids, dict):
+                return next(iter(book_ids))
+            if book_ids is not None:
+                return book_ids
+        return None
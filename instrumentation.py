@@ -0,0 +1,164 @@
+"""Per-rerun timing, I/O counters and opt-in profiling."""
+import contextlib
+import contextvars
+import io
+import json
+import logging
+import pstats
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+try:
+    import cProfile
+except ImportError:  # Some minimal builds ship without it.
+    cProfile = None
+
+PROFILE_MODES = ['cprofile', 'tracemalloc']
+# Lines of profile output kept in the report.
+PROFILE_LIMIT = 25
+
+logger = logging.getLogger("library.metrics")
+
+_current = contextvars.ContextVar('rerun_metrics', default=None)
+
+
+class RerunMetrics:
+    """Phase timings and counters for one rerun."""
+
+    def __init__(self, label=None):
+        self.label = label
+        self.started = time.perf_counter()
+        self.created = datetime.now()
+        # Phase path ("Statistics/figures") -> [seconds, calls], in first-entered order.
+        self.phases = {}
+        self.counters = Counter()
+        self._stack = []
+
+    def begin(self, name):
+        path = "/".join([entry[0] for entry in self._stack] + [name])
+        self.phases.setdefault(path, [0.0, 0])
+        self._stack.append((name, path, time.perf_counter()))
+
+    def end(self):
+        name, path, started = self._stack.pop()
+        totals = self.phases[path]
+        totals[0] += time.perf_counter() - started
+        totals[1] += 1
+
+    def add(self, name, amount=1):
+        self.counters[name] += amount
+
+    def close(self):
+        """End every phase still open, innermost first."""
+        while self._stack:
+            self.end()
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'created': self.created.isoformat(timespec='seconds'),
+            'seconds': time.perf_counter() - self.started,
+            'phases': [{'phase': path, 'seconds': seconds, 'calls': calls} for path, (seconds, calls) in self.phases.items()],
+            'counters': dict(self.counters),
+        }
+
+
+def start_rerun(label=None):
+    """Start collecting metrics for the rerun running in this thread."""
+    metrics = RerunMetrics(label)
+    _current.set(metrics)
+    return metrics
+
+
+def current():
+    """Return the metrics of the rerun in progress, or ``None``."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the enclosed block as phase ``name`` of the current rerun."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    metrics.begin(name)
+    try:
+        yield
+    finally:
+        metrics.end()
+
+
+def add_counter(name, amount=1):
+    """Add ``amount`` to counter ``name`` of the current rerun, if any."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(name, amount)
+
+
+class Profiler:
+    """Capture a cProfile or tracemalloc report around a block of work."""
+
+    def __init__(self, mode):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode!r}")
+        self.mode = mode
+        self._profile = None
+        self._snapshot = None
+        self._started_tracing = False
+        self.error = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            if cProfile is None:
+                self.error = "cProfile is not available"
+                return
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+            except ValueError as e:  # Another profiler is active in this process.
+                self._profile = None
+                self.error = str(e)
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            self._snapshot = tracemalloc.take_snapshot()
+
+    def stop(self):
+        """Stop capturing and return the report as text."""
+        if self.error is not None:
+            return f"Profiling unavailable: {self.error}"
+        if self.mode == 'cprofile':
+            self._profile.disable()
+            out = io.StringIO()
+            pstats.Stats(self._profile, stream=out).sort_stats('cumulative').print_stats(PROFILE_LIMIT)
+            return out.getvalue()
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            traced, peak = tracemalloc.get_traced_memory()
+        finally:
+            if self._started_tracing:
+                tracemalloc.stop()
+        lines = [f"Traced memory: {traced / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB"]
+        for stat in snapshot.compare_to(self._snapshot, 'lineno')[:PROFILE_LIMIT]:
+            lines.append(str(stat))
+        return "\n".join(lines)
+
+
+def finish_rerun(metrics, profiler=None, metrics_path=None):
+    """Close any open phases, stop ``profiler`` and log the rerun; returns its report dict."""
+    _current.set(None)
+    metrics.close()
+    report = metrics.to_dict()
+    if profiler is not None:
+        report['profile'] = {'mode': profiler.mode, 'report': profiler.stop()}
+    line = json.dumps(report)
+    logger.info(line)
+    if metrics_path:
+        with open(metrics_path, 'a') as f:
+            f.write(line + "\n")
+    return report
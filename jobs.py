@@ -0,0 +1,326 @@
+"""Background jobs for long-running library operations."""
+import contextlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from exporter import export_name, write_export
+from importer import CHUNK_SIZE, REQUIRED_COLUMNS, import_csv, read_header
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+JOB_WORKERS = 4
+# Finished jobs kept for status polling; older ones are forgotten.
+JOB_HISTORY = 50
+
+logger = logging.getLogger("library.jobs")
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's work once the job has been cancelled."""
+
+
+class Job:
+    """Status, progress and outcome of one background job."""
+
+    def __init__(self, kind, label, owner=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.label = label
+        # Who the job belongs to, e.g. the library it works on.
+        self.owner = owner
+        self.status = QUEUED
+        self.fraction = 0.0
+        self.message = "Waiting to start..."
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._cancel_requested = False
+        self._committing = False
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started
+
+    def progress(self, fraction=None, message=None):
+        """Record progress; raises ``JobCancelled`` if the job has been cancelled."""
+        with self._lock:
+            if fraction is not None:
+                self.fraction = min(max(fraction, 0.0), 1.0)
+            if message is not None:
+                self.message = message
+            cancelled = self._cancel_requested and not self._committing
+        if cancelled:
+            raise JobCancelled()
+
+    def cancel(self):
+        """Ask the job to stop; returns False if it has finished or is writing its result."""
+        with self._lock:
+            if self.finished or self._committing:
+                return False
+            self._cancel_requested = True
+            if self.status == QUEUED:
+                self.status = CANCELLED
+                self.finished_at = time.time()
+            return True
+
+    @contextlib.contextmanager
+    def commit(self):
+        """Mark the block that writes the job's result; from here on it cannot be cancelled."""
+        with self._lock:
+            if self._cancel_requested:
+                raise JobCancelled()
+            self._committing = True
+            self.message = "Saving..."
+        yield
+
+    def _start(self):
+        with self._lock:
+            if self.status != QUEUED:
+                return False
+            self.status = RUNNING
+            self.started = time.time()
+            self.message = "Running..."
+            return True
+
+    def discard(self):
+        """Delete the file the job offers for download; called once the job is forgotten."""
+        download = (self.result or {}).get('download')
+        if download is not None:
+            with contextlib.suppress(OSError):
+                os.remove(download[1])
+
+    def _finish(self, status, result=None, error=None):
+        with self._lock:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+            if status == DONE:
+                self.fraction = 1.0
+
+
+class JobQueue:
+    """A thread pool running ``Job``s, with the recent jobs kept for polling."""
+
+    def __init__(self, workers=JOB_WORKERS, history=JOB_HISTORY):
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="library-job")
+        self._jobs = OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, label, run, owner=None, lock=None):
+        """Queue ``run(job)`` and return the ``Job``; its result is what ``run`` returns."""
+        job = Job(kind, label, owner)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+            key_lock = None if lock is None else self._keys.setdefault(lock, threading.Lock())
+        self._executor.submit(self._run, job, run, key_lock)
+        return job
+
+    def _run(self, job, run, key_lock):
+        with key_lock or contextlib.nullcontext():
+            if not job._start():
+                return
+            try:
+                result = run(job)
+            except JobCancelled:
+                job._finish(CANCELLED)
+            except Exception as e:
+                logger.exception("Job %s (%s) failed", job.id, job.kind)
+                job._finish(FAILED, error=str(e))
+            else:
+                job._finish(DONE, result=result)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(self._jobs) - self.history, 0)]:
+            self._jobs.pop(job_id).discard()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self, owner=None):
+        """Return the jobs of ``owner`` (every job when ``None``), newest first."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job for job in reversed(jobs) if owner is None or job.owner == owner]
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        return job is not None and job.cancel()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        if wait:
+            for job in self.list():
+                job.discard()
+
+
+# Library jobs.  Each builder returns the ``run(job)`` function to submit; its
+# result is a dict with a ``message`` and, optionally, a ``warning`` and a
+# ``download`` of ``(label, path, file_name, mime)``.  The download is a temp
+# file, deleted when the job is forgotten, so the finished jobs kept for
+# polling hold no file contents.
+
+def spool_download(write):
+    """Call ``write(f)`` on a new binary temp file and return its path; the file is removed if ``write`` fails."""
+    fd, path = tempfile.mkstemp(prefix="library-download-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def import_csv_job(repo, data, on_duplicate='skip', chunksize=CHUNK_SIZE):
+    """Import the CSV bytes ``data`` into ``repo``, one chunk per write; a failed or cancelled import keeps the chunks before it."""
+    def run(job):
+        source = io.BytesIO(data)
+        columns = read_header(source)
+        if any(column not in columns for column in REQUIRED_COLUMNS):
+            raise ValueError(f"CSV must contain columns: {', '.join(REQUIRED_COLUMNS)}")
+
+        def show_progress(report):
+            job.progress(source.tell() / max(len(data), 1), f"{report.imported:,} books saved from {report.rows_read:,} rows")
+
+        report = import_csv(source, repo, on_duplicate=on_duplicate, chunksize=chunksize, progress=show_progress)
+        if report.error is not None:
+            raise ValueError(
+                f"Import stopped at chunk {report.failed_chunk + 1} ({report.error}); "
+                f"{report.imported:,} books from the chunks before it were saved"
+            )
+        result = {
+            'message': (
+                f"Added {report.inserted} books, updated {report.updated}, "
+                f"skipped {report.duplicates} duplicates ({report.rows_per_second:,.0f} rows/s)."
+            ),
+            'report': report,
+        }
+        if report.error_rows:
+            result['warning'] = f"{len(report.error_rows)} rows were skipped."
+            path = spool_download(lambda f: report.error_frame().to_csv(f, index=False))
+            result['download'] = ("Download Skipped Rows", path, "import_errors.csv", "text/csv")
+        return result
+
+    return run
+
+
+def backup_job(store, repo, download=False):
+    """Record a backup point of ``repo`` in the ``BackupStore`` ``store``; with ``download``, also offer a JSON export."""
+    def run(job):
+        share = 0.8 if download else 1.0
+        point = store.create(repo, progress=lambda fraction: job.progress(share * fraction, "Writing backup point..."))
+        result = {
+            'message': (
+                f"Backup point {point['created']} saved: {point['books']} books, "
+                f"{point['new_objects']} changed chunks ({point['bytes_written'] / 1024:.1f} KB written)."
+            ),
+            'point': point,
+        }
+        if download:
+            job.progress(0.8, "Exporting...")
+            path = spool_download(lambda f: write_export(repo, 'json', f))
+            result['download'] = ("Download Backup", path) + export_name('json')
+        return result
+
+    return run
+
+
+def prune_job(store, keep):
+    """Keep the newest ``keep`` backup points of ``store`` and delete the objects only older points used."""
+    def run(job):
+        points = len(store.list())
+        with job.commit():
+            removed = store.prune(keep)
+        return {'message': f"Removed {max(points - keep, 0)} backup points and {removed} unused chunks."}
+
+    return run
+
+
+def restore_point_job(store, repo, backup_id):
+    """Replace the contents of ``repo`` with a backup point of ``store``."""
+    def run(job):
+        # The books stream from the backup into ``replace``, which stores them all or none.
+        with job.commit():
+            store.restore(backup_id, repo, progress=lambda fraction: job.progress(fraction, "Restoring backup point..."))
+        return {'message': "Library restored!"}
+
+    return run
+
+
+def merge_library(repo, data):
+    """Merge the books, collections and reading list of ``data`` into ``repo``; returns the import counts."""
+    result = repo.import_books(data.get('books', []), on_duplicate='merge')
+    # Point restored collections and reading list at the books they were merged into.
+    ids = result['ids']
+    for name, book_ids in data.get('collections', {}).items():
+        repo.add_to_collection(name, [ids[i] for i in book_ids if i in ids])
+    repo.add_to_reading_list([ids[i] for i in data.get('reading_list', []) if i in ids])
+    return result
+
+
+def restore_file_job(repo, data, merge=False):
+    """Restore ``repo`` from the JSON backup bytes ``data``, or merge the backup into it."""
+    def run(job):
+        job.progress(0.1, "Reading backup file...")
+        library = json.loads(data)
+        if isinstance(library, list):
+            library = {'books': library, 'collections': {}, 'reading_list': []}
+        elif not isinstance(library, dict):
+            raise ValueError("Invalid backup format")
+        job.progress(0.5, "Restoring...")
+        if not merge:
+            with job.commit():
+                repo.replace(library)
+            return {'message': "Library restored!"}
+        with job.commit(), repo.batch():
+            result = merge_library(repo, library)
+        return {
+            'message': f"Added {result['inserted']} books, merged {result['updated']}, skipped {result['duplicates']} duplicates."
+        }
+
+    return run
+
+
+def export_job(repo, fmt, compress=False):
+    """Export ``repo`` in ``fmt`` and offer the file for download."""
+    def run(job):
+        total = max(repo.count_books(), 1)
+        path = spool_download(lambda f: write_export(
+            repo, fmt, f, compress=compress,
+            progress=lambda count: job.progress(count / total, f"{count:,} books exported")
+        ))
+        file_name, mime = export_name(fmt, compress)
+        return {
+            'message': f"Export ready: {file_name} ({os.path.getsize(path) / 1024:.1f} KB).",
+            'download': (f"Download {file_name}", path, file_name, mime),
+        }
+
+    return run
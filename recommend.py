@@ -0,0 +1,265 @@
+"""Recommendations of unread books from the books rated highly."""
+import math
+
+import numpy as np
+
+from indexes import normalize_text
+
+# Read books rated at least this shape the recommendations.
+LIKED_RATING = 4
+# Weight of each field's tokens; tags are a list, the others single values.
+FEATURE_WEIGHTS = {'genre': 1.0, 'author': 1.5, 'tags': 1.0}
+# Share of the library that may change before the frequencies are recomputed.
+REFRESH_FRACTION = 0.1
+
+
+def book_tokens(book, cache=None):
+    """Return ``{token: weight}`` for a book's genre, author and tags.
+
+    ``cache`` maps ``(field, value)`` to its token across calls, so a library
+    normalizes each distinct genre, author and tag once.
+    """
+    tokens = {}
+    for field, weight in FEATURE_WEIGHTS.items():
+        values = book.get(field)
+        for value in values if isinstance(values, list) else [values]:
+            key = (field, value) if isinstance(value, str) else None
+            token = None if cache is None or key is None else cache.get(key)
+            if token is None:
+                text = normalize_text(value)
+                token = f"{field}:{text}" if text else ''
+                if cache is not None and key is not None:
+                    cache[key] = token
+            if token:
+                tokens[token] = weight
+    return tokens
+
+
+def liked_weight(book):
+    """Return how much a book counts towards the profile: 0 unless it is read and rated ``LIKED_RATING`` or more."""
+    rating = book.get('rating')
+    if not book.get('read') or isinstance(rating, bool) or not isinstance(rating, (int, float)) or rating < LIKED_RATING:
+        return 0.0
+    return float(rating - LIKED_RATING + 1)
+
+
+def _grow(array, size):
+    """Return ``array``, or a copy with room for at least ``size`` items, zero filled."""
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class FeatureIndex:
+    """Sparse token rows of a set of books, with a taste profile and cached scores.
+
+    Rows are reused after removals.  Callers serialize every call.
+    """
+
+    def __init__(self, books=()):
+        self.codes = {}
+        self.ids = []
+        self.rows = {}
+        self.free = []
+        self.changed = 0
+        # Per token: live document frequency and the frozen inverse frequency.
+        self.df = np.zeros(64)
+        self.idf = np.zeros(64)
+        self._profile = None
+        self._liked_entries = None
+        self._scores = None
+        self._norm = 0.0
+        self._bulk_append(books)
+        self.refresh()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, book_id):
+        return book_id in self.rows
+
+    def _code(self, token):
+        code = self.codes.get(token)
+        if code is None:
+            code = self.codes[token] = len(self.codes)
+            self.df = _grow(self.df, code + 1)
+            self.idf = _grow(self.idf, code + 1)
+            # A new token gets the frequency it would have had at the last refresh.
+            self.idf[code] = math.log((1 + len(self.rows)) / 2) + 1
+            if self._profile is not None:
+                self._profile = _grow(self._profile, code + 1)
+        return code
+
+    def _bulk_append(self, books):
+        """Give every book a row and its entries at once, without values."""
+        ids, read, liked, rows, codes, weights = [], [], [], [], [], []
+        code, cache = self._code, {}
+        for book in books:
+            row = len(ids)
+            ids.append(book['id'])
+            read.append(bool(book.get('read')))
+            liked.append(liked_weight(book))
+            for token, weight in book_tokens(book, cache).items():
+                rows.append(row)
+                codes.append(code(token))
+                weights.append(weight)
+        self.ids, self.rows = ids, {book_id: row for row, book_id in enumerate(ids)}
+        # Per row: read state, liked weight and the span of its entries.
+        self.read, self.liked = np.array(read + [False], dtype=bool), np.array(liked + [0.0])
+        self.starts, self.stops = np.zeros(len(ids) + 1, dtype=np.intp), np.zeros(len(ids) + 1, dtype=np.intp)
+        # Per entry: row, token code, field weight and scaled value.
+        self.size = len(rows)
+        self.entry_rows = np.array(rows + [0], dtype=np.intp)
+        self.entry_codes = np.array(codes + [0], dtype=np.intp)
+        self.entry_weights = np.array(weights + [0.0])
+        self.values = np.zeros(len(rows) + 1)
+
+    def _append(self, book):
+        """Give ``book`` a row and append its entries, without values."""
+        if self.free:
+            row = self.free.pop()
+            self.ids[row] = book['id']
+        else:
+            row = len(self.ids)
+            self.ids.append(book['id'])
+            for name in ('read', 'liked', 'starts', 'stops'):
+                setattr(self, name, _grow(getattr(self, name), row + 1))
+        self.rows[book['id']] = row
+        self.read[row] = bool(book.get('read'))
+        self.liked[row] = liked_weight(book)
+        tokens = book_tokens(book)
+        start, stop = self.size, self.size + len(tokens)
+        for name in ('entry_rows', 'entry_codes', 'entry_weights', 'values'):
+            setattr(self, name, _grow(getattr(self, name), stop))
+        self.entry_rows[start:stop] = row
+        self.entry_codes[start:stop] = [self._code(token) for token in tokens]
+        self.entry_weights[start:stop] = list(tokens.values())
+        self.values[start:stop] = 0.0
+        self.starts[row], self.stops[row] = start, stop
+        self.size = stop
+        return row
+
+    def refresh(self):
+        """Recompute the frequencies and values of every row, dropping the entries of removed books."""
+        keep = np.flatnonzero(self.entry_weights[:self.size] > 0)
+        keep = keep[np.argsort(self.entry_rows[keep], kind='stable')]
+        rows, codes, weights = self.entry_rows[keep], self.entry_codes[keep], self.entry_weights[keep]
+        self.size = len(keep)
+        self.entry_rows[:self.size], self.entry_codes[:self.size], self.entry_weights[:self.size] = rows, codes, weights
+        self.entry_weights[self.size:] = 0.0
+        self.starts[:len(self.ids)] = np.searchsorted(rows, np.arange(len(self.ids)), 'left')
+        self.stops[:len(self.ids)] = np.searchsorted(rows, np.arange(len(self.ids)), 'right')
+        self.df[:] = 0.0
+        self.df[:len(self.codes)] = np.bincount(codes, minlength=len(self.codes))
+        self.idf[:len(self.codes)] = np.log((1 + len(self.rows)) / (1 + self.df[:len(self.codes)])) + 1
+        values = weights * self.idf[codes]
+        norms = np.sqrt(np.bincount(rows, weights=values * values, minlength=len(self.ids)))
+        self.values[:self.size] = values / norms[rows] if self.size else values
+        self.changed = 0
+        self._profile = self._liked_entries = self._scores = None
+
+    def add(self, book):
+        """Add or replace a book's row."""
+        self.remove(book['id'])
+        row = self._append(book)
+        start, stop = self.starts[row], self.stops[row]
+        codes = self.entry_codes[start:stop]
+        self.df[codes] += 1
+        values = self.entry_weights[start:stop] * self.idf[codes]
+        norm = math.sqrt(float(values @ values)) if len(values) else 1.0
+        self.values[start:stop] = values / norm
+        self._changed(row, 1)
+
+    def remove(self, book_id):
+        row = self.rows.pop(book_id, None)
+        if row is None:
+            return
+        start, stop = self.starts[row], self.stops[row]
+        self.df[self.entry_codes[start:stop]] -= 1
+        self._changed(row, -1)
+        self.entry_weights[start:stop] = 0.0
+        self.values[start:stop] = 0.0
+        self.ids[row] = None
+        self.read[row] = False
+        self.liked[row] = 0.0
+        self.free.append(row)
+
+    def _changed(self, row, sign):
+        """Adjust the profile and the cached scores for a row added (``sign`` 1) or about to be removed (-1)."""
+        self.changed += 1
+        start, stop = self.starts[row], self.stops[row]
+        codes, values = self.entry_codes[start:stop], self.values[start:stop]
+        if self.liked[row]:
+            if self._profile is not None:
+                np.add.at(self._profile, codes, sign * self.liked[row] * values)
+            self._liked_entries = self._scores = None
+        elif self._scores is not None:
+            self._scores = _grow(self._scores, row + 1)
+            self._scores[row] = float(values @ self._profile[codes]) / self._norm if sign > 0 and self._norm else 0.0
+
+    def profile(self):
+        """Return the weighted sum of the liked rows, one value per token."""
+        if self._profile is None:
+            liked = self.liked_entries()
+            self._profile = np.bincount(
+                self.entry_codes[liked], weights=self.values[liked] * self.liked[self.entry_rows[liked]],
+                minlength=len(self.df)
+            ).astype(float)
+        return self._profile
+
+    def liked_entries(self):
+        """Return the indexes of the live entries of liked rows."""
+        if self._liked_entries is None:
+            entries = np.arange(self.size)
+            self._liked_entries = entries[(self.liked[self.entry_rows[:self.size]] > 0) & (self.values[:self.size] > 0)]
+        return self._liked_entries
+
+    def scores(self):
+        """Return every row's cosine similarity to the profile; 0 for rows with no book."""
+        if self._scores is None:
+            profile = self.profile()
+            self._norm = float(np.sqrt(profile @ profile))
+            if self._norm:
+                size = self.size
+                self._scores = np.bincount(
+                    self.entry_rows[:size], weights=self.values[:size] * profile[self.entry_codes[:size]],
+                    minlength=len(self.ids)
+                ) / self._norm
+            else:
+                self._scores = np.zeros(len(self.ids))
+        return self._scores
+
+    def because(self, row):
+        """Return the id of the liked book whose row is closest to ``row``, or ``None``."""
+        liked = self.liked_entries()
+        start, stop = self.starts[row], self.stops[row]
+        vector = np.zeros(len(self.df))
+        vector[self.entry_codes[start:stop]] = self.values[start:stop]
+        shared = np.bincount(self.entry_rows[liked], weights=self.values[liked] * vector[self.entry_codes[liked]], minlength=len(self.ids))
+        best = int(np.argmax(shared)) if len(shared) else 0
+        return self.ids[best] if len(shared) and shared[best] > 0 else None
+
+    def recommend(self, limit, exclude=()):
+        """Return ``(book_id, score, liked_id)`` for the ``limit`` unread books most like the liked ones, best first.
+
+        Books in ``exclude`` and books sharing no token with a liked book are
+        left out; ``liked_id`` is the liked book closest to each.
+        """
+        if limit <= 0:
+            return []
+        if self.changed > REFRESH_FRACTION * max(len(self.rows), 1):
+            self.refresh()
+        scores = self.scores()
+        candidates = (scores[:len(self.ids)] > 0) & ~self.read[:len(self.ids)]
+        for book_id in exclude:
+            row = self.rows.get(book_id)
+            if row is not None:
+                candidates[row] = False
+        rows = np.flatnonzero(candidates)
+        if len(rows) > limit:
+            rows = rows[np.argpartition(-scores[rows], limit - 1)[:limit]]
+        # Best first; equal scores in row order.
+        rows = rows[np.lexsort((rows, -scores[rows]))]
+        return [(self.ids[row], float(scores[row]), self.because(row)) for row in rows.tolist()]
@@ -0,0 +1,1749 @@
+"""Library repositories: a common interface over the JSON and SQLite backends."""
+import contextlib
+import functools
+import json
+import pathlib
+import queue
+import sqlite3
+import threading
+from collections.abc import Mapping
+from itertools import islice
+
+from booktable import BookTable
+from facets import FACETS, FacetIndex, normalize_filters, order_counts
+from indexes import DedupIndex, MembershipIndex, OrderedIdSet, dedup_keys
+from fuzzy import TermIndex
+from recommend import FeatureIndex
+from search_index import FIELD_WEIGHTS, FIELDS as SEARCH_FIELDS, FUZZY_FIELDS, SearchIndex, field_text, format_query, parse_query, tokenize
+from stats import LibraryStats
+from storage import empty_library, require_valid_books
+
+# Fields stored in dedicated columns by the SQLite backend, in column order.
+BOOK_FIELDS = ['id', 'title', 'author', 'year', 'genre', 'read', 'rating', 'notes', 'isbn', 'tags', 'date_added']
+
+# How ``import_books`` treats an incoming book that duplicates a stored one:
+# leave the stored book alone, overwrite its fields, or only fill its empty fields.
+DUPLICATE_MODES = ['skip', 'update', 'merge']
+
+# Sort keys accepted by ``query_books`` and ``filter_books``.
+SORT_FIELDS = ['title', 'author', 'year', 'genre', 'date_added']
+
+# Layout of the state pickled into a JSON library's binary snapshot; bump it
+# whenever the table or index classes change shape, so old snapshots are ignored.
+BINARY_FORMAT = 3
+
+# Books written per transaction when ``SqliteRepository.replace`` streams a library in.
+REPLACE_BATCH = 5000
+
+# Read-only connections a ``SqliteRepository`` keeps for reads on threads that are not writing.
+READ_CONNECTIONS = 4
+
+
+class LibraryRepository:
+    """Interface shared by all library backends."""
+
+    # Reads
+
+    def count_books(self, read=None):
+        """Count books, optionally only read (``True``) or unread (``False``) ones."""
+        raise NotImplementedError
+
+    def count_distinct(self, field):
+        """Count distinct non-empty values of ``field``, ignoring case."""
+        raise NotImplementedError
+
+    def distinct_keys(self, field):
+        """Return the distinct non-empty values of ``field`` (genre or author), lowercased."""
+        raise NotImplementedError
+
+    def genre_counts(self):
+        """Return ``(genre, count)`` pairs, most common first."""
+        raise NotImplementedError
+
+    def get_books(self, book_ids):
+        """Return the books for ``book_ids`` in the same order, skipping unknown ids."""
+        raise NotImplementedError
+
+    def get_book(self, book_id):
+        books = self.get_books([book_id])
+        return books[0] if books else None
+
+    def book_collections(self, book_id):
+        """Return the names of the collections containing ``book_id``."""
+        raise NotImplementedError
+
+    def in_reading_list(self, book_id):
+        raise NotImplementedError
+
+    def query_books(self, read=None, sort_by='title', descending=False, limit=None, offset=0):
+        """Return books filtered by read state and sorted by ``sort_by``."""
+        raise NotImplementedError
+
+    def filter_books(self, filters=None, sort_by='title', descending=False, limit=None, offset=0, after=None):
+        """Return ``(total, books)``: how many books match every facet of ``filters``, and one sorted page of them.
+
+        Books with equal ``sort_by`` values are ordered by id.  ``after`` is
+        the ``(value, id)`` of the last book of the previous page; the page
+        then starts with the book that follows it, even if that book was
+        deleted since.  See ``facets`` for the filter format.
+        """
+        raise NotImplementedError
+
+    def facet_counts(self, filters=None):
+        """Return ``{facet: [(value, count), ...]}`` for the books matching ``filters``.
+
+        Each facet is counted without its own filter; see ``facets``.
+        """
+        raise NotImplementedError
+
+    def recent_books(self, limit):
+        """Return the ``limit`` most recently added books."""
+        return self.query_books(sort_by='date_added', descending=True, limit=limit)
+
+    def search_books(self, query, limit=None, offset=0):
+        """Return books matching a full-text ``query``, best match first.
+
+        See ``search_index`` for the query syntax.
+        """
+        raise NotImplementedError
+
+    def search_hits(self, query, limit=None):
+        """Return ``(book, score)`` pairs for ``query``, best first; a higher score is a better match."""
+        raise NotImplementedError
+
+    def has_term(self, field, term, prefix=False):
+        """True when searchable ``field`` (any field when ``None``) holds the word ``term``.
+
+        With ``prefix``, a word starting with ``term`` is enough.
+        """
+        raise NotImplementedError
+
+    def similar_terms(self, word, limit=None):
+        """Return ``(term, distance, books)`` for the title and author words a few typos from ``word``.
+
+        Closest first, then those in the most books; see ``fuzzy``.
+        """
+        raise NotImplementedError
+
+    def complete_terms(self, prefix, limit=None):
+        """Return ``(term, books)`` for the title and author words starting with ``prefix``, most common first."""
+        raise NotImplementedError
+
+    def suggest_query(self, query):
+        """Return ``query`` with its misspelled words corrected, or ``None`` if there is nothing to correct.
+
+        A word is misspelled when no field holds it (as a prefix, for the
+        word being typed) and a title or author word is a few typos from it.
+        """
+        terms = parse_query(query)
+        corrected = []
+        for field, term, prefix in terms:
+            if (field is None or field in FUZZY_FIELDS) and not self.has_term(field, term, prefix):
+                similar = self.similar_terms(term, 1)
+                if similar:
+                    term = similar[0][0]
+            corrected.append((field, term, prefix))
+        return format_query(corrected) if corrected != terms else None
+
+    def complete_query(self, query, limit=5):
+        """Return up to ``limit`` queries completing the last word of ``query``, most common first.
+
+        When no title or author word starts with it, the words a few typos
+        from it are offered instead.
+        """
+        terms = parse_query(query)
+        if not terms or not terms[-1][2] or terms[-1][0] not in (None, *FUZZY_FIELDS):
+            return []
+        field, word, _ = terms[-1]
+        words = [term for term, _ in self.complete_terms(word, limit + 1) if term != word][:limit]
+        if not words and not self.has_term(field, word, True):
+            words = [term for term, _, _ in self.similar_terms(word, limit)]
+        return [format_query(terms[:-1] + [(field, term, True)]) for term in words]
+
+    def recommend_books(self, limit=5, exclude=()):
+        """Return ``(book, score, liked_book)`` for the ``limit`` unread books most like the read books rated highly, best first.
+
+        ``liked_book`` is the highly rated book most like each; books in
+        ``exclude`` are skipped.  See ``recommend``.
+        """
+        with self.lock:
+            picks = self._features().recommend(limit, exclude)
+        books = {book['id']: book for book in self.get_books([i for pick in picks for i in (pick[0], pick[2]) if i is not None])}
+        return [(books[book_id], score, books.get(liked_id)) for book_id, score, liked_id in picks if book_id in books]
+
+    def _features(self):
+        """Return the ``FeatureIndex`` of the books, rebuilt once the stored library changed; call under the lock."""
+        version = self.version
+        if self._feature_index is None or self._feature_version != version:
+            self._feature_index = FeatureIndex(self.iter_books())
+            self._feature_version = version
+        return self._feature_index
+
+    def collections(self):
+        """Return a mapping of collection name to a list of book ids."""
+        raise NotImplementedError
+
+    def reading_list(self):
+        """Return the list of book ids on the reading list."""
+        raise NotImplementedError
+
+    def in_collection(self, name, book_id):
+        """True when collection ``name`` holds ``book_id``."""
+        return book_id in self.collections().get(name, ())
+
+    def export_data(self):
+        """Return the whole library in its on-disk structure."""
+        raise NotImplementedError
+
+    def iter_books(self, batch_size=1000):
+        """Yield every book without materializing a copy of the whole library."""
+        raise NotImplementedError
+
+    def book_frame(self, columns=None):
+        """Return the books as a pandas DataFrame with typed columns.
+
+        ``year``, ``rating`` and ``read`` are numeric or boolean, ``date_added``
+        is a datetime and ``genre`` and ``author`` are categoricals.
+        """
+        raise NotImplementedError
+
+    def is_stale(self):
+        """True when another process changed the stored library since this repository last read or wrote it."""
+        return False
+
+    def refresh(self, load=None):
+        """Bring the repository up to date with changes another process made.
+
+        ``load`` returns the full library data for when an incremental catch-up
+        is not possible; it defaults to reading the store directly.
+        """
+
+    @property
+    def version(self):
+        """A counter that grows with every write to the stored library, for caches keyed on its contents."""
+        raise NotImplementedError
+
+    # Writes
+
+    def add_book(self, book):
+        self.add_books([book])
+
+    def add_books(self, books):
+        raise NotImplementedError
+
+    def update_book(self, book_id, changes):
+        raise NotImplementedError
+
+    def delete_book(self, book_id):
+        """Delete a book and remove it from every collection and the reading list."""
+        raise NotImplementedError
+
+    def find_duplicates(self, books):
+        """Return, for each book, the id of a stored duplicate (same ISBN or normalized title and author) or ``None``."""
+        raise NotImplementedError
+
+    def import_books(self, books, on_duplicate='skip'):
+        """Add books in one pass, resolving duplicates according to ``on_duplicate``.
+
+        Duplicates are matched against the stored library and against books
+        earlier in the same batch.  Returns counts of inserted, updated and
+        duplicate books plus ``ids``, mapping each incoming id to the id it
+        was stored under.
+        """
+        if on_duplicate not in DUPLICATE_MODES:
+            raise ValueError(f"Unsupported duplicate mode: {on_duplicate}")
+        with self.lock:
+            return self._import_books(books, on_duplicate)
+
+    def _import_books(self, books, on_duplicate):
+        result = {'inserted': 0, 'updated': 0, 'duplicates': 0, 'ids': {}}
+        existing_ids = self.find_duplicates(books)
+        existing = {book['id']: book for book in self.get_books([i for i in existing_ids if i is not None])}
+        pending = DedupIndex()
+        new_books = {}
+        for book, existing_id in zip(books, existing_ids):
+            if existing_id is None:
+                pending_id = pending.find(book)
+                if pending_id is None:
+                    pending.add(book)
+                    new_books[book['id']] = book
+                    result['ids'][book['id']] = book['id']
+                    continue
+                # Duplicate within the batch: resolve against the not-yet-written book.
+                if on_duplicate != 'skip':
+                    new_books[pending_id].update(duplicate_changes(new_books[pending_id], book, on_duplicate))
+                result['duplicates'] += 1
+                result['ids'][book['id']] = pending_id
+                continue
+            result['ids'][book['id']] = existing_id
+            changes = {} if on_duplicate == 'skip' else duplicate_changes(existing[existing_id], book, on_duplicate)
+            if changes:
+                self.update_book(existing_id, changes)
+                result['updated'] += 1
+            else:
+                result['duplicates'] += 1
+        if new_books:
+            self.add_books(list(new_books.values()))
+            result['inserted'] = len(new_books)
+        return result
+
+    def set_collection(self, name, book_ids):
+        raise NotImplementedError
+
+    def delete_collection(self, name):
+        raise NotImplementedError
+
+    def add_to_reading_list(self, book_ids):
+        raise NotImplementedError
+
+    def remove_from_reading_list(self, book_ids):
+        raise NotImplementedError
+
+    def replace(self, data):
+        """Replace the whole library with ``data``; ``data['books']`` may be any iterable."""
+        raise NotImplementedError
+
+    def batch(self):
+        """Return a context manager that stores the writes made inside it together.
+
+        Readers and other processes see all of the block's writes or none of
+        them.  If the block raises, its writes are discarded.  ``replace`` is
+        atomic on its own and is not meant to run inside a batch.
+        """
+        return contextlib.nullcontext()
+
+
+def check_books(books):
+    """Return ``books`` as a list, raising ``ValueError`` unless each is a mapping with a string id.
+
+    Writes call this before touching the table or any index.
+    """
+    books = list(books)
+    for book in books:
+        if not isinstance(book, Mapping) or not isinstance(book.get('id'), str):
+            raise ValueError("Every book must be an object with a string id")
+    return books
+
+
+def check_changes(changes):
+    """Raise ``ValueError`` unless ``changes`` is a mapping of fields that leaves the book's id alone."""
+    if not isinstance(changes, Mapping) or 'id' in changes:
+        raise ValueError("Changes must be an object of fields other than the id")
+
+
+def duplicate_changes(existing, incoming, mode):
+    """Return the field changes that resolving ``incoming`` against ``existing`` makes."""
+    changes = {}
+    for field, value in incoming.items():
+        if field in ('id', 'date_added'):
+            continue
+        current = existing.get(field)
+        if mode == 'update':
+            if value != current:
+                changes[field] = value
+        elif field == 'tags':
+            merged = list(current or []) + [tag for tag in (value or []) if tag not in (current or [])]
+            if merged != (current or []):
+                changes[field] = merged
+        elif current in (None, '', 0) and value not in (None, '', 0):
+            changes[field] = value
+    return changes
+
+
+def _sort_key(field):
+    if field == 'year':
+        return _year_key
+    return lambda value: str(value or '').lower()
+
+
+def _year_key(value):
+    # Numbers first, with no year as 0, then anything else by its text, as SQLite orders mixed values.
+    if value is None or isinstance(value, (int, float)):
+        return (0, value or 0, '')
+    return (1, 0, str(value))
+
+
+def _synchronized(method):
+    """Run a write holding the repository and file locks, after applying other processes' changes."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock, self.store.locked():
+            self._catch_up()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class JsonRepository(LibraryRepository):
+    """In-memory library persisted through a ``JournalStore``, shared by every session in the process."""
+
+    def __init__(self, store, data):
+        self._init(store)
+        self._load(data)
+
+    def _init(self, store):
+        self.store = store
+        self.lock = threading.RLock()
+        self._replaying = False
+        self._search_index = None
+        self._facet_index = None
+        self._feature_index = None
+        # Journal records of the batch in progress, or None outside a batch.
+        self._batch = None
+
+    def _load(self, data):
+        """Build the table and indexes from ``data``, then apply its pending ``journal`` records.
+
+        The new table and indexes replace the current ones only once every
+        book has been read.
+        """
+        stats = LibraryStats()
+        dedup = DedupIndex()
+
+        def indexed(books):
+            # Index each book as it streams into the table, while it is still a dict.
+            for book in books:
+                stats.add(book)
+                dedup.add(book)
+                yield book
+
+        table = BookTable(indexed(data['books']))
+        self.table, self.stats, self.dedup = table, stats, dedup
+        self._facet_index = None
+        self._feature_index = None
+        self._set_lists(data['collections'], data['reading_list'])
+        self._replay(data.get('journal') or [])
+
+    def _restore(self, state, records):
+        """Take the table and indexes from a binary snapshot, then apply the journal ``records`` after it."""
+        self.table = state['table']
+        self._facet_index = None
+        self._feature_index = None
+        self.stats = state['stats']
+        self.dedup = state['dedup']
+        self._set_lists(state['collections'], state['reading_list'])
+        self._replay(records)
+
+    def _set_lists(self, collections, reading_list):
+        self.lists = {name: OrderedIdSet(book_ids) for name, book_ids in collections.items()}
+        self.reading = OrderedIdSet(reading_list)
+        self.collection_members = MembershipIndex({name: ids.ids() for name, ids in self.lists.items()})
+        self._lists_view = None
+
+    def _lists(self):
+        """Return ``(collections, reading_list)`` as plain lists, rebuilt after a change to any list."""
+        view = self._lists_view
+        if view is None:
+            with self.lock:
+                view = self._lists_view
+                if view is None:
+                    view = self._lists_view = ({name: ids.ids() for name, ids in self.lists.items()}, self.reading.ids())
+        return view
+
+    def _replay(self, records):
+        if records:
+            self._replaying = True
+            try:
+                for record in records:
+                    self._apply(record)
+            finally:
+                self._replaying = False
+            if self.store.needs_compaction():
+                self._compact()
+        self.signature = self.store.signature()
+
+    @classmethod
+    def open(cls, store, load=None):
+        """Open the library from the store's binary snapshot, or from ``load()`` if it is not current.
+
+        ``load`` defaults to ``store.open``.  After a JSON load a new binary
+        snapshot is written so that the next start can skip the JSON.  A JSON
+        snapshot from an older schema is rewritten first (see ``storage``).
+        """
+        with store.locked():
+            opened = store.read_binary()
+            if opened is not None and opened[0].get('format') == BINARY_FORMAT:
+                repo = cls.__new__(cls)
+                repo._init(store)
+                repo._restore(*opened)
+                return repo
+            repo = cls(store, (load or store.open)())
+            if store.needs_migration:
+                repo._migrate()
+            else:
+                store.write_binary(repo._binary_state())
+            return repo
+
+    def _binary_state(self):
+        return {
+            'format': BINARY_FORMAT,
+            'table': self.table,
+            'stats': self.stats,
+            'dedup': self.dedup,
+            'collections': self.collections(),
+            'reading_list': self.reading_list()
+        }
+
+    def _migrate(self):
+        """Rewrite a snapshot loaded from an older schema, once, after saving the entries it set aside."""
+        self.store.write_quarantine()
+        self._compact()
+        self.signature = self.store.signature()
+
+    def _compact(self):
+        """Fold the journal into a new JSON snapshot and rewrite the binary one to match."""
+        self.store.compact(self._snapshot())
+        self.store.write_binary(self._binary_state())
+
+    @property
+    def search_index(self):
+        # Built on first search, then maintained by every write.
+        if self._search_index is None:
+            with self.lock:
+                if self._search_index is None:
+                    self._search_index = SearchIndex(self.books)
+        return self._search_index
+
+    @property
+    def facet_index(self):
+        # Built on first use and updated by every write to the table; read under the lock.
+        if self._facet_index is None:
+            self._facet_index = FacetIndex(self.table, _sort_key)
+        return self._facet_index
+
+    @property
+    def books(self):
+        return self.table
+
+    def _snapshot(self):
+        return {
+            'books': self.table.iter_dicts(),
+            'collections': self.collections(),
+            'reading_list': self.reading_list()
+        }
+
+    def _index_add(self, books):
+        """Add books to every maintained index."""
+        for book in books:
+            self.stats.add(book)
+            self.dedup.add(book)
+        if self._search_index is not None:
+            for book in books:
+                self._search_index.add(book)
+        if self._feature_index is not None:
+            for book in books:
+                self._feature_index.add(book)
+
+    def _index_remove(self, book):
+        """Remove a book from every maintained index."""
+        self.stats.remove(book)
+        self.dedup.remove(book)
+        if self._search_index is not None:
+            self._search_index.remove(book['id'])
+        if self._feature_index is not None:
+            self._feature_index.remove(book['id'])
+
+    def _table_changed(self, rows):
+        """Bring the facet index, if built, up to date with a write to ``rows`` of the table."""
+        if self._facet_index is not None:
+            self._facet_index.update(rows)
+
+    def _log(self, op, **payload):
+        if self._replaying:
+            return
+        if self._batch is not None:
+            self._batch.append(dict(payload, op=op))
+            return
+        self.store.append(op, **payload)
+        if self.store.needs_compaction():
+            self._compact()
+        self.signature = self.store.signature()
+
+    @property
+    def version(self):
+        """Operation count of the stored library, for caches keyed on its contents."""
+        return self.store.version
+
+    def is_stale(self):
+        return self.store.signature() != self.signature
+
+    def refresh(self, load=None):
+        with self.lock, self.store.locked():
+            self._catch_up(load)
+
+    def _catch_up(self, load=None):
+        """Apply journal records other processes appended, or reload after they compacted."""
+        if self._replaying or not self.is_stale():
+            return
+        records = self.store.read_changes()
+        if records is None:
+            # Another process compacted.
+            self._reload(load)
+            return
+        self._replay(records)
+
+    def _reload(self, load=None):
+        """Reload the library from the store, from its binary snapshot when that is current."""
+        opened = self.store.read_binary()
+        if opened is not None and opened[0].get('format') == BINARY_FORMAT:
+            self._restore(*opened)
+        else:
+            self._load((load or self.store.open)())
+            if self.store.needs_migration:
+                self._migrate()
+        self._search_index = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Write every change made inside the block as a single journal record.
+
+        The repository and file locks are held for the whole block.  If the
+        block raises, the library is reloaded from the store, which does not
+        hold the block's writes yet.
+        """
+        with self.lock, self.store.locked():
+            if self._batch is not None:
+                yield
+                return
+            self._catch_up()
+            self._batch = []
+            try:
+                yield
+            except BaseException:
+                self._batch = None
+                self._reload()
+                raise
+            records, self._batch = self._batch, None
+            if records:
+                self._log('batch', records=records)
+
+    def _apply(self, record):
+        op = record.get('op')
+        if op == 'add_book':
+            self.add_books([record['book']])
+        elif op == 'add_books':
+            self.add_books(record['books'])
+        elif op == 'update_book':
+            self.update_book(record['id'], record['changes'])
+        elif op == 'delete_book':
+            self.delete_book(record['id'])
+        elif op == 'set_collection':
+            self.set_collection(record['name'], record['ids'])
+        elif op == 'delete_collection':
+            self.delete_collection(record['name'])
+        elif op == 'collection_add':
+            self.add_to_collection(record['name'], record['ids'], record.get('position'))
+        elif op == 'collection_remove':
+            self.remove_from_collection(record['name'], record['ids'])
+        elif op == 'collection_move':
+            self.move_in_collection(record['name'], record['ids'], record['position'])
+        elif op == 'reading_list_add':
+            self.add_to_reading_list(record['ids'], record.get('position'))
+        elif op == 'reading_list_remove':
+            self.remove_from_reading_list(record['ids'])
+        elif op == 'reading_list_move':
+            self.move_in_reading_list(record['ids'], record['position'])
+        elif op == 'batch':
+            for change in record['records']:
+                self._apply(change)
+        else:
+            raise ValueError(f"Unknown journal operation: {op!r}")
+
+    def count_books(self, read=None):
+        if read is None:
+            return self.stats.total
+        return self.stats.read if read else self.stats.unread
+
+    def count_distinct(self, field):
+        if field == 'genre':
+            return len(self.stats.genre_keys)
+        if field == 'author':
+            return len(self.stats.author_keys)
+        raise ValueError(f"Unsupported field: {field}")
+
+    def distinct_keys(self, field):
+        if field not in ('genre', 'author'):
+            raise ValueError(f"Unsupported field: {field}")
+        return set(self.stats.genre_keys if field == 'genre' else self.stats.author_keys)
+
+    def genre_counts(self):
+        return self.stats.genre_counts()
+
+    def recent_books(self, limit):
+        book_ids = self.stats.recent_ids(limit)
+        if book_ids is None:
+            # Refill under the lock, so no write changes the table mid-scan.
+            with self.lock:
+                self.stats.refill_recent(self.books)
+                book_ids = self.stats.recent_ids(limit)
+        return self.get_books(book_ids)
+
+    def get_books(self, book_ids):
+        with self.lock:
+            return self.table.get_many(book_ids)
+
+    def get_book(self, book_id):
+        with self.lock:
+            return self.table.get(book_id)
+
+    def book_collections(self, book_id):
+        return self.collection_members.owners_of(book_id)
+
+    def find_duplicates(self, books):
+        return [self.dedup.find(book) for book in books]
+
+    def in_reading_list(self, book_id):
+        return book_id in self.reading
+
+    def query_books(self, read=None, sort_by='title', descending=False, limit=None, offset=0):
+        filters = None if read is None else {'read': read}
+        return self.filter_books(filters, sort_by=sort_by, descending=descending, limit=limit, offset=offset)[1]
+
+    def filter_books(self, filters=None, sort_by='title', descending=False, limit=None, offset=0, after=None):
+        filters = normalize_filters(filters)
+        with self.lock:
+            index = self.facet_index
+            rows = index.match(filters, self.collections())
+            total = len(self.table) if rows is None else len(rows)
+            return total, self.table.books(index.sort(rows, sort_by, descending, offset, limit, after).tolist())
+
+    def facet_counts(self, filters=None):
+        filters = normalize_filters(filters)
+        with self.lock:
+            return self.facet_index.counts(filters, self.collections())
+
+    def search_books(self, query, limit=None, offset=0):
+        hits = self.search_index.search(query, limit=None if limit is None else offset + limit)
+        return self.get_books([book_id for book_id, _ in hits[offset:]])
+
+    def search_hits(self, query, limit=None):
+        hits = self.search_index.search(query, limit=limit)
+        books = {book['id']: book for book in self.get_books([book_id for book_id, _ in hits])}
+        return [(books[book_id], score) for book_id, score in hits if book_id in books]
+
+    def has_term(self, field, term, prefix=False):
+        return self.search_index.has_term(field, term, prefix)
+
+    def similar_terms(self, word, limit=None):
+        return self.search_index.similar_terms(word, limit)
+
+    def complete_terms(self, prefix, limit=None):
+        return self.search_index.complete_terms(prefix, limit)
+
+    def _features(self):
+        # Built on first use, then maintained by every write.
+        if self._feature_index is None:
+            self._feature_index = FeatureIndex(self.table.iter_dicts())
+        return self._feature_index
+
+    def collections(self):
+        return self._lists()[0]
+
+    def reading_list(self):
+        return self._lists()[1]
+
+    def in_collection(self, name, book_id):
+        ids = self.lists.get(name)
+        return ids is not None and book_id in ids
+
+    def export_data(self):
+        collections, reading_list = self._lists()
+        return {'books': list(self.table.iter_dicts()), 'collections': collections, 'reading_list': reading_list}
+
+    def iter_books(self, batch_size=1000):
+        # Walk a copy of the id list so concurrent writes cannot shift rows under the iteration.
+        with self.lock:
+            book_ids = list(self.table.ids)
+        for start in range(0, len(book_ids), batch_size):
+            with self.lock:
+                rows = self.table.rows
+                books = self.table.dicts([rows[i] for i in book_ids[start:start + batch_size] if i in rows])
+            yield from books
+
+    def book_frame(self, columns=None):
+        with self.lock:
+            return self.table.frame(columns)
+
+    @_synchronized
+    def add_books(self, books):
+        # A repeated id within the batch resolves to its last copy.
+        books = list({book['id']: book for book in check_books(books)}.values())
+        for previous in self.table.put_many(books):
+            if previous is not None:
+                self._index_remove(previous)
+        self._index_add(books)
+        self._table_changed([self.table.rows[book['id']] for book in books])
+        if len(books) == 1:
+            self._log('add_book', book=books[0])
+        else:
+            self._log('add_books', books=books)
+
+    @_synchronized
+    def update_book(self, book_id, changes):
+        check_changes(changes)
+        book = self.table.get(book_id)
+        if book is None:
+            return False
+        self._index_remove(book)
+        book = dict(book, **changes)
+        self.table.put_many([book])
+        self._index_add([book])
+        self._table_changed([self.table.rows[book_id]])
+        self._log('update_book', id=book_id, changes=changes)
+        return True
+
+    @_synchronized
+    def delete_book(self, book_id):
+        row = self.table.row_of(book_id)
+        book = self.table.remove(book_id)
+        if book is None:
+            return False
+        self._index_remove(book)
+        # The last row moved into the removed one's place.
+        self._table_changed([row])
+        # Only the lists that actually hold the book are touched, each in O(1).
+        owners = self.collection_members.owners_of(book_id)
+        for name in owners:
+            self.lists[name].remove([book_id])
+            self.collection_members.remove(name, [book_id])
+        removed = self.reading.remove([book_id])
+        if owners or removed:
+            self._lists_view = None
+        self._log('delete_book', id=book_id)
+        return True
+
+    # Each list edit journals only the ids it changed.
+
+    @_synchronized
+    def set_collection(self, name, book_ids):
+        old = self.lists.get(name)
+        if old is not None:
+            self.collection_members.remove(name, old.ids())
+        ids = self.lists[name] = OrderedIdSet(book_ids)
+        self.collection_members.add(name, ids.ids())
+        self._lists_view = None
+        self._log('set_collection', name=name, ids=ids.ids())
+
+    @_synchronized
+    def delete_collection(self, name):
+        old = self.lists.pop(name, None)
+        if old is not None:
+            self.collection_members.remove(name, old.ids())
+            self._lists_view = None
+        self._log('delete_collection', name=name)
+
+    @_synchronized
+    def add_to_collection(self, name, book_ids, position=None):
+        created = name not in self.lists
+        ids = self.lists[name] if not created else self.lists.setdefault(name, OrderedIdSet())
+        added = ids.add(book_ids, position)
+        if added or created:
+            self.collection_members.add(name, added)
+            self._lists_view = None
+            self._log('collection_add', name=name, ids=added, position=position)
+
+    @_synchronized
+    def remove_from_collection(self, name, book_ids):
+        ids = self.lists.get(name)
+        removed = ids.remove(book_ids) if ids is not None else []
+        if removed:
+            self.collection_members.remove(name, removed)
+            self._lists_view = None
+            self._log('collection_remove', name=name, ids=removed)
+
+    @_synchronized
+    def move_in_collection(self, name, book_ids, position):
+        ids = self.lists.get(name)
+        moved = ids.move(book_ids, position) if ids is not None else []
+        if moved:
+            self._lists_view = None
+            self._log('collection_move', name=name, ids=moved, position=position)
+
+    @_synchronized
+    def add_to_reading_list(self, book_ids, position=None):
+        added = self.reading.add(book_ids, position)
+        if added:
+            self._lists_view = None
+            self._log('reading_list_add', ids=added, position=position)
+
+    @_synchronized
+    def remove_from_reading_list(self, book_ids):
+        removed = self.reading.remove(book_ids)
+        if removed:
+            self._lists_view = None
+            self._log('reading_list_remove', ids=removed)
+
+    @_synchronized
+    def move_in_reading_list(self, book_ids, position):
+        moved = self.reading.move(book_ids, position)
+        if moved:
+            self._lists_view = None
+            self._log('reading_list_move', ids=moved, position=position)
+
+    @_synchronized
+    def replace(self, data):
+        try:
+            self._load({
+                'books': require_valid_books(data.get('books', [])),
+                'collections': dict(data.get('collections', {})),
+                'reading_list': list(data.get('reading_list', []))
+            })
+        except BaseException:
+            # Nothing was stored yet; put back the library the store holds.
+            self._reload()
+            raise
+        if self._search_index is not None:
+            self._search_index.sync(self.books)
+        self.store.version += 1
+        self._compact()
+        self.signature = self.store.signature()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    author TEXT,
+    year INTEGER,
+    genre TEXT,
+    read INTEGER NOT NULL DEFAULT 0,
+    rating INTEGER,
+    notes TEXT,
+    isbn TEXT,
+    tags TEXT,
+    date_added TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_books_author ON books(author COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_books_genre ON books(genre);
+CREATE INDEX IF NOT EXISTS idx_books_year ON books(year);
+CREATE INDEX IF NOT EXISTS idx_books_read ON books(read);
+CREATE INDEX IF NOT EXISTS idx_books_date_added ON books(date_added);
+CREATE INDEX IF NOT EXISTS idx_books_title ON books(title COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS collections (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS collection_books (
+    collection TEXT NOT NULL REFERENCES collections(name) ON DELETE CASCADE,
+    book_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (collection, position)
+);
+CREATE INDEX IF NOT EXISTS idx_collection_books_book ON collection_books(book_id);
+
+CREATE TABLE IF NOT EXISTS reading_list (
+    position INTEGER PRIMARY KEY,
+    book_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reading_list_book ON reading_list(book_id);
+
+CREATE TABLE IF NOT EXISTS library_meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+-- Every book holding each duplicate key, so deleting one of several books
+-- sharing a key keeps it for the others.
+CREATE TABLE IF NOT EXISTS book_keys (
+    key TEXT NOT NULL,
+    book_id TEXT NOT NULL,
+    UNIQUE (key, book_id)
+);
+CREATE INDEX IF NOT EXISTS idx_book_keys_book ON book_keys(book_id);
+CREATE TRIGGER IF NOT EXISTS books_keys_delete AFTER DELETE ON books BEGIN
+    DELETE FROM book_keys WHERE book_id = OLD.id;
+END;
+"""
+
+# Full-text index over the searchable columns. Rows share the rowid of their
+# book and are kept in sync by triggers; tags are indexed as their JSON text.
+# books_vocab lists the index's words with the number of books per column.
+FTS_SCHEMA = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS books_search USING fts5(
+    {', '.join(SEARCH_FIELDS)},
+    tokenize = 'unicode61', prefix = '2 3'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS books_vocab USING fts5vocab(books_search, 'col');
+CREATE TRIGGER IF NOT EXISTS books_search_insert AFTER INSERT ON books BEGIN
+    INSERT INTO books_search (rowid, {', '.join(SEARCH_FIELDS)})
+    VALUES (NEW.rowid, {', '.join('NEW.' + field for field in SEARCH_FIELDS)});
+END;
+CREATE TRIGGER IF NOT EXISTS books_search_delete AFTER DELETE ON books BEGIN
+    DELETE FROM books_search WHERE rowid = OLD.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS books_search_update AFTER UPDATE ON books BEGIN
+    DELETE FROM books_search WHERE rowid = OLD.rowid;
+    INSERT INTO books_search (rowid, {', '.join(SEARCH_FIELDS)})
+    VALUES (NEW.rowid, {', '.join('NEW.' + field for field in SEARCH_FIELDS)});
+END;
+"""
+
+# Running aggregates maintained by triggers so the Dashboard and Statistics
+# pages never scan the books table.
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS book_counts (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS value_counts (
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (field, value)
+);
+"""
+
+# (field, value expression, condition) for each counted value, written against
+# a trigger row alias.
+_COUNTED_VALUES = [
+    ('genre', '{row}.genre', '{row}.genre IS NOT NULL'),
+    ('genre_key', 'lower({row}.genre)', "{row}.genre <> ''"),
+    ('author_key', 'lower({row}.author)', "{row}.author <> ''"),
+]
+
+
+def _stats_statements(row, sign):
+    """Trigger statements adding (sign=1) or removing (sign=-1) trigger row ``row``."""
+    statements = [
+        f"INSERT INTO book_counts (name, value) VALUES ('total', {sign}) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;",
+        f"INSERT INTO book_counts (name, value) VALUES ('read', {sign} * {row}.read) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;",
+    ]
+    for field, value, condition in _COUNTED_VALUES:
+        value, condition = value.format(row=row), condition.format(row=row)
+        statements.append(
+            f"INSERT INTO value_counts (field, value, count) SELECT '{field}', {value}, {sign} WHERE {condition} "
+            "ON CONFLICT(field, value) DO UPDATE SET count = count + excluded.count;"
+        )
+        if sign < 0:
+            statements.append(f"DELETE FROM value_counts WHERE field = '{field}' AND value = {value} AND count <= 0;")
+    return "\n    ".join(statements)
+
+
+STATS_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS books_stats_insert AFTER INSERT ON books BEGIN
+    {_stats_statements('NEW', 1)}
+END;
+CREATE TRIGGER IF NOT EXISTS books_stats_delete AFTER DELETE ON books BEGIN
+    {_stats_statements('OLD', -1)}
+END;
+CREATE TRIGGER IF NOT EXISTS books_stats_update AFTER UPDATE ON books BEGIN
+    {_stats_statements('OLD', -1)}
+    {_stats_statements('NEW', 1)}
+END;
+"""
+
+_SORT_COLUMNS = {
+    'title': 'title COLLATE NOCASE',
+    'author': 'author COLLATE NOCASE',
+    'year': 'year',
+    'genre': 'genre COLLATE NOCASE',
+    'date_added': 'date_added',
+}
+
+
+# SQL expressions the facets filter and count on; as in the JSON backend,
+# years and ratings that are not integers count as 0.
+def _order_by(sort_by, descending):
+    direction = 'DESC' if descending else 'ASC'
+    return f" ORDER BY {_SORT_COLUMNS[sort_by]} {direction}, id {direction}"
+
+
+def _after_clause(sort_by, descending, value, book_id):
+    """Return a WHERE condition and its parameters for the books that follow ``(value, book_id)`` in sort order.
+
+    SQLite sorts NULLs first, so they precede every value ascending and follow
+    every value descending.
+    """
+    column = _SORT_COLUMNS[sort_by]
+    if value is None:
+        if descending:
+            return f"({column} IS NULL AND id < ?)", [book_id]
+        return f"({column} IS NOT NULL OR id > ?)", [book_id]
+    if descending:
+        return f"({column} < ? OR {column} IS NULL OR ({column} = ? AND id < ?))", [value, value, book_id]
+    return f"({column} > ? OR ({column} = ? AND id > ?))", [value, value, book_id]
+
+
+_FACET_COLUMNS = {
+    'genre': 'genre',
+    'author': 'author',
+    'year': "(CASE WHEN typeof(year) = 'integer' THEN year ELSE 0 END)",
+    'rating': "(CASE WHEN typeof(rating) = 'integer' THEN rating ELSE 0 END)",
+    'read': 'read',
+}
+
+
+def _book_to_row(book):
+    extra = {k: v for k, v in book.items() if k not in BOOK_FIELDS}
+    tags = book.get('tags')
+    return (
+        book['id'],
+        book.get('title'),
+        book.get('author'),
+        book.get('year'),
+        book.get('genre'),
+        1 if book.get('read') else 0,
+        book.get('rating'),
+        book.get('notes'),
+        book.get('isbn'),
+        json.dumps(tags) if tags is not None else None,
+        book.get('date_added'),
+        json.dumps(extra) if extra else None,
+    )
+
+
+def _row_to_book(row):
+    book = {}
+    for field in BOOK_FIELDS:
+        value = row[field]
+        if value is None:
+            continue
+        if field == 'read':
+            value = bool(value)
+        elif field == 'tags':
+            value = json.loads(value)
+        book[field] = value
+    if row['extra']:
+        book.update(json.loads(row['extra']))
+    return book
+
+
+class SqliteRepository(LibraryRepository):
+    """Library stored in a SQLite database, with a pool of read-only connections for reads."""
+
+    def __init__(self, path, readers=READ_CONNECTIONS):
+        self.path = path
+        # Streamlit reruns scripts on fresh threads, so the connection is shared
+        # across threads and serialized with a lock.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self.conn.executescript(FTS_SCHEMA)
+        self.conn.executescript(STATS_SCHEMA)
+        self.conn.executescript(STATS_TRIGGERS)
+        self.lock = threading.RLock()
+        self._in_batch = False
+        # Thread running a write transaction on ``conn``.
+        self._writer = None
+        # An in-memory database cannot be opened a second time.
+        self._max_readers = 0 if path in ('', ':memory:') else readers
+        self._reader_uri = None if not self._max_readers else pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._local = threading.local()
+        # Title and author words for spelling suggestions, and the version they were read at.
+        self._term_index = None
+        self._term_version = None
+        # Recommendation features, and the version they were read at.
+        self._feature_index = None
+        self._feature_version = None
+        if not self._query("SELECT 1 FROM book_counts WHERE name = 'total'"):
+            self._rebuild_stats()
+        if self._scalar("SELECT COUNT(*) FROM books_search") != self.count_books():
+            self._rebuild_search_index()
+        if self.count_books() and not self._query("SELECT 1 FROM book_keys LIMIT 1"):
+            self._rebuild_dedup_keys()
+
+    def _rebuild_dedup_keys(self):
+        with self._transaction():
+            self.conn.execute("DELETE FROM book_keys")
+            books = [_row_to_book(row) for row in self.conn.execute("SELECT * FROM books")]
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO book_keys (key, book_id) VALUES (?, ?)",
+                ((key, book['id']) for book in books for key in dedup_keys(book))
+            )
+
+    def _rebuild_stats(self):
+        with self._transaction():
+            self.conn.execute("DELETE FROM book_counts")
+            self.conn.execute("DELETE FROM value_counts")
+            self.conn.execute("INSERT INTO book_counts SELECT 'total', COUNT(*) FROM books")
+            self.conn.execute("INSERT INTO book_counts SELECT 'read', COALESCE(SUM(read), 0) FROM books")
+            for field, value, condition in _COUNTED_VALUES:
+                value, condition = value.format(row='books'), condition.format(row='books')
+                self.conn.execute(
+                    f"INSERT INTO value_counts SELECT '{field}', {value}, COUNT(*) FROM books WHERE {condition} GROUP BY {value}"
+                )
+
+    def _rebuild_search_index(self):
+        with self._transaction():
+            self.conn.execute("DELETE FROM books_search")
+            self.conn.execute(
+                f"INSERT INTO books_search (rowid, {', '.join(SEARCH_FIELDS)}) "
+                f"SELECT rowid, {', '.join(SEARCH_FIELDS)} FROM books"
+            )
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Hold the lock and run the block in its own transaction, or in the enclosing batch's."""
+        with self.lock:
+            if self._in_batch:
+                yield
+            else:
+                with self._writing(), self.conn:
+                    yield
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Run every write made inside the block in one transaction."""
+        with self.lock:
+            if self._in_batch:
+                yield
+                return
+            with self._writing(), self.conn:
+                self._in_batch = True
+                try:
+                    yield
+                except BaseException:
+                    # The rollback undoes writes the features already hold.
+                    self._feature_index = None
+                    raise
+                finally:
+                    self._in_batch = False
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Route this thread's reads to the write connection until the block ends."""
+        writer, self._writer = self._writer, threading.get_ident()
+        try:
+            yield
+        finally:
+            self._writer = writer
+
+    def _open_reader(self):
+        conn = sqlite3.connect(self._reader_uri, uri=True, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Yield the connection for a read on this thread.
+
+        That is the write connection, under the lock, while this thread writes
+        or when there is no pool, and otherwise a pooled read-only connection.
+        Nested reads on a thread share its connection.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        if self._writer == threading.get_ident() or not self._max_readers:
+            with self.lock:
+                yield self.conn
+            return
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._reader_lock:
+                opened = self._reader_count < self._max_readers
+                if opened:
+                    self._reader_count += 1
+            try:
+                conn = self._open_reader() if opened else self._readers.get()
+            except Exception:
+                with self._reader_lock:
+                    self._reader_count -= 1
+                raise
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    @contextlib.contextmanager
+    def _snapshot(self):
+        """Run the block's reads against one consistent state of the database."""
+        with self._reading() as conn:
+            if conn is self.conn or conn.in_transaction:
+                yield
+                return
+            conn.execute("BEGIN")
+            try:
+                yield
+            finally:
+                conn.rollback()
+
+    def _query(self, sql, params=()):
+        with self._reading() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _scalar(self, sql, params=()):
+        return self._query(sql, params)[0][0]
+
+    @property
+    def version(self):
+        return self._scalar("SELECT COALESCE((SELECT value FROM library_meta WHERE name = 'version'), 0)")
+
+    def _bump_version(self):
+        # Called inside each write transaction, so the new version commits with the write.
+        self.conn.execute(
+            "INSERT INTO library_meta (name, value) VALUES ('version', 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+        )
+        # This process's own writes keep the word index and the features usable.
+        if self._term_version is not None:
+            self._term_version += 1
+        if self._feature_version is not None:
+            self._feature_version += 1
+
+    def is_empty(self):
+        return self._scalar("SELECT NOT EXISTS (SELECT 1 FROM books) AND NOT EXISTS (SELECT 1 FROM collections)") == 1
+
+    def count_books(self, read=None):
+        counts = dict(self._query("SELECT name, value FROM book_counts"))
+        total = counts.get('total', 0)
+        if read is None:
+            return total
+        return counts.get('read', 0) if read else total - counts.get('read', 0)
+
+    def count_distinct(self, field):
+        if field not in ('genre', 'author'):
+            raise ValueError(f"Unsupported field: {field}")
+        return self._scalar("SELECT COUNT(*) FROM value_counts WHERE field = ?", (f"{field}_key",))
+
+    def distinct_keys(self, field):
+        if field not in ('genre', 'author'):
+            raise ValueError(f"Unsupported field: {field}")
+        return {row[0] for row in self._query("SELECT value FROM value_counts WHERE field = ?", (f"{field}_key",))}
+
+    def genre_counts(self):
+        rows = self._query("SELECT value, count FROM value_counts WHERE field = 'genre' ORDER BY count DESC")
+        return [(row[0], row[1]) for row in rows]
+
+    def get_books(self, book_ids):
+        book_ids = list(book_ids)
+        found = {}
+        # Stay below SQLite's bound-parameter limit.
+        for start in range(0, len(book_ids), 500):
+            chunk = book_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in self._query(f"SELECT * FROM books WHERE id IN ({placeholders})", chunk):
+                found[row['id']] = _row_to_book(row)
+        return [found[book_id] for book_id in book_ids if book_id in found]
+
+    def find_duplicates(self, books):
+        books = list(books)
+        keys = [dedup_keys(book) for book in books]
+        flat = list({key for book_keys in keys for key in book_keys})
+        found = {}
+        for start in range(0, len(flat), 500):
+            chunk = flat[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            # Newest first, so the book that has held a key longest wins.
+            found.update(self._query(
+                f"SELECT key, book_id FROM book_keys WHERE key IN ({placeholders}) ORDER BY rowid DESC", chunk
+            ))
+        return [next((found[key] for key in book_keys if key in found), None) for book_keys in keys]
+
+    def book_collections(self, book_id):
+        return [row[0] for row in self._query("SELECT DISTINCT collection FROM collection_books WHERE book_id = ?", (book_id,))]
+
+    def in_reading_list(self, book_id):
+        return self._scalar("SELECT EXISTS (SELECT 1 FROM reading_list WHERE book_id = ?)", (book_id,)) == 1
+
+    def in_collection(self, name, book_id):
+        return self._scalar(
+            "SELECT EXISTS (SELECT 1 FROM collection_books WHERE collection = ? AND book_id = ?)", (name, book_id)
+        ) == 1
+
+    def query_books(self, read=None, sort_by='title', descending=False, limit=None, offset=0):
+        if sort_by not in _SORT_COLUMNS:
+            raise ValueError(f"Unsupported sort field: {sort_by}")
+        sql = "SELECT * FROM books"
+        params = []
+        if read is not None:
+            sql += " WHERE read = ?"
+            params.append(1 if read else 0)
+        sql += _order_by(sort_by, descending)
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset])
+        return [_row_to_book(row) for row in self._query(sql, params)]
+
+    def _facet_clauses(self, filters, skip=None):
+        """Return WHERE conditions and parameters for every facet of normalized ``filters`` but ``skip``."""
+        clauses, params = [], []
+        for name, value in filters.items():
+            if name == skip:
+                continue
+            if name == 'year':
+                lowest, highest = value
+                if lowest is not None:
+                    clauses.append(f"{_FACET_COLUMNS['year']} >= ?")
+                    params.append(lowest)
+                if highest is not None:
+                    clauses.append(f"{_FACET_COLUMNS['year']} <= ?")
+                    params.append(highest)
+                continue
+            if name == 'read':
+                clauses.append("read = ?")
+                params.append(1 if value else 0)
+                continue
+            # Value lists are bound as one JSON array, so their length is not limited by SQLite's parameter count.
+            if name == 'tags':
+                clauses.append(
+                    "json_type(books.tags) = 'array' AND EXISTS "
+                    "(SELECT 1 FROM json_each(books.tags) AS tag WHERE tag.value IN (SELECT value FROM json_each(?)))"
+                )
+            elif name == 'collection':
+                clauses.append(
+                    "books.id IN (SELECT book_id FROM collection_books WHERE collection IN (SELECT value FROM json_each(?)))"
+                )
+            elif name == 'ids':
+                clauses.append("books.id IN (SELECT value FROM json_each(?))")
+            else:
+                clauses.append(f"{_FACET_COLUMNS[name]} IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(value)))
+        return clauses, params
+
+    def filter_books(self, filters=None, sort_by='title', descending=False, limit=None, offset=0, after=None):
+        if sort_by not in _SORT_COLUMNS:
+            raise ValueError(f"Unsupported sort field: {sort_by}")
+        clauses, params = self._facet_clauses(normalize_filters(filters))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        page_clauses, page = list(clauses), list(params)
+        if after is not None:
+            clause, values = _after_clause(sort_by, descending, *after)
+            page_clauses.append(clause)
+            page.extend(values)
+        sql = "SELECT * FROM books"
+        if page_clauses:
+            sql += f" WHERE {' AND '.join(page_clauses)}"
+        sql += _order_by(sort_by, descending)
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            page.extend([-1 if limit is None else limit, offset])
+        with self._snapshot():
+            total = self._scalar(f"SELECT COUNT(*) FROM books{where}", params) if clauses else self.count_books()
+            return total, [_row_to_book(row) for row in self._query(sql, page)]
+
+    def facet_counts(self, filters=None):
+        filters = normalize_filters(filters)
+        result = {}
+        with self._snapshot():
+            for field in FACETS:
+                clauses, params = self._facet_clauses(filters, skip=field)
+                if field == 'tags':
+                    clauses = ["json_type(books.tags) = 'array'", "tag.type = 'text'"] + clauses
+                    sql = "SELECT tag.value, COUNT(DISTINCT books.id) FROM books, json_each(books.tags) AS tag"
+                    group = "tag.value"
+                elif field == 'collection':
+                    sql = "SELECT collection, COUNT(DISTINCT books.id) FROM collection_books JOIN books ON books.id = collection_books.book_id"
+                    group = "collection"
+                else:
+                    group = _FACET_COLUMNS[field]
+                    sql = f"SELECT {group}, COUNT(*) FROM books"
+                if clauses:
+                    sql += f" WHERE {' AND '.join(clauses)}"
+                counts = dict(self._query(f"{sql} GROUP BY {group}", params))
+                if field == 'read':
+                    counts = {True: counts.get(1, 0), False: counts.get(0, 0)}
+                result[field] = order_counts(field, counts)
+        return result
+
+    def _search(self, query, limit, offset):
+        terms = parse_query(query)
+        if not terms:
+            return []
+        # Translate to an FTS5 expression; quoting keeps user input literal.
+        match = " AND ".join(
+            (f"{field} : " if field else "") + f'"{term}"' + ("*" if prefix else "")
+            for field, term, prefix in terms
+        )
+        weights = ", ".join(str(FIELD_WEIGHTS[field]) for field in SEARCH_FIELDS)
+        sql = (
+            f"SELECT books.*, bm25(books_search, {weights}) AS score "
+            "FROM books_search JOIN books ON books.rowid = books_search.rowid "
+            "WHERE books_search MATCH ? ORDER BY score"
+        )
+        params = [match]
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([-1 if limit is None else limit, offset])
+        return self._query(sql, params)
+
+    def search_books(self, query, limit=None, offset=0):
+        return [_row_to_book(row) for row in self._search(query, limit, offset)]
+
+    def search_hits(self, query, limit=None):
+        # bm25 is lower for better matches.
+        return [(_row_to_book(row), -row['score']) for row in self._search(query, limit, 0)]
+
+    def has_term(self, field, term, prefix=False):
+        condition, params = ("term >= ? AND term < ?", [term, term + "\U0010ffff"]) if prefix else ("term = ?", [term])
+        if field:
+            condition += " AND col = ?"
+            params.append(field)
+        return bool(self._query(f"SELECT 1 FROM books_vocab WHERE {condition} LIMIT 1", params))
+
+    def _vocabulary(self):
+        """Return the ``TermIndex`` of title and author words, rebuilt after another process wrote.
+
+        Writes in this process only add words to it, so it may hold words no
+        book has any more; lookups check the book counts and skip those.
+        """
+        with self.lock:
+            version = self.version
+            if self._term_index is None or self._term_version != version:
+                columns = ", ".join("?" * len(FUZZY_FIELDS))
+                rows = self._query(f"SELECT DISTINCT term FROM books_vocab WHERE col IN ({columns})", FUZZY_FIELDS)
+                self._term_index = TermIndex(row[0] for row in rows)
+                self._term_version = version
+            return self._term_index
+
+    def _term_books(self, terms):
+        """Return ``{term: books}`` for the ``terms`` some title or author still holds."""
+        columns = ", ".join("?" * len(FUZZY_FIELDS))
+        sql = f"SELECT SUM(doc) FROM books_vocab WHERE term = ? AND col IN ({columns})"
+        books = {}
+        for term in terms:
+            count = self._scalar(sql, [term, *FUZZY_FIELDS])
+            if count:
+                books[term] = count
+        return books
+
+    def similar_terms(self, word, limit=None):
+        # Writes add to the index, so look it up under the lock.
+        with self.lock:
+            similar = self._vocabulary().similar(word)
+        books = self._term_books(term for term, _ in similar)
+        found = [(term, distance, books[term]) for term, distance in similar if term in books]
+        found.sort(key=lambda item: (item[1], -item[2], item[0]))
+        return found[:limit]
+
+    def complete_terms(self, prefix, limit=None):
+        columns = ", ".join("?" * len(FUZZY_FIELDS))
+        rows = self._query(
+            f"SELECT term, SUM(doc) AS books FROM books_vocab WHERE term >= ? AND term < ? AND col IN ({columns}) "
+            "GROUP BY term ORDER BY books DESC, term LIMIT ?",
+            [prefix, prefix + "\U0010ffff", *FUZZY_FIELDS, -1 if limit is None else limit]
+        )
+        return [(row[0], row[1]) for row in rows]
+
+    def collections(self):
+        result = {row[0]: [] for row in self._query("SELECT name FROM collections ORDER BY rowid")}
+        for row in self._query("SELECT collection, book_id FROM collection_books ORDER BY collection, position"):
+            result[row[0]].append(row[1])
+        return result
+
+    def reading_list(self):
+        return [row[0] for row in self._query("SELECT book_id FROM reading_list ORDER BY position")]
+
+    def iter_books(self, batch_size=1000):
+        # Page through the table by rowid so no cursor is held between batches.
+        last = 0
+        while True:
+            rows = self._query("SELECT rowid, * FROM books WHERE rowid > ? ORDER BY rowid LIMIT ?", (last, batch_size))
+            if not rows:
+                return
+            for row in rows:
+                yield _row_to_book(row)
+            last = rows[-1][0]
+
+    def book_frame(self, columns=None):
+        import pandas as pd
+
+        columns = list(columns or BOOK_FIELDS)
+        with self._reading() as conn:
+            frame = pd.read_sql_query(f"SELECT {', '.join(columns)} FROM books ORDER BY rowid", conn)
+        for name in ('year', 'rating'):
+            if name in frame:
+                frame[name] = pd.to_numeric(frame[name], errors='coerce').fillna(0).astype('int32')
+        if 'read' in frame:
+            frame['read'] = frame['read'].fillna(0).astype(bool)
+        if 'date_added' in frame:
+            frame['date_added'] = pd.to_datetime(frame['date_added'], format="%Y-%m-%d %H:%M:%S", errors='coerce')
+        for name in ('author', 'genre'):
+            if name in frame:
+                frame[name] = frame[name].astype('category')
+        if 'tags' in frame:
+            frame['tags'] = [json.loads(tags) if tags else [] for tags in frame['tags']]
+        return frame
+
+    def export_data(self):
+        return {
+            'books': list(self.iter_books()),
+            'collections': self.collections(),
+            'reading_list': self.reading_list()
+        }
+
+    def add_books(self, books):
+        books = check_books(books)
+        placeholders = ",".join("?" * (len(BOOK_FIELDS) + 1))
+        with self._transaction():
+            self.conn.executemany(
+                f"INSERT INTO books ({', '.join(BOOK_FIELDS)}, extra) VALUES ({placeholders}) "
+                f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in BOOK_FIELDS[1:] + ['extra'])}",
+                (_book_to_row(book) for book in books)
+            )
+            self.conn.executemany("DELETE FROM book_keys WHERE book_id = ?", ((book['id'],) for book in books))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO book_keys (key, book_id) VALUES (?, ?)",
+                ((key, book['id']) for book in books for key in dedup_keys(book))
+            )
+            self._bump_version()
+            if self._term_index is not None:
+                for book in books:
+                    for field in FUZZY_FIELDS:
+                        for token in tokenize(field_text(book, field)):
+                            if token not in self._term_index:
+                                self._term_index.add(token)
+            if self._feature_index is not None:
+                for book in books:
+                    self._feature_index.add(book)
+
+    def update_book(self, book_id, changes):
+        check_changes(changes)
+        book = self.get_book(book_id)
+        if book is None:
+            return False
+        book.update(changes)
+        self.add_books([book])
+        return True
+
+    def delete_book(self, book_id):
+        with self._transaction():
+            deleted = self.conn.execute("DELETE FROM books WHERE id = ?", (book_id,)).rowcount
+            self.conn.execute("DELETE FROM collection_books WHERE book_id = ?", (book_id,))
+            self.conn.execute("DELETE FROM reading_list WHERE book_id = ?", (book_id,))
+            self._bump_version()
+            if self._feature_index is not None:
+                self._feature_index.remove(book_id)
+        return deleted > 0
+
+    # A collection and the reading list (``name`` None) are both rows of
+    # (position, book_id); positions only need to be ascending.
+
+    def _list_ids(self, name):
+        if name is None:
+            rows = self.conn.execute("SELECT book_id FROM reading_list ORDER BY position")
+        else:
+            rows = self.conn.execute("SELECT book_id FROM collection_books WHERE collection = ? ORDER BY position", (name,))
+        return OrderedIdSet(row[0] for row in rows)
+
+    def _insert_list(self, name, book_ids, start=0):
+        if name is None:
+            self.conn.executemany(
+                "INSERT INTO reading_list (position, book_id) VALUES (?, ?)",
+                ((start + i, book_id) for i, book_id in enumerate(book_ids))
+            )
+        else:
+            self.conn.executemany(
+                "INSERT INTO collection_books (collection, book_id, position) VALUES (?, ?, ?)",
+                ((name, book_id, start + i) for i, book_id in enumerate(book_ids))
+            )
+
+    def _rewrite_list(self, name, book_ids):
+        if name is None:
+            self.conn.execute("DELETE FROM reading_list")
+        else:
+            self.conn.execute("DELETE FROM collection_books WHERE collection = ?", (name,))
+        self._insert_list(name, book_ids)
+
+    def _add_to_list(self, name, book_ids, position):
+        ids = self._list_ids(name)
+        size = len(ids)
+        added = ids.add(book_ids, position)
+        if not added:
+            return
+        if position is None or position >= size:
+            # Appending writes only the new rows.
+            if name is None:
+                start = self.conn.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM reading_list").fetchone()[0]
+            else:
+                start = self.conn.execute(
+                    "SELECT COALESCE(MAX(position) + 1, 0) FROM collection_books WHERE collection = ?", (name,)
+                ).fetchone()[0]
+            self._insert_list(name, added, start)
+        else:
+            self._rewrite_list(name, ids.ids())
+        self._bump_version()
+
+    def _move_in_list(self, name, book_ids, position):
+        ids = self._list_ids(name)
+        if ids.move(book_ids, position):
+            self._rewrite_list(name, ids.ids())
+            self._bump_version()
+
+    def _write_collection(self, name, book_ids):
+        self.conn.execute("INSERT OR IGNORE INTO collections (name) VALUES (?)", (name,))
+        self._rewrite_list(name, dict.fromkeys(book_ids))
+
+    def set_collection(self, name, book_ids):
+        with self._transaction():
+            self._write_collection(name, book_ids)
+            self._bump_version()
+
+    def delete_collection(self, name):
+        with self._transaction():
+            self.conn.execute("DELETE FROM collections WHERE name = ?", (name,))
+            self._bump_version()
+
+    def add_to_collection(self, name, book_ids, position=None):
+        with self._transaction():
+            if self.conn.execute("INSERT OR IGNORE INTO collections (name) VALUES (?)", (name,)).rowcount:
+                self._bump_version()
+            self._add_to_list(name, book_ids, position)
+
+    def remove_from_collection(self, name, book_ids):
+        with self._transaction():
+            removed = sum(
+                self.conn.execute("DELETE FROM collection_books WHERE collection = ? AND book_id = ?", (name, book_id)).rowcount
+                for book_id in dict.fromkeys(book_ids)
+            )
+            if removed:
+                self._bump_version()
+
+    def move_in_collection(self, name, book_ids, position):
+        with self._transaction():
+            self._move_in_list(name, book_ids, position)
+
+    def add_to_reading_list(self, book_ids, position=None):
+        with self._transaction():
+            self._add_to_list(None, book_ids, position)
+
+    def remove_from_reading_list(self, book_ids):
+        with self._transaction():
+            removed = sum(
+                self.conn.execute("DELETE FROM reading_list WHERE book_id = ?", (book_id,)).rowcount
+                for book_id in dict.fromkeys(book_ids)
+            )
+            if removed:
+                self._bump_version()
+
+    def move_in_reading_list(self, book_ids, position):
+        with self._transaction():
+            self._move_in_list(None, book_ids, position)
+
+    def replace(self, data):
+        data = data or empty_library()
+        # One transaction, so readers never see the library half replaced.
+        with self.batch():
+            with self._transaction():
+                self.conn.execute("DELETE FROM books")
+                self.conn.execute("DELETE FROM collections")
+                self.conn.execute("DELETE FROM collection_books")
+                self.conn.execute("DELETE FROM reading_list")
+                self._bump_version()
+                self._feature_index = None
+            # Insert in batches so a streamed restore never holds the whole library.
+            books = require_valid_books(data.get('books', []))
+            while True:
+                batch = list(islice(books, REPLACE_BATCH))
+                if not batch:
+                    break
+                self.add_books(batch)
+            with self._transaction():
+                for name, book_ids in data.get('collections', {}).items():
+                    self._write_collection(name, book_ids)
+                self._bump_version()
+            self.add_to_reading_list(data.get('reading_list', []))
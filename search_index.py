@@ -0,0 +1,246 @@
+"""Incrementally maintained inverted index for full-text book search."""
+import bisect
+import heapq
+import math
+import re
+
+from fuzzy import TermIndex
+
+# Searchable fields and their ranking weights.
+FIELD_WEIGHTS = {
+    'title': 3.0,
+    'author': 2.0,
+    'genre': 1.0,
+    'tags': 1.0,
+    'isbn': 1.0,
+    'notes': 0.5,
+}
+FIELDS = list(FIELD_WEIGHTS)
+# Fields whose words are offered as spelling corrections and completions.
+FUZZY_FIELDS = ['title', 'author']
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """Split text into lowercase word tokens."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def field_text(book, field):
+    """Return the searchable text of one book field."""
+    value = book.get(field)
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ' '.join(str(v) for v in value)
+    return str(value)
+
+
+def parse_query(query):
+    """Parse a query into ``(field, term, prefix)`` triples.
+
+    ``field`` is ``None`` for unqualified terms.  Unknown field qualifiers are
+    treated as ordinary search text.
+    """
+    parts = query.split()
+    terms = []
+    for i, part in enumerate(parts):
+        field = None
+        if ':' in part:
+            name, _, rest = part.partition(':')
+            if name.lower() in FIELD_WEIGHTS:
+                field, part = name.lower(), rest
+        prefix = part.endswith('*') or i == len(parts) - 1
+        tokens = tokenize(part)
+        for j, token in enumerate(tokens):
+            # Only the final token of a part can be incomplete.
+            terms.append((field, token, prefix and j == len(tokens) - 1))
+    return terms
+
+
+def format_query(terms):
+    """Turn ``(field, term, prefix)`` triples back into query text that ``parse_query`` reads the same way."""
+    parts = []
+    for i, (field, term, prefix) in enumerate(terms):
+        star = "*" if prefix and i < len(terms) - 1 else ""
+        parts.append((f"{field}:" if field else "") + term + star)
+    return " ".join(parts)
+
+
+class _FieldIndex:
+    """Posting lists and length statistics for a single field.
+
+    ``vocabulary``, once set, is a ``TermIndex`` told about every term the
+    field gains or loses.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.terms = []
+        self.lengths = {}
+        self.total_length = 0
+        self.vocabulary = None
+
+    def add(self, doc_id, tokens):
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            docs = self.postings.get(token)
+            if docs is None:
+                docs = self.postings[token] = {}
+                bisect.insort(self.terms, token)
+                if self.vocabulary is not None:
+                    self.vocabulary.add(token)
+            docs[doc_id] = tf
+        self.lengths[doc_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, doc_id, tokens):
+        for token in set(tokens):
+            docs = self.postings.get(token)
+            if docs is None:
+                continue
+            docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[token]
+                index = bisect.bisect_left(self.terms, token)
+                if index < len(self.terms) and self.terms[index] == token:
+                    del self.terms[index]
+                if self.vocabulary is not None:
+                    self.vocabulary.remove(token)
+        self.total_length -= self.lengths.pop(doc_id, 0)
+
+    def expand(self, term, prefix):
+        """Return index terms matching ``term``, exact match first."""
+        if not prefix:
+            return [term] if term in self.postings else []
+        start = bisect.bisect_left(self.terms, term)
+        # Every term from ``term`` up to the first one past its prefix range.
+        stop = bisect.bisect_left(self.terms, term + '\U0010ffff', start)
+        return self.terms[start:stop]
+
+
+class SearchIndex:
+    """Inverted index over the searchable fields of a set of books."""
+
+    def __init__(self, books=()):
+        self.fields = {field: _FieldIndex() for field in FIELDS}
+        self.documents = {}
+        for book in books:
+            self.add(book)
+        # Built in bulk from the fields' terms, then kept up to date by them.
+        self.vocabulary = TermIndex(term for field in FUZZY_FIELDS for term in self.fields[field].terms)
+        for field in FUZZY_FIELDS:
+            self.fields[field].vocabulary = self.vocabulary
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, book_id):
+        return book_id in self.documents
+
+    def _book_fields(self, book):
+        return tuple(field_text(book, field) for field in FIELDS)
+
+    def add(self, book):
+        """Index a book, replacing any previous version with the same id."""
+        book_id = book['id']
+        texts = self._book_fields(book)
+        previous = self.documents.get(book_id)
+        if previous is not None:
+            if previous == texts:
+                return
+            self.remove(book_id)
+        self.documents[book_id] = texts
+        for field, text in zip(FIELDS, texts):
+            self.fields[field].add(book_id, tokenize(text))
+
+    update = add
+
+    def remove(self, book_id):
+        """Remove a book from the index if present."""
+        texts = self.documents.pop(book_id, None)
+        if texts is None:
+            return
+        for field, text in zip(FIELDS, texts):
+            self.fields[field].remove(book_id, tokenize(text))
+
+    def sync(self, books):
+        """Bring the index in line with ``books``, re-indexing only what changed."""
+        seen = set()
+        for book in books:
+            seen.add(book['id'])
+            self.add(book)
+        for book_id in [i for i in self.documents if i not in seen]:
+            self.remove(book_id)
+
+    def has_term(self, field, term, prefix=False):
+        """True when ``field`` (any field when ``None``) holds ``term``, or with ``prefix`` a word starting with it."""
+        return any(self.fields[name].expand(term, prefix) for name in ([field] if field else FIELDS))
+
+    def _term_books(self, term):
+        # A book holding the word in both its title and author counts twice.
+        return sum(len(self.fields[name].postings.get(term, ())) for name in FUZZY_FIELDS)
+
+    def similar_terms(self, word, limit=None):
+        """Return ``(term, distance, books)`` for the title and author words close to ``word``.
+
+        Closest first, then those in the most books.
+        """
+        found = [(term, distance, self._term_books(term)) for term, distance in self.vocabulary.similar(word)]
+        found.sort(key=lambda item: (item[1], -item[2], item[0]))
+        return found[:limit]
+
+    def complete_terms(self, prefix, limit=None):
+        """Return ``(term, books)`` for the title and author words starting with ``prefix``, most common first."""
+        found = [(term, self._term_books(term)) for term in self.vocabulary.complete(prefix)]
+        found.sort(key=lambda item: (-item[1], item[0]))
+        return found[:limit]
+
+    def _matches(self, field, term, prefix):
+        """Return ``(field, index term, postings)`` for every expansion of a query term."""
+        matches = []
+        for name in ([field] if field else FIELDS):
+            index = self.fields[name]
+            for match in index.expand(term, prefix):
+                matches.append((name, match, index.postings[match]))
+        return matches
+
+    def search(self, query, limit=None):
+        """Return ``(book_id, score)`` pairs for ``query``, best first."""
+        terms = [(term, self._matches(field, term, prefix)) for field, term, prefix in parse_query(query)]
+        if not terms:
+            return []
+        # Start from the most selective term and only score surviving candidates,
+        # so the cost follows the result size rather than the library size.
+        terms.sort(key=lambda item: sum(len(docs) for _, _, docs in item[1]))
+        candidates = set()
+        for _, _, docs in terms[0][1]:
+            candidates.update(docs)
+        for _, matches in terms[1:]:
+            if not candidates:
+                break
+            candidates = {doc_id for doc_id in candidates if any(doc_id in docs for _, _, docs in matches)}
+        scores = dict.fromkeys(candidates, 0.0)
+        total_docs = len(self.documents)
+        for term, matches in terms:
+            for name, match, docs in matches:
+                index = self.fields[name]
+                avg_length = index.total_length / len(index.lengths) or 1.0
+                idf = math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                # Completions of a prefix rank below exact matches.
+                boost = FIELD_WEIGHTS[name] * idf * (1.0 if match == term else 0.5)
+                for doc_id in docs if len(docs) <= len(scores) else scores:
+                    tf = docs.get(doc_id)
+                    if tf is None or doc_id not in scores:
+                        continue
+                    scores[doc_id] += boost * tf * (K1 + 1) / (tf + K1 * (1 - B + B * index.lengths[doc_id] / avg_length))
+        if limit is None:
+            return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,377 @@
+"""Named libraries split into shards."""
+import contextlib
+import contextvars
+import heapq
+import json
+import os
+import re
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+from facets import FACETS, normalize_filters, order_counts
+from repository import LibraryRepository, JsonRepository, SqliteRepository, _sort_key, check_books
+from storage import JournalStore, atomic_write, require_valid_books
+
+LIBRARY_ROOT = "libraries"
+MANIFEST = "library.json"
+DEFAULT_SHARDS = 4
+# Upper bound on the threads one sharded library fans out to.
+MAX_WORKERS = 8
+
+_NAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9 _-]{0,63}$')
+
+
+def shard_of(book_id, shards):
+    return zlib.crc32(str(book_id).encode('utf-8')) % shards
+
+
+def _merge_key(sort_by):
+    """Return the key that orders books from different shards like each shard does: by ``sort_by``, then id."""
+    key = _sort_key(sort_by)
+    return lambda book: (key(book.get(sort_by)), book['id'])
+
+
+def _read_spool(spool):
+    """Yield the books written to ``spool`` as JSON lines, from the start."""
+    spool.seek(0)
+    for line in spool:
+        yield json.loads(line)
+
+
+def list_libraries(root=LIBRARY_ROOT):
+    """Return the names of the named libraries under ``root``, sorted."""
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name for name in os.listdir(root)
+        if os.path.exists(os.path.join(root, name, MANIFEST))
+    )
+
+
+def create_library(root, name, shards=DEFAULT_SHARDS, backend='json'):
+    """Create an empty named library and return its directory.
+
+    Raises ``ValueError`` for an invalid or existing name.
+    """
+    if not _NAME_RE.match(name or ''):
+        raise ValueError("Library names use letters, digits, spaces, '-' and '_' (at most 64 characters)")
+    if backend not in ('json', 'sqlite'):
+        raise ValueError(f"Unsupported backend: {backend}")
+    if shards < 1:
+        raise ValueError("A library needs at least one shard")
+    path = os.path.join(root, name)
+    if os.path.exists(os.path.join(path, MANIFEST)):
+        raise ValueError(f"Library '{name}' already exists")
+    os.makedirs(path, exist_ok=True)
+    manifest = json.dumps({'shards': shards, 'backend': backend})
+    atomic_write(os.path.join(path, MANIFEST), lambda f: f.write(manifest))
+    return path
+
+
+class ShardedRepository(LibraryRepository):
+    """A library whose books are partitioned over several repositories."""
+
+    def __init__(self, shards, lists, workers=None):
+        self.shards = shards
+        self.lists = lists
+        self.lock = threading.RLock()
+        # Recommendation features over every shard, and the version they were read at.
+        self._feature_index = None
+        self._feature_version = None
+        # Thread holding an open batch; its calls run inline, since the parts' locks are its own.
+        self._batch_thread = None
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers or min(len(shards), MAX_WORKERS),
+            thread_name_prefix="shard"
+        )
+
+    @classmethod
+    def open(cls, path, binary_snapshot=True):
+        """Open the named library in directory ``path``, loading its shards in parallel."""
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        names = [f"shard-{i:02d}" for i in range(manifest['shards'])] + ["lists"]
+        if manifest.get('backend', 'json') == 'sqlite':
+            def open_part(name):
+                return SqliteRepository(os.path.join(path, name + ".db"))
+        else:
+            def open_part(name):
+                return JsonRepository.open(JournalStore(os.path.join(path, name + ".json"), binary_snapshot=binary_snapshot))
+        with ThreadPoolExecutor(max_workers=min(len(names), MAX_WORKERS)) as pool:
+            parts = list(pool.map(open_part, names))
+        return cls(parts[:-1], parts[-1])
+
+    def _shard(self, book_id):
+        return self.shards[shard_of(book_id, len(self.shards))]
+
+    def _map(self, function, items=None):
+        """Call ``function`` on every shard (or on each of ``items``) in parallel, in order."""
+        items = self.shards if items is None else items
+        if self._batch_thread == threading.get_ident():
+            return [function(item) for item in items]
+        # Each call runs in a copy of the caller's context, so rerun metrics see the shards' I/O.
+        contexts = [contextvars.copy_context() for _ in items]
+        return list(self.pool.map(lambda context, item: context.run(function, item), contexts, items))
+
+    def _group(self, items, key):
+        """Split ``items`` into ``(shard, items)`` pairs by the book id ``key`` returns."""
+        groups = {}
+        for item in items:
+            groups.setdefault(shard_of(key(item), len(self.shards)), []).append(item)
+        return [(self.shards[index], group) for index, group in groups.items()]
+
+    # Reads
+
+    def count_books(self, read=None):
+        # Counters are kept per shard, so summing them is cheaper than a fan-out.
+        return sum(shard.count_books(read) for shard in self.shards)
+
+    def count_distinct(self, field):
+        return len(self.distinct_keys(field))
+
+    def distinct_keys(self, field):
+        return set().union(*(shard.distinct_keys(field) for shard in self.shards))
+
+    def genre_counts(self):
+        counts = {}
+        for shard in self.shards:
+            for genre, count in shard.genre_counts():
+                counts[genre] = counts.get(genre, 0) + count
+        return sorted(counts.items(), key=lambda item: item[1], reverse=True)
+
+    def get_books(self, book_ids):
+        book_ids = list(book_ids)
+        found = {}
+        for books in self._map(lambda item: item[0].get_books(item[1]), self._group(book_ids, lambda book_id: book_id)):
+            found.update((book['id'], book) for book in books)
+        return [found[book_id] for book_id in book_ids if book_id in found]
+
+    def get_book(self, book_id):
+        return self._shard(book_id).get_book(book_id)
+
+    def book_collections(self, book_id):
+        return self.lists.book_collections(book_id)
+
+    def find_duplicates(self, books):
+        books = list(books)
+        # A duplicate may sit in any shard; take the first shard's match per book.
+        matches = self._map(lambda shard: shard.find_duplicates(books))
+        return [next((found for found in column if found is not None), None) for column in zip(*matches)]
+
+    def in_reading_list(self, book_id):
+        return self.lists.in_reading_list(book_id)
+
+    def in_collection(self, name, book_id):
+        return self.lists.in_collection(name, book_id)
+
+    def query_books(self, read=None, sort_by='title', descending=False, limit=None, offset=0):
+        # Each shard returns its own first offset + limit books; merging the
+        # sorted runs gives the global page.
+        stop = None if limit is None else offset + limit
+        runs = self._map(lambda shard: shard.query_books(read=read, sort_by=sort_by, descending=descending, limit=stop))
+        merged = heapq.merge(*runs, key=_merge_key(sort_by), reverse=descending)
+        return list(islice(merged, offset, stop))
+
+    def _resolve_collections(self, filters):
+        """Replace a collection facet by the ids of its books, since shards hold no collections."""
+        if 'collection' not in filters:
+            return filters
+        filters = dict(filters)
+        collections = self.lists.collections()
+        book_ids = {book_id for name in filters.pop('collection') for book_id in collections.get(name, ())}
+        if 'ids' in filters:
+            book_ids &= set(filters['ids'])
+        filters['ids'] = tuple(book_ids)
+        return filters
+
+    def filter_books(self, filters=None, sort_by='title', descending=False, limit=None, offset=0, after=None):
+        filters = self._resolve_collections(normalize_filters(filters))
+        stop = None if limit is None else offset + limit
+        runs = self._map(
+            lambda shard: shard.filter_books(filters, sort_by=sort_by, descending=descending, limit=stop, after=after)
+        )
+        merged = heapq.merge(*(books for _, books in runs), key=_merge_key(sort_by), reverse=descending)
+        return sum(total for total, _ in runs), list(islice(merged, offset, stop))
+
+    def facet_counts(self, filters=None):
+        filters = normalize_filters(filters)
+        resolved = self._resolve_collections(filters)
+        others = {name: value for name, value in filters.items() if name != 'collection'}
+        collections = self.lists.collections()
+
+        def count(shard):
+            counts = shard.facet_counts(resolved)
+            # Collection counts need each collection's books under the other facets.
+            counts['collection'] = {}
+            for name, book_ids in collections.items():
+                restricted = set(book_ids) & set(others['ids']) if 'ids' in others else book_ids
+                counts['collection'][name] = shard.filter_books(dict(others, ids=tuple(restricted)), limit=0)[0]
+            return counts
+
+        totals = {field: {} for field in FACETS}
+        for counts in self._map(count):
+            for field in FACETS:
+                pairs = counts[field].items() if field == 'collection' else counts[field]
+                for value, found in pairs:
+                    totals[field][value] = totals[field].get(value, 0) + found
+        return {field: order_counts(field, totals[field]) for field in FACETS}
+
+    def recent_books(self, limit):
+        runs = self._map(lambda shard: shard.recent_books(limit))
+        merged = heapq.merge(*runs, key=lambda book: str(book.get('date_added', '0')), reverse=True)
+        return list(islice(merged, limit))
+
+    def search_books(self, query, limit=None, offset=0):
+        stop = None if limit is None else offset + limit
+        return [book for book, _ in self.search_hits(query, stop)[offset:]]
+
+    def search_hits(self, query, limit=None):
+        runs = self._map(lambda shard: shard.search_hits(query, limit))
+        return list(islice(heapq.merge(*runs, key=lambda hit: hit[1], reverse=True), limit))
+
+    def has_term(self, field, term, prefix=False):
+        return any(self._map(lambda shard: shard.has_term(field, term, prefix)))
+
+    def similar_terms(self, word, limit=None):
+        # A word is equally far from ``word`` on every shard; only its book counts add up.
+        found = {}
+        for run in self._map(lambda shard: shard.similar_terms(word)):
+            for term, distance, books in run:
+                found[term] = (distance, found.get(term, (distance, 0))[1] + books)
+        ranked = sorted(found.items(), key=lambda item: (item[1][0], -item[1][1], item[0]))
+        return [(term, distance, books) for term, (distance, books) in ranked[:limit]]
+
+    def complete_terms(self, prefix, limit=None):
+        found = {}
+        for run in self._map(lambda shard: shard.complete_terms(prefix)):
+            for term, books in run:
+                found[term] = found.get(term, 0) + books
+        return sorted(found.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+    def collections(self):
+        return self.lists.collections()
+
+    def reading_list(self):
+        return self.lists.reading_list()
+
+    def export_data(self):
+        return {
+            'books': list(self.iter_books()),
+            'collections': self.collections(),
+            'reading_list': self.reading_list()
+        }
+
+    def iter_books(self, batch_size=1000):
+        return chain.from_iterable(shard.iter_books(batch_size) for shard in self.shards)
+
+    def book_frame(self, columns=None):
+        import pandas as pd
+        from pandas.api.types import union_categoricals
+
+        frames = self._map(lambda shard: shard.book_frame(columns))
+        data = {}
+        for name in frames[0].columns:
+            parts = [frame[name] for frame in frames]
+            if isinstance(parts[0].dtype, pd.CategoricalDtype):
+                data[name] = union_categoricals(parts)
+            else:
+                data[name] = pd.concat(parts, ignore_index=True)
+        return pd.DataFrame(data)
+
+    @property
+    def version(self):
+        # Every part's version only grows, so their sum changes on any write.
+        return sum(shard.version for shard in self.shards) + self.lists.version
+
+    def is_stale(self):
+        return any(part.is_stale() for part in self.shards + [self.lists])
+
+    def refresh(self, load=None):
+        # Each part reloads from its own files; ``load`` only applies to a single-file library.
+        stale = [part for part in self.shards + [self.lists] if part.is_stale()]
+        self._map(lambda part: part.refresh(), stale)
+
+    # Writes
+
+    def add_books(self, books):
+        self._map(lambda item: item[0].add_books(item[1]), self._group(check_books(books), lambda book: book['id']))
+
+    def update_book(self, book_id, changes):
+        return self._shard(book_id).update_book(book_id, changes)
+
+    def delete_book(self, book_id):
+        if not self._shard(book_id).delete_book(book_id):
+            return False
+        for name in self.lists.book_collections(book_id):
+            self.lists.remove_from_collection(name, [book_id])
+        self.lists.remove_from_reading_list([book_id])
+        return True
+
+    def set_collection(self, name, book_ids):
+        self.lists.set_collection(name, book_ids)
+
+    def delete_collection(self, name):
+        self.lists.delete_collection(name)
+
+    def add_to_collection(self, name, book_ids, position=None):
+        self.lists.add_to_collection(name, book_ids, position)
+
+    def remove_from_collection(self, name, book_ids):
+        self.lists.remove_from_collection(name, book_ids)
+
+    def move_in_collection(self, name, book_ids, position):
+        self.lists.move_in_collection(name, book_ids, position)
+
+    def add_to_reading_list(self, book_ids, position=None):
+        self.lists.add_to_reading_list(book_ids, position)
+
+    def remove_from_reading_list(self, book_ids):
+        self.lists.remove_from_reading_list(book_ids)
+
+    def move_in_reading_list(self, book_ids, position):
+        self.lists.move_in_reading_list(book_ids, position)
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Each part stores the block's writes together; the parts commit one
+        # after another, so the batch is atomic per shard, not across shards.
+        with self.lock, contextlib.ExitStack() as stack:
+            if self._batch_thread is not None:
+                yield
+                return
+            for part in self.shards + [self.lists]:
+                stack.enter_context(part.batch())
+            self._batch_thread = threading.get_ident()
+            try:
+                yield
+            finally:
+                self._batch_thread = None
+
+    def replace(self, data):
+        # Every book is checked and routed to a spool file before any part
+        # changes, and the current books are spooled too, so a part failing
+        # to take its books puts every part back.
+        with contextlib.ExitStack() as stack:
+            staged = [stack.enter_context(tempfile.TemporaryFile('w+')) for _ in self.shards]
+            saved = [stack.enter_context(tempfile.TemporaryFile('w+')) for _ in self.shards]
+            for book in require_valid_books(data.get('books', [])):
+                staged[shard_of(book['id'], len(self.shards))].write(json.dumps(book) + "\n")
+            for shard, spool in zip(self.shards, saved):
+                spool.writelines(json.dumps(dict(book)) + "\n" for book in shard.iter_books())
+            lists = {'collections': self.collections(), 'reading_list': self.reading_list()}
+            try:
+                self._replace_parts(staged, data.get('collections', {}), data.get('reading_list', []))
+            except BaseException:
+                self._replace_parts(saved, lists['collections'], lists['reading_list'])
+                raise
+
+    def _replace_parts(self, spools, collections, reading_list):
+        """Replace each shard with the books of its spool file, then the lists part with the lists."""
+        self._map(
+            lambda item: item[0].replace({'books': _read_spool(item[1]), 'collections': {}, 'reading_list': []}),
+            list(zip(self.shards, spools))
+        )
+        self.lists.replace({'books': [], 'collections': collections, 'reading_list': reading_list})
@@ -0,0 +1,89 @@
+"""Incrementally maintained library statistics."""
+import bisect
+
+# Number of most recent additions kept ready for the Dashboard.
+RECENT_CAPACITY = 50
+
+
+def _bump(counts, key, delta):
+    value = counts.get(key, 0) + delta
+    if value > 0:
+        counts[key] = value
+    else:
+        counts.pop(key, None)
+
+
+class LibraryStats:
+    """Running counters over a set of books."""
+
+    def __init__(self, books=(), recent_capacity=RECENT_CAPACITY):
+        self.recent_capacity = recent_capacity
+        self.total = 0
+        self.read = 0
+        # Exact genre values, as charted on the Statistics page.
+        self.genres = {}
+        # Case-insensitive, non-empty genre and author values, as counted on the Dashboard.
+        self.genre_keys = {}
+        self.author_keys = {}
+        # Ascending (date_added, id) pairs of the newest books.
+        self.recent = []
+        self.recent_complete = True
+        for book in books:
+            self.add(book)
+
+    def _update(self, book, delta):
+        self.total += delta
+        if book.get('read', False):
+            self.read += delta
+        genre = book.get('genre')
+        if genre is not None:
+            _bump(self.genres, genre, delta)
+        if genre:
+            _bump(self.genre_keys, str(genre).lower(), delta)
+        author = book.get('author')
+        if author:
+            _bump(self.author_keys, str(author).lower(), delta)
+
+    def _offer_recent(self, entry):
+        if len(self.recent) < self.recent_capacity:
+            bisect.insort(self.recent, entry)
+        elif entry > self.recent[0]:
+            bisect.insort(self.recent, entry)
+            del self.recent[0]
+
+    def add(self, book):
+        self._update(book, 1)
+        entry = (str(book.get('date_added', '0')), book['id'])
+        # A window that lost entries to removals cannot take books older than its oldest.
+        if self.recent_complete or (self.recent and entry > self.recent[0]):
+            self._offer_recent(entry)
+
+    def remove(self, book):
+        self._update(book, -1)
+        entry = (str(book.get('date_added', '0')), book['id'])
+        index = bisect.bisect_left(self.recent, entry)
+        if index < len(self.recent) and self.recent[index] == entry:
+            del self.recent[index]
+            if self.total > len(self.recent):
+                self.recent_complete = False
+
+    @property
+    def unread(self):
+        return self.total - self.read
+
+    def genre_counts(self):
+        """Return ``(genre, count)`` pairs, most common first."""
+        return sorted(self.genres.items(), key=lambda item: item[1], reverse=True)
+
+    def recent_ids(self, limit):
+        """Return the ids of the newest ``limit`` books, or ``None`` if the window needs a refill."""
+        if limit > len(self.recent) and not self.recent_complete:
+            return None
+        return [book_id for _, book_id in reversed(self.recent[-limit:])] if limit > 0 else []
+
+    def refill_recent(self, books):
+        """Rebuild the recent-additions window from the full book list."""
+        self.recent = []
+        self.recent_complete = True
+        for book in books:
+            self._offer_recent((str(book.get('date_added', '0')), book['id']))
@@ -0,0 +1,595 @@
+"""Append-only journal storage for the library file."""
+import contextlib
+import json
+import os
+import pickle
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from itertools import islice
+
+from indexes import OrderedIdSet
+from instrumentation import add_counter
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within one process.
+    fcntl = None
+
+# How long a writer waits for the library lock before giving up, and the first retry delay.
+LOCK_TIMEOUT = 10.0
+LOCK_RETRY_DELAY = 0.005
+
+# Books encoded per json.dumps call when a snapshot is written.
+COMPACT_BATCH = 5000
+
+# Version of the snapshot layout; snapshots marked with an older one, or none, are checked and migrated on load.
+SCHEMA_VERSION = 1
+
+
+class StoreBusyError(RuntimeError):
+    """Raised when the library lock cannot be taken within the timeout."""
+
+
+def empty_library():
+    """Return a new, empty library structure."""
+    return {
+        'books': [],
+        'collections': {},
+        'reading_list': []
+    }
+
+
+def atomic_write(path, write, mode='w'):
+    """Write a file atomically by writing to a temp file and renaming it over ``path``."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class QuarantineReport:
+    """The entries of a library that failed validation on load, and the repairs made to the rest."""
+
+    def __init__(self):
+        self.checked = 0
+        self.ids_assigned = 0
+        # ``{'index', 'reason', 'entry'}`` per entry set aside; ``index`` is None for the lists.
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, index, reason, entry):
+        self.entries.append({'index': index, 'reason': reason, 'entry': entry})
+
+    def write(self, path):
+        """Add the entries to the quarantine file at ``path``, keeping any set aside by earlier loads."""
+        entries = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                entries = json.load(f).get('entries', [])
+        report = {
+            'updated': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'checked': self.checked,
+            'ids_assigned': self.ids_assigned,
+            'entries': entries + self.entries
+        }
+        atomic_write(path, lambda f: json.dump(report, f))
+
+
+def read_quarantine(path):
+    """Return the quarantine report stored at ``path``, or ``None`` if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def validate_books(books, report):
+    """Yield the well-formed books of ``books``, giving those without an id a new one.
+
+    Anything else goes into ``report``.  Books are checked as they stream
+    through, so the input is never held in full.
+    """
+    for index, book in enumerate(books):
+        report.checked += 1
+        if not isinstance(book, dict):
+            report.add(index, "not a JSON object", book)
+            continue
+        if 'id' not in book:
+            book['id'] = str(uuid.uuid4())
+            report.ids_assigned += 1
+        elif not isinstance(book['id'], str):
+            report.add(index, "id is not a string", book)
+            continue
+        yield book
+
+
+def require_valid_books(books):
+    """Yield ``books`` checked as ``validate_books`` does, raising ``ValueError`` at the first one it would set aside."""
+    report = QuarantineReport()
+    for book in validate_books(books, report):
+        if report.entries:
+            break
+        yield book
+    if report.entries:
+        entry = report.entries[0]
+        raise ValueError(f"Book {entry['index']} is invalid: {entry['reason']}")
+
+
+def _edit_list(book_ids, record, action):
+    """Return the list ``book_ids`` with the ids of ``record`` added, removed or moved, as ``OrderedIdSet`` does."""
+    ordered = OrderedIdSet(book_ids)
+    if action == 'add':
+        ordered.add(record['ids'], record.get('position'))
+    elif action == 'remove':
+        ordered.remove(record['ids'])
+    else:
+        ordered.move(record['ids'], record['position'])
+    return ordered.ids()
+
+
+def _book_positions(books):
+    return {book.get('id'): i for i, book in enumerate(books) if isinstance(book, dict)}
+
+
+def apply_change(data, record, positions=None):
+    """Apply a single journal record to ``data`` in place.
+
+    ``positions`` is an optional id -> list index map for ``data['books']``;
+    it is kept up to date so that replaying many records stays linear.
+    """
+    books = data['books']
+    if positions is None:
+        positions = _book_positions(books)
+    op = record.get('op')
+
+    if op in ('add_book', 'add_books'):
+        for book in ([record['book']] if op == 'add_book' else record['books']):
+            index = positions.get(book.get('id'))
+            if index is None:
+                positions[book.get('id')] = len(books)
+                books.append(book)
+            else:
+                books[index] = book
+    elif op == 'update_book':
+        index = positions.get(record['id'])
+        if index is not None:
+            books[index].update(record['changes'])
+    elif op == 'delete_book':
+        index = positions.pop(record['id'], None)
+        if index is not None:
+            # Swap-remove keeps deletion O(1); book order is not significant.
+            last = books.pop()
+            if index < len(books):
+                books[index] = last
+                positions[last.get('id')] = index
+            for ids in data['collections'].values():
+                if record['id'] in ids:
+                    ids[:] = [i for i in ids if i != record['id']]
+            if record['id'] in data['reading_list']:
+                data['reading_list'] = [i for i in data['reading_list'] if i != record['id']]
+    elif op == 'set_collection':
+        data['collections'][record['name']] = list(dict.fromkeys(record['ids']))
+    elif op == 'delete_collection':
+        data['collections'].pop(record['name'], None)
+    elif op in ('collection_add', 'collection_remove', 'collection_move'):
+        name = record['name']
+        if name in data['collections'] or op == 'collection_add':
+            data['collections'][name] = _edit_list(data['collections'].get(name, []), record, op.split('_')[1])
+    elif op in ('reading_list_add', 'reading_list_remove', 'reading_list_move'):
+        data['reading_list'] = _edit_list(data['reading_list'], record, op.split('_')[-1])
+    elif op == 'set_reading_list':
+        data['reading_list'] = list(record['ids'])
+    elif op == 'batch':
+        for change in record['records']:
+            apply_change(data, change, positions)
+    else:
+        raise ValueError(f"Unknown journal operation: {op!r}")
+    return data
+
+
+def apply_journal(data):
+    """Materialize ``data['books']`` as a list and apply the pending ``data['journal']`` records to it."""
+    books = data['books']
+    data['books'] = books if isinstance(books, list) else list(books)
+    positions = _book_positions(data['books'])
+    for record in data.pop('journal', []):
+        apply_change(data, record, positions)
+    return data
+
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_ARRAY_PREFIX_RE = re.compile(r'[ \t\n\r]*\[')
+_SNAPSHOT_PREFIX_RE = re.compile(r'[ \t\n\r]*\{[ \t\n\r]*"generation"')
+_SNAPSHOT_GENERATION_RE = re.compile(rb'[ \t\n\r]*\{[ \t\n\r]*"generation"[ \t\n\r]*:[ \t\n\r]*"([0-9a-f]+)"')
+_SNAPSHOT_SUFFIX_RE = re.compile(r'\][ \t\n\r]*\}[ \t\n\r]*\Z')
+
+
+def _iter_array(text, index, decode):
+    """Yield the values of the JSON array whose first element starts at ``index``."""
+    skip = _WHITESPACE_RE.match
+    while True:
+        index = skip(text, index).end()
+        if text[index] == ']':
+            return
+        value, index = decode(text, index)
+        yield value
+        index = skip(text, index).end()
+        if text[index] == ',':
+            index += 1
+
+
+def _iter_books(text, index, decode):
+    """Yield the books of a snapshot whose ``books`` array is its last key."""
+    skip = _WHITESPACE_RE.match
+    while True:
+        index = skip(text, index).end()
+        if text[index] == ']':
+            break
+        value, index = decode(text, index)
+        yield value
+        index = skip(text, index).end()
+        if text[index] == ',':
+            index += 1
+    index = skip(text, index + 1).end()
+    if text[index:index + 1] != '}':
+        raise json.JSONDecodeError("Expected '}' after the books array", text, index)
+
+
+def _decode_snapshot(text):
+    """Decode a snapshot, leaving a trailing ``books`` array as a lazy iterator.
+
+    Snapshots written by ``compact`` start with their generation and end with
+    the books, so the books can be decoded one at a time while the table that
+    holds them is built.  A legacy file holding only a list of books is
+    streamed the same way.  Any other JSON is decoded in full.
+    """
+    decode = json.JSONDecoder().raw_decode
+    prefix = _ARRAY_PREFIX_RE.match(text)
+    if prefix:
+        return {'books': _iter_array(text, prefix.end(), decode)}
+    if not (_SNAPSHOT_PREFIX_RE.match(text) and _SNAPSHOT_SUFFIX_RE.search(text)):
+        return json.loads(text)
+    skip = _WHITESPACE_RE.match
+    data = {}
+    index = skip(text, 0).end() + 1
+    while True:
+        index = skip(text, index).end()
+        if text[index] == '}':
+            return data
+        key, index = decode(text, index)
+        index = skip(text, index).end() + 1
+        index = skip(text, index).end()
+        if key == 'books' and text[index] == '[':
+            data['books'] = _iter_books(text, index + 1, decode)
+            return data
+        data[key], index = decode(text, index)
+        index = skip(text, index).end()
+        if text[index] == ',':
+            index += 1
+
+
+class JournalStore:
+    """Snapshot + append-only journal storage for a library file."""
+
+    def __init__(self, path, compact_ratio=0.5, min_compact_bytes=1 << 20, lock_timeout=LOCK_TIMEOUT,
+                 binary_snapshot=True):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.lock_path = path + ".lock"
+        self.binary_path = path + ".pickle"
+        self.quarantine_path = path + ".quarantine"
+        self.binary_snapshot = binary_snapshot
+        self.compact_ratio = compact_ratio
+        self.min_compact_bytes = min_compact_bytes
+        self.lock_timeout = lock_timeout
+        self.generation = None
+        # Number of operations applied to the library since it was created.
+        self.version = 0
+        # Journal byte offset up to which records have been applied.
+        self.offset = 0
+        # Schema version of the snapshot last opened, whether it must be rewritten
+        # with the current one, and the entries its checks set aside.
+        self.schema = None
+        self.needs_migration = False
+        self.quarantine = QuarantineReport()
+        self._thread_lock = threading.RLock()
+        self._lock_file = None
+        self._lock_depth = 0
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the advisory lock on the library files; reentrant within a process.
+
+        Waiting writers retry with jittered exponential backoff and raise
+        ``StoreBusyError`` after ``lock_timeout`` seconds.
+        """
+        with self._thread_lock:
+            if self._lock_depth == 0:
+                self._acquire()
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    self._release()
+
+    def _acquire(self):
+        f = open(self.lock_path, 'a')
+        if fcntl is not None:
+            deadline = time.monotonic() + self.lock_timeout
+            delay = LOCK_RETRY_DELAY
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        f.close()
+                        raise StoreBusyError(f"Timed out waiting for the lock on {self.path}")
+                    time.sleep(delay * (0.5 + random.random()))
+                    delay = min(delay * 2, 0.2)
+        self._lock_file = f
+
+    def _release(self):
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def open(self):
+        """Read the snapshot without decoding all of its books up front.
+
+        Returns the library data with ``books`` as an iterator over the
+        snapshot's books and ``journal`` as the list of journal records still
+        to be applied on top of them (``apply_journal`` does that for plain
+        dicts).  Unless the snapshot carries the current schema version, the
+        books are validated as they are read (see ``validate_books``) into
+        ``quarantine``, and ``needs_migration`` is set.  Raises
+        ``json.JSONDecodeError`` for a corrupt snapshot.
+        """
+        with self.locked():
+            self.needs_migration = False
+            self.quarantine = QuarantineReport()
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    add_counter('bytes_read', os.fstat(f.fileno()).st_size)
+                    data = _decode_snapshot(f.read())
+            else:
+                data = empty_library()
+
+            if isinstance(data, list):
+                data = {'books': data, 'collections': {}, 'reading_list': []}
+            if not isinstance(data, dict):
+                return data
+            self.generation = data.pop('generation', None)
+            self.version = data.pop('version', 0)
+            self.schema = data.pop('schema', None)
+            self.offset = 0
+            data.setdefault('books', [])
+            data.setdefault('collections', {})
+            data.setdefault('reading_list', [])
+            if isinstance(data['books'], list):
+                data['books'] = iter(data['books'])
+            elif not isinstance(data['books'], Iterator):
+                data['books'] = iter(())
+            if self.schema != SCHEMA_VERSION and os.path.exists(self.path):
+                self._validate(data)
+
+            records = self._read_records() if os.path.exists(self.journal_path) else None
+            if records is None:
+                # No journal, or one that predates the current snapshot and is already folded in.
+                self._start_journal()
+                records = []
+            data['journal'] = records
+            return data
+
+    def _validate(self, data):
+        """Check ``data`` read from an unmarked or older snapshot, setting aside what is not valid."""
+        self.needs_migration = True
+        if not isinstance(data['collections'], dict):
+            self.quarantine.add(None, "collections is not a JSON object", data['collections'])
+            data['collections'] = {}
+        if not isinstance(data['reading_list'], list):
+            self.quarantine.add(None, "reading_list is not a JSON array", data['reading_list'])
+            data['reading_list'] = []
+        data['books'] = validate_books(data['books'], self.quarantine)
+
+    def write_quarantine(self):
+        """Save the entries the last ``open`` set aside, if any, to ``quarantine_path``."""
+        if self.quarantine:
+            self.quarantine.write(self.quarantine_path)
+
+    def read_binary(self):
+        """Read the binary snapshot if it matches the current JSON snapshot.
+
+        Returns ``(state, records)``: the object passed to ``write_binary`` and the
+        journal records appended after it, or ``None`` when there is no usable
+        binary snapshot.
+        """
+        if not self.binary_snapshot:
+            return None
+        with self.locked():
+            try:
+                with open(self.path, 'rb') as f:
+                    match = _SNAPSHOT_GENERATION_RE.match(f.read(256))
+                if match is None or not os.path.exists(self.journal_path):
+                    return None
+                with open(self.binary_path, 'rb') as f:
+                    add_counter('bytes_read', os.fstat(f.fileno()).st_size)
+                    payload = pickle.load(f)
+                generation = payload['generation']
+                if generation != match.group(1).decode('ascii') or os.path.getsize(self.journal_path) < payload['offset']:
+                    return None
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, TypeError):
+                return None
+            self.generation = generation
+            self.version = payload['version']
+            self.offset = payload['offset']
+            records = self._read_records()
+            if records is None:
+                return None
+            return payload['state'], records
+
+    def write_binary(self, state):
+        """Write ``state`` as the binary snapshot of the library as of the current journal offset.
+
+        Call with the lock held and every journal record applied to ``state``.
+        """
+        if not self.binary_snapshot:
+            return
+        with self.locked():
+            payload = {'generation': self.generation, 'version': self.version, 'offset': self.offset, 'state': state}
+            atomic_write(self.binary_path, lambda f: pickle.dump(payload, f, protocol=5), mode='wb')
+            add_counter('bytes_written', os.path.getsize(self.binary_path))
+
+    def load(self):
+        """Load the snapshot and replay the journal on top of it.
+
+        Returns the raw library data with ``books`` as a list; validation of
+        individual books is left to the caller.  Raises
+        ``json.JSONDecodeError`` for a corrupt snapshot.
+        """
+        with self.locked():
+            data = self.open()
+            if not isinstance(data, dict):
+                return data
+            replayed = len(data['journal'])
+            apply_journal(data)
+            if replayed and self.needs_compaction():
+                self.compact(data)
+            return data
+
+    def _read_records(self):
+        """Read the complete journal records past ``offset`` and advance it.
+
+        Returns ``None`` if the journal belongs to a different snapshot generation.
+        """
+        with open(self.journal_path, 'rb') as f:
+            header = f.readline()
+            try:
+                if json.loads(header).get('generation') != self.generation:
+                    return None
+            except (ValueError, AttributeError):
+                return None
+            self.offset = max(self.offset, len(header))
+            f.seek(self.offset)
+            records = []
+            start = self.offset
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A torn final line from an interrupted append.
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                records.append(record)
+                self.offset += len(line)
+                self.version = record.get('version', self.version + 1)
+        add_counter('bytes_read', len(header) + self.offset - start)
+        return records
+
+    def read_changes(self):
+        """Return the records other processes appended since this store last read or wrote.
+
+        Returns ``None`` when another process compacted the library into a new
+        snapshot; the caller must then ``load()`` it again.  Call with the lock held.
+        """
+        if not os.path.exists(self.journal_path):
+            return []
+        return self._read_records()
+
+    def _start_journal(self):
+        header = json.dumps({'generation': self.generation}) + "\n"
+        atomic_write(self.journal_path, lambda f: f.write(header))
+        self.offset = len(header.encode('utf-8'))
+
+    def append(self, op, **payload):
+        """Append one operation record to the journal.
+
+        The caller should hold the lock and have applied ``read_changes()``
+        first, so that the record is stamped after every earlier operation.
+        """
+        with self.locked():
+            self.version += 1
+            record = dict(payload, op=op, version=self.version)
+            line = (json.dumps(record) + "\n").encode('utf-8')
+            if not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) == 0:
+                self._start_journal()
+            with open(self.journal_path, 'ab') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+                self.offset = f.tell()
+            add_counter('bytes_written', len(line))
+            return len(line)
+
+    def signature(self):
+        """Return the modification time and size of the snapshot and journal, to detect outside writes."""
+        stamps = []
+        for path in (self.path, self.journal_path):
+            try:
+                stat = os.stat(path)
+                stamps.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def needs_compaction(self):
+        """True when the journal has grown large relative to the snapshot."""
+        try:
+            journal_bytes = os.path.getsize(self.journal_path)
+        except OSError:
+            return False
+        try:
+            snapshot_bytes = os.path.getsize(self.path)
+        except OSError:
+            snapshot_bytes = 0
+        return journal_bytes > max(self.min_compact_bytes, snapshot_bytes * self.compact_ratio)
+
+    def compact(self, data):
+        """Write ``data`` as a new snapshot and start an empty journal."""
+        with self.locked():
+            self.generation = uuid.uuid4().hex
+            self.schema = SCHEMA_VERSION
+            snapshot = {'generation': self.generation, 'version': self.version, 'schema': self.schema}
+            snapshot.update((key, value) for key, value in data.items() if key != 'books')
+            books = data.get('books', [])
+
+            def write(f):
+                # Books go last so that open() can stream them.  They may be any
+                # iterable and are encoded in batches with json.dumps (the C
+                # encoder; json.dump goes through the pure-Python one).
+                f.write('{')
+                for key, value in snapshot.items():
+                    f.write(f'{json.dumps(key)}: {json.dumps(value)}, ')
+                f.write('"books": [')
+                books_iter = iter(books)
+                separator = ''
+                while True:
+                    batch = list(islice(books_iter, COMPACT_BATCH))
+                    if not batch:
+                        break
+                    f.write(separator + json.dumps(batch)[1:-1])
+                    separator = ', '
+                f.write(']}')
+
+            atomic_write(self.path, write)
+            add_counter('bytes_written', os.path.getsize(self.path))
+            self._start_journal()
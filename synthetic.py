@@ -0,0 +1,138 @@
+"""Synthetic libraries for benchmarks and load testing.
+
+    python synthetic.py 100000 library.json
+"""
+import argparse
+import hashlib
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from storage import JournalStore
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# (genre, relative weight)
+GENRES = [
+    ("Fiction", 30), ("Mystery", 12), ("Fantasy", 10), ("Science Fiction", 9), ("Romance", 9),
+    ("Non-Fiction", 8), ("Biography", 5), ("History", 5), ("Thriller", 4), ("Self-Help", 3),
+    ("Poetry", 2), ("Philosophy", 1), ("Travel", 1), ("Cooking", 1),
+]
+
+FIRST_NAMES = [
+    "Ada", "Alan", "Amara", "Ana", "Ben", "Carmen", "Chen", "Clara", "David", "Elena", "Emeka", "Farah",
+    "George", "Hana", "Hugo", "Ines", "Ivan", "James", "Jun", "Kofi", "Laila", "Leo", "Maria", "Mei",
+    "Nadia", "Omar", "Priya", "Rosa", "Sam", "Sofia", "Tomas", "Yara",
+]
+LAST_NAMES = [
+    "Abe", "Adeyemi", "Berg", "Castro", "Dubois", "Evans", "Fischer", "Garcia", "Haddad", "Ito",
+    "Jensen", "Khan", "Kowalski", "Lopez", "Mensah", "Morel", "Nakamura", "Novak", "Okafor", "Park",
+    "Quinn", "Rossi", "Sato", "Schmidt", "Silva", "Tanaka", "Umar", "Varga", "Wong", "Yilmaz",
+]
+
+TITLE_WORDS = [
+    "Silent", "Broken", "Hidden", "Last", "Golden", "Winter", "Crimson", "Distant", "Secret", "Lost",
+    "River", "Garden", "Empire", "Shadow", "City", "Night", "House", "Ocean", "Mountain", "Letter",
+    "Storm", "Crown", "Mirror", "Road", "Star", "Forest", "Island", "Song", "Machine", "Memory",
+]
+
+TAGS = [
+    "classic", "favorite", "award-winner", "series", "book-club", "gift", "signed", "borrowed",
+    "reread", "audiobook", "ebook", "translated", "short", "long", "illustrated", "debut",
+]
+
+COLLECTION_NAMES = [
+    "Favorites", "Summer Reads", "To Lend", "Book Club", "Classics", "Gifts", "Work", "Holiday",
+    "Kids", "Research", "Rainy Days", "Travel", "Signed Copies", "Wishlist", "Series", "Shelf A",
+]
+
+# Ratings 1-5 are given to about half the books, skewed towards 3 and 4.
+RATING_WEIGHTS = [50, 2, 5, 13, 18, 12]
+
+
+def book_id(index, seed=0):
+    """Return the deterministic, uuid4-shaped id of book ``index``."""
+    return str(uuid.UUID(bytes=hashlib.md5(f"{seed}:{index}".encode()).digest(), version=4))
+
+
+def _author_names(count):
+    names = []
+    for i in range(count):
+        first = FIRST_NAMES[i % len(FIRST_NAMES)]
+        last = LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)]
+        suffix = i // (len(FIRST_NAMES) * len(LAST_NAMES))
+        names.append(f"{first} {last}" + (f" {suffix + 1}" if suffix else ""))
+    return names
+
+
+def generate_books(count, seed=0):
+    """Yield ``count`` synthetic books."""
+    rng = random.Random(seed)
+    authors = _author_names(max(1, count // 8))
+    genres, genre_weights = zip(*GENRES)
+    genre_cum = list(_cumulative(genre_weights))
+    rating_cum = list(_cumulative(RATING_WEIGHTS))
+    start = datetime(2015, 1, 1)
+    step = (10 * 365 * 24 * 3600) / max(count, 1)
+    for i in range(count):
+        # Squaring a uniform draw gives a few prolific authors and a long tail.
+        author = authors[int(len(authors) * rng.random() ** 2)]
+        title = " ".join(rng.sample(TITLE_WORDS, rng.choice((1, 2, 2, 3))))
+        if rng.random() < 0.3:
+            title = f"The {title}"
+        book = {
+            'id': book_id(i, seed),
+            'title': title,
+            'author': author,
+            'year': min(2025, max(1800, int(rng.gauss(1995, 22)))),
+            'genre': rng.choices(genres, cum_weights=genre_cum)[0],
+            'read': rng.random() < 0.45,
+            'rating': rng.choices(range(6), cum_weights=rating_cum)[0],
+            'notes': f"Recommended by {rng.choice(FIRST_NAMES)}." if rng.random() < 0.2 else "",
+            'isbn': f"978{rng.randrange(10**10):010d}" if rng.random() < 0.7 else "",
+            'tags': sorted({TAGS[int(len(TAGS) * rng.random() ** 2)] for _ in range(rng.choice((0, 0, 1, 1, 2, 3, 4)))}),
+            'date_added': (start + timedelta(seconds=int(i * step))).strftime(DATE_FORMAT),
+        }
+        yield book
+
+
+def _cumulative(weights):
+    total = 0
+    for weight in weights:
+        total += weight
+        yield total
+
+
+def generate_library(count, seed=0, collections=12):
+    """Return a library structure whose ``books`` is a generator of ``count`` books."""
+    rng = random.Random(seed + 1)
+    lists = {}
+    for name in COLLECTION_NAMES[:collections]:
+        size = min(count, rng.randint(5, 200))
+        lists[name] = [book_id(i, seed) for i in rng.sample(range(count), size)]
+    reading_list = [book_id(i, seed) for i in rng.sample(range(count), min(count, 500, max(1, count // 200)))] if count else []
+    return {
+        'books': generate_books(count, seed),
+        'collections': lists,
+        'reading_list': reading_list
+    }
+
+
+def write_library(path, count, seed=0):
+    """Write a synthetic library of ``count`` books as a JSON snapshot at ``path``."""
+    store = JournalStore(path, binary_snapshot=False)
+    store.compact(generate_library(count, seed))
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic library file.")
+    parser.add_argument("count", type=int, help="number of books")
+    parser.add_argument("path", nargs="?", default="library.json", help="library file to write")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_library(args.path, args.count, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import json
+
+import pytest
+from tornado.testing import AsyncHTTPTestCase
+
+import api
+
+
+class BookValidationTest(AsyncHTTPTestCase):
+    @pytest.fixture(autouse=True)
+    def _library(self, tmp_path):
+        self.libraries = api.Libraries(
+            backend='json', library_file=str(tmp_path / "library.json"), root=str(tmp_path / "libraries")
+        )
+
+    def get_app(self):
+        return api.make_app(self.libraries)
+
+    def request(self, method, path, body=None):
+        response = self.fetch(path, method=method, body=None if body is None else json.dumps(body), allow_nonstandard_methods=True)
+        return response.code, json.loads(response.body) if response.body else None
+
+    def test_bad_books_are_rejected_without_changes(self):
+        code, added = self.request('POST', '/books', {'title': 'Dune', 'author': 'Frank Herbert'})
+        assert code == 201
+        book_id = added['ids'][0]
+
+        for book in [
+            {'id': 5, 'title': 'Numeric id', 'author': 'A'},
+            {'title': 'Bad year', 'author': 'A', 'year': '1965'},
+            {'title': 'Bad read', 'author': 'A', 'read': 'yes'},
+            {'title': 'Bad rating', 'author': 'A', 'rating': True},
+            {'title': 'Bad tags', 'author': 'A', 'tags': ['ok', 3]},
+        ]:
+            code, _ = self.request('POST', '/books', book)
+            assert code == 400, book
+        code, _ = self.request('POST', '/batch', {'add': [{'title': 'Good', 'author': 'A'}, {'id': 5, 'title': 'Bad', 'author': 'A'}]})
+        assert code == 400
+        for changes in [{'rating': 'five'}, {'title': ''}, {'tags': 'scifi'}]:
+            code, _ = self.request('PATCH', f'/books/{book_id}', changes)
+            assert code == 400, changes
+
+        code, stats = self.request('GET', '/stats')
+        assert stats['books'] == 1
+        code, books = self.request('GET', '/books')
+        assert [book['id'] for book in books['books']] == [book_id]
+        code, book = self.request('GET', f'/books/{book_id}')
+        assert 'rating' not in book
+
+    def test_optional_fields_may_be_null(self):
+        code, added = self.request('POST', '/books', {'title': 'Emma', 'author': 'Jane Austen', 'year': None, 'tags': None})
+        assert code == 201
+        code, _ = self.request('PATCH', f"/books/{added['ids'][0]}", {'rating': 4, 'genre': None})
+        assert code == 200
+
+
+class PagingTest(AsyncHTTPTestCase):
+    backend = 'json'
+
+    @pytest.fixture(autouse=True)
+    def _library(self, tmp_path):
+        self.libraries = api.Libraries(
+            backend=self.backend, library_file=str(tmp_path / "library.json"),
+            db_file=str(tmp_path / "library.db"), root=str(tmp_path / "libraries")
+        )
+
+    def get_app(self):
+        return api.make_app(self.libraries)
+
+    def request(self, method, path, body=None):
+        response = self.fetch(path, method=method, body=None if body is None else json.dumps(body), allow_nonstandard_methods=True)
+        return response.code, json.loads(response.body) if response.body else None
+
+    def pages(self, query, between=None):
+        """Return the ids of every page of ``GET /books?query``, calling ``between()`` after each page."""
+        pages, cursor = [], None
+        while True:
+            code, page = self.request('GET', f"/books?{query}" + (f"&cursor={cursor}" if cursor else ""))
+            assert code == 200
+            pages.append([book['id'] for book in page['books']])
+            cursor = page['next']
+            if cursor is None:
+                return pages
+            if between:
+                between()
+
+    def test_pages_neither_repeat_nor_skip_books_under_writes(self):
+        # Several books share a year, so pages also break ties by id.
+        books = [{'id': f"b{i:02d}", 'title': f"Book {i:02d}", 'author': 'A', 'year': 1990 + i % 4} for i in range(20)]
+        self.request('POST', '/books', books)
+        added = iter(range(100))
+
+        def insert_before():
+            # Every new book sorts before the books still to come.
+            self.request('POST', '/books', {'id': f"a{next(added):02d}", 'title': 'Early', 'author': 'A', 'year': 1900})
+
+        for order in ('asc', 'desc'):
+            pages = self.pages(f"sort=year&order={order}&limit=3", between=insert_before if order == 'asc' else None)
+            seen = [book_id for page in pages for book_id in page]
+            assert len(seen) == len(set(seen))
+            assert {f"b{i:02d}" for i in range(20)} <= set(seen)
+            expected = sorted(books, key=lambda book: (book['year'], book['id']), reverse=order == 'desc')
+            assert [book_id for book_id in seen if book_id.startswith('b')] == [book['id'] for book in expected]
+
+    def test_deleting_the_cursor_book_keeps_the_place(self):
+        self.request('POST', '/books', [{'id': f"b{i}", 'title': f"Book {i}", 'author': 'A'} for i in range(6)])
+        code, page = self.request('GET', "/books?limit=2")
+        assert [book['id'] for book in page['books']] == ['b0', 'b1']
+        self.request('DELETE', '/books/b1')
+        code, page = self.request('GET', f"/books?limit=2&cursor={page['next']}")
+        assert [book['id'] for book in page['books']] == ['b2', 'b3']
+
+    def test_a_cursor_belongs_to_its_query(self):
+        self.request('POST', '/books', [{'title': f"Book {i}", 'author': 'A'} for i in range(3)])
+        code, page = self.request('GET', "/books?limit=1")
+        code, _ = self.request('GET', f"/books?limit=1&sort=year&cursor={page['next']}")
+        assert code == 400
+
+    def test_a_book_named_batch_is_reachable(self):
+        self.request('POST', '/books', {'id': 'batch', 'title': 'Batch', 'author': 'A'})
+        code, book = self.request('GET', '/books/batch')
+        assert code == 200 and book['title'] == 'Batch'
+        code, _ = self.request('POST', '/batch', {'delete': ['batch']})
+        assert code == 200
+        code, _ = self.request('GET', '/books/batch')
+        assert code == 404
+
+
+class SqlitePagingTest(PagingTest):
+    backend = 'sqlite'
@@ -0,0 +1,71 @@
+import os
+import threading
+
+import backups as backups_module
+from backups import BackupStore
+from repository import JsonRepository
+from storage import JournalStore
+
+
+def test_backup_points_share_unchanged_buckets(tmp_path):
+    store = JournalStore(str(tmp_path / "library.json"))
+    repo = JsonRepository(store, store.open())
+    repo.add_books([{'id': f'b{i}', 'title': f'Book {i}', 'author': 'A'} for i in range(100)])
+    backups = BackupStore(str(tmp_path / "backups"), buckets=8)
+
+    first = backups.create(repo)
+    assert first['books'] == 100
+    assert backups.create(repo)['new_objects'] == 0
+    repo.update_book('b1', {'rating': 5})
+    assert backups.create(repo)['new_objects'] == 1
+
+    assert sorted(book['id'] for book in backups.iter_books(first['id'])) == sorted(f'b{i}' for i in range(100))
+    objects = [name for _, _, names in os.walk(backups.objects_dir) for name in names]
+    assert len(objects) == len(set(first['buckets']) | {first['lists']}) + 1
+    assert not [name for name in objects if name.startswith(".tmp")]
+
+
+def _library(tmp_path, count=20):
+    store = JournalStore(str(tmp_path / "library.json"))
+    repo = JsonRepository(store, store.open())
+    repo.add_books([{'id': f'b{i}', 'title': f'Book {i}', 'author': 'A'} for i in range(count)])
+    return repo
+
+
+def test_prune_keeps_young_objects_and_temp_files(tmp_path, monkeypatch):
+    repo = _library(tmp_path)
+    backups = BackupStore(str(tmp_path / "backups"), buckets=4)
+    backups.create(repo)
+    repo.update_book('b1', {'rating': 5})
+    backups.create(repo)
+    stray = os.path.join(backups.objects_dir, "ab", ".tmp-partial")
+    os.makedirs(os.path.dirname(stray), exist_ok=True)
+    open(stray, 'w').close()
+
+    assert backups.prune(1) == 0
+    monkeypatch.setattr(backups_module, 'PRUNE_GRACE', -1)
+    assert backups.prune(1) == 1
+    assert os.path.exists(stray)
+    assert len(list(backups.iter_books(backups.list()[0]['id']))) == 20
+
+
+def test_backup_point_is_consistent_under_concurrent_writes(tmp_path):
+    repo = _library(tmp_path)
+    backups = BackupStore(str(tmp_path / "backups"), buckets=4)
+    writers = []
+
+    def write_during_backup(fraction):
+        # Another session adds a book while the first half of the buckets is written.
+        if fraction == 0.5:
+            book = {'id': f'late{len(writers)}', 'title': 'Late', 'author': 'B'}
+            writers.append(threading.Thread(target=repo.add_books, args=([book],)))
+            writers[-1].start()
+            writers[-1].join(0.2)
+
+    point = backups.create(repo, progress=write_during_backup)
+    for writer in writers:
+        writer.join()
+    # The first tries saw a write and were redone; the last one held the lock, so its writer waited.
+    assert len(writers) == backups_module.BACKUP_ATTEMPTS
+    assert point['books'] == len(list(backups.iter_books(point['id']))) == 20 + len(writers) - 1
+    assert repo.count_books() == 20 + len(writers)
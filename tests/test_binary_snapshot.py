@@ -0,0 +1,30 @@
+import json
+
+from repository import JsonRepository
+from storage import JournalStore
+
+
+def _open(path, **options):
+    return JsonRepository.open(JournalStore(str(path), **options))
+
+
+def test_reopen_from_binary_snapshot_keeps_missing_fields_absent(tmp_path):
+    path = tmp_path / "library.json"
+    path.write_text(json.dumps({'books': [
+        {'id': 'a', 'title': 'With ISBN', 'author': 'X', 'isbn': '123'},
+        {'id': 'b', 'title': 'No ISBN', 'author': 'Y'},
+    ], 'collections': {}, 'reading_list': []}))
+    # The first open writes the binary snapshot, the second reads it.
+    _open(path)
+    # Compact after every write.
+    repo = _open(path, compact_ratio=0.0, min_compact_bytes=0)
+
+    assert repo.get_book('b').get('isbn') is None
+    assert 'isbn' not in dict(repo.get_book('b'))
+    exported = json.loads(json.dumps(repo.export_data()))
+    assert {book['id'] for book in exported['books']} == {'a', 'b'}
+
+    repo.add_book({'id': 'c', 'title': 'Later', 'author': 'Z'})
+    books = json.loads(path.read_text())['books']
+    assert [book['id'] for book in books] == ['a', 'b', 'c']
+    assert books[1] == {'id': 'b', 'title': 'No ISBN', 'author': 'Y'}
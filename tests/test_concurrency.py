@@ -0,0 +1,41 @@
+import multiprocessing
+
+from repository import JsonRepository
+from storage import JournalStore
+
+PROCESSES = 4
+BOOKS_PER_PROCESS = 60
+
+
+def _open(path):
+    # Compact after every few KB of journal, so writers keep meeting each other's compactions.
+    return JsonRepository.open(JournalStore(path, compact_ratio=0.0, min_compact_bytes=4096))
+
+
+def _write(path, worker):
+    repo = _open(path)
+    for i in range(BOOKS_PER_PROCESS):
+        book_id = f"w{worker}-b{i}"
+        repo.add_books([{'id': book_id, 'title': f"Book {worker}.{i}", 'author': f"Author {worker}"}])
+        repo.update_book(book_id, {'read': True})
+        repo.add_to_reading_list([book_id])
+
+
+def test_concurrent_writers_lose_nothing(tmp_path):
+    path = str(tmp_path / "library.json")
+    _open(path)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_write, args=(path, worker)) for worker in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    repo = _open(path)
+    expected = {f"w{worker}-b{i}" for worker in range(PROCESSES) for i in range(BOOKS_PER_PROCESS)}
+    assert {book['id'] for book in repo.iter_books()} == expected
+    assert repo.count_books(read=True) == len(expected)
+    assert set(repo.reading_list()) == expected
+    # One add, one update and one reading-list add per book.
+    assert repo.version == 3 * len(expected)
@@ -0,0 +1,134 @@
+import random
+
+import pytest
+
+from repository import JsonRepository, SqliteRepository
+from storage import JournalStore
+
+BOOKS = [
+    {'id': 'a', 'title': 'Emma', 'author': 'Jane Austen', 'genre': 'Fiction', 'year': 1815, 'rating': 4, 'read': True, 'tags': ['classic']},
+    {'id': 'b', 'title': 'dune', 'author': 'Frank Herbert', 'genre': 'Science Fiction', 'year': 1965, 'rating': 5, 'tags': ['classic', 'space']},
+    {'id': 'c', 'title': 'Persuasion', 'author': 'Jane Austen', 'genre': 'Fiction', 'year': 1817, 'read': True},
+    {'id': 'd', 'title': 'Hyperion', 'author': 'Dan Simmons', 'genre': 'Science Fiction', 'year': 1989, 'rating': 4, 'tags': ['space']},
+    {'id': 'e', 'title': 'Beloved', 'author': 'Toni Morrison', 'genre': 'Fiction', 'year': 1987, 'rating': 5},
+]
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    if request.param == 'sqlite':
+        repo = SqliteRepository(str(tmp_path / "library.db"))
+    else:
+        store = JournalStore(str(tmp_path / "library.json"))
+        repo = JsonRepository(store, store.open())
+    repo.add_books(BOOKS)
+    repo.add_to_collection('Favorites', 'b')
+    repo.add_to_collection('Favorites', 'e')
+    return repo
+
+
+def _ids(books):
+    return [book['id'] for book in books]
+
+
+def test_filters_combine_facets(repo):
+    total, books = repo.filter_books({'genre': ['Fiction'], 'year': (1816, None)})
+    assert total == 2 and set(_ids(books)) == {'c', 'e'}
+    assert set(_ids(repo.filter_books({'tags': ['space'], 'rating': [5]})[1])) == {'b'}
+    assert set(_ids(repo.filter_books({'collection': ['Favorites'], 'read': False})[1])) == {'b', 'e'}
+    assert repo.filter_books({'ids': []}) == (0, [])
+
+
+def test_counts_leave_out_their_own_facet(repo):
+    counts = repo.facet_counts({'genre': ['Fiction'], 'rating': [5]})
+    # Genres are counted over the 5-star books, ratings over the fiction.
+    assert counts['genre'] == [('Fiction', 1), ('Science Fiction', 1)]
+    assert counts['rating'] == [(0, 1), (4, 1), (5, 1)]
+    assert counts['author'] == [('Toni Morrison', 1)]
+    assert counts['read'] == [(True, 0), (False, 1)]
+    assert counts['collection'] == [('Favorites', 1)]
+
+
+def test_counts_follow_writes(repo):
+    repo.update_book('d', {'genre': 'Fiction'})
+    repo.delete_book('a')
+    counts = repo.facet_counts()
+    assert counts['genre'] == [('Fiction', 3), ('Science Fiction', 1)]
+    assert counts['tags'] == [('space', 2), ('classic', 1)]
+
+
+@pytest.mark.parametrize('field, expected', [
+    ('title', ['e', 'b', 'a', 'd', 'c']),
+    ('author', ['d', 'b', 'a', 'c', 'e']),
+    ('year', ['a', 'c', 'b', 'e', 'd']),
+])
+def test_sorting_pages_and_ties(repo, field, expected):
+    assert _ids(repo.filter_books(sort_by=field)[1]) == expected
+    assert _ids(repo.filter_books(sort_by=field, descending=True)[1]) == expected[::-1]
+    assert _ids(repo.filter_books(sort_by=field, limit=2, offset=1)[1]) == expected[1:3]
+    total, books = repo.filter_books({'genre': ['Fiction']}, sort_by=field, limit=2)
+    assert total == 3 and _ids(books) == [book_id for book_id in expected if book_id in 'ace'][:2]
+
+
+def test_years_of_mixed_types_sort(tmp_path):
+    store = JournalStore(str(tmp_path / "library.json"))
+    repo = JsonRepository(store, store.open())
+    repo.add_books([
+        {'id': 'a', 'title': 'A', 'author': 'X', 'year': 1990},
+        {'id': 'b', 'title': 'B', 'author': 'X', 'year': 'c. 1900'},
+        {'id': 'c', 'title': 'C', 'author': 'X'},
+        {'id': 'd', 'title': 'D', 'author': 'X', 'year': 1850},
+    ])
+    # Numbers first, a missing year as 0, then text, as SQLite orders them.
+    assert _ids(repo.filter_books(sort_by='year')[1]) == ['c', 'd', 'a', 'b']
+    repo.update_book('a', {'year': '1990s'})
+    assert _ids(repo.filter_books(sort_by='year', descending=True)[1]) == ['b', 'a', 'd', 'c']
+
+
+def test_index_follows_writes(tmp_path):
+    rng = random.Random(7)
+    path = str(tmp_path / "library.json")
+    repo = JsonRepository.open(JournalStore(path))
+
+    def book(book_id):
+        return {
+            'id': book_id, 'title': rng.choice(['Alpha', 'beta', 'Gamma', f"Title {rng.randrange(30)}"]),
+            'author': rng.choice(['Ann', 'bob', f"Author {rng.randrange(10)}"]), 'genre': rng.choice(['Fiction', 'Poetry', None]),
+            'year': rng.choice([None, 1950, 1990, 2001]), 'rating': rng.randrange(6), 'read': rng.random() < 0.5,
+            'tags': rng.sample(['a', 'b', 'c', 'd'], rng.randrange(3)),
+        }
+
+    def views(repo):
+        result = [repo.facet_counts(filters) for filters in FILTERS]
+        for filters in FILTERS:
+            for field in ('title', 'author', 'year', 'genre'):
+                result.append(_ids(repo.filter_books(filters, sort_by=field)[1]))
+                result.append(_ids(repo.filter_books(filters, sort_by=field, descending=True, limit=4, after=('M', 'm'))[1]))
+        return result
+
+    FILTERS = [None, {'genre': ['Fiction']}, {'tags': ['a', 'c']}, {'year': (1960, None), 'read': True}]
+    repo.add_books([book(f"b{i:03d}") for i in range(60)])
+    views(repo)
+    for step in range(120):
+        book_ids = sorted(repo.books.rows)
+        if step % 3 == 0:
+            repo.add_books([book(f"n{step:03d}")])
+        elif step % 3 == 1:
+            changes = book('x')
+            del changes['id']
+            repo.update_book(rng.choice(book_ids), {name: value for name, value in changes.items() if rng.random() < 0.5})
+        else:
+            repo.delete_book(rng.choice(book_ids))
+        if step % 10 == 9:
+            # A library opened afresh builds its index from scratch.
+            assert views(repo) == views(JsonRepository.open(JournalStore(path)))
+
+
+def test_book_frame_does_not_follow_later_writes(repo):
+    frame = repo.book_frame(['id', 'author', 'year', 'rating'])
+    before = frame.sort_values('id')[['author', 'year', 'rating']].values.tolist()
+    repo.update_book('a', {'author': 'Someone Else', 'year': 2000, 'rating': 1})
+    repo.delete_book('b')
+    repo.add_books([{'id': 'f', 'title': 'Middlemarch', 'author': 'George Eliot', 'year': 1871}])
+    assert sorted(frame['id']) == ['a', 'b', 'c', 'd', 'e']
+    assert frame.sort_values('id')[['author', 'year', 'rating']].values.tolist() == before
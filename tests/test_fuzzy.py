@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from fuzzy import TermIndex, edit_distances, word_codes
+from repository import JsonRepository, SqliteRepository
+from storage import JournalStore
+
+BOOKS = [
+    {'id': 'hobbit', 'title': 'The Hobbit', 'author': 'J.R.R. Tolkien', 'genre': 'Fantasy'},
+    {'id': 'rings', 'title': 'The Lord of the Rings', 'author': 'J.R.R. Tolkien', 'genre': 'Fantasy'},
+    {'id': 'dune', 'title': 'Dune', 'author': 'Frank Herbert', 'genre': 'Science Fiction'},
+    {'id': 'hyperion', 'title': 'Hyperion', 'author': 'Dan Simmons', 'genre': 'Science Fiction'},
+]
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    if request.param == 'sqlite':
+        repo = SqliteRepository(str(tmp_path / "library.db"))
+    else:
+        store = JournalStore(str(tmp_path / "library.json"))
+        repo = JsonRepository(store, store.open())
+    repo.add_books(BOOKS)
+    return repo
+
+
+def test_edit_distance_counts_a_swap_as_one_edit():
+    words = ['tolkien', 'tolkin', 'tolkiens', 'talkien', 'tloklien']
+    codes = np.vstack([word_codes(word) for word in words])
+    lengths = np.array([len(word) for word in words])
+    # Distances over the limit come back as the limit plus one.
+    assert edit_distances('tolkein', codes, lengths, 2).tolist() == [1, 1, 2, 2, 3]
+
+
+def test_similar_words_by_length():
+    index = TermIndex(['tolkien', 'hobbit', 'dune', 'at'])
+    assert index.similar('tolkein') == [('tolkien', 1)]
+    assert index.similar('hobit') == [('hobbit', 1)]
+    # Two-letter words allow no typo, and a word is not similar to itself.
+    assert index.similar('an') == []
+    assert index.similar('dune') == []
+
+
+def test_words_stay_until_every_field_removes_them():
+    index = TermIndex(['tolkien', 'tolkien'])
+    index.remove('tolkien')
+    assert index.similar('tolkein') == [('tolkien', 1)]
+    index.remove('tolkien')
+    assert index.similar('tolkein') == [] and index.complete('tol') == []
+    index.add('tolkien')
+    assert index.similar('tolkein') == [('tolkien', 1)]
+
+
+def test_suggestions_correct_only_unknown_words(repo):
+    assert repo.suggest_query('tolkein hobit') == 'tolkien hobbit'
+    assert repo.suggest_query('author:herbrt dune') == 'author:herbert dune'
+    # Known words, genres and prefixes of known words are left alone.
+    assert repo.suggest_query('hobbit') is None
+    assert repo.suggest_query('fantasy') is None
+    assert repo.suggest_query('hob') is None
+    assert repo.suggest_query('xyzzy') is None
+
+
+def test_completions_follow_writes(repo):
+    assert repo.complete_query('hy') == ['hyperion']
+    assert repo.complete_query('hyperoin') == ['hyperion']
+    repo.delete_book('hyperion')
+    assert repo.complete_query('hy') == []
+    assert repo.suggest_query('hyperoin') is None
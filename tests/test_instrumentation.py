@@ -0,0 +1,28 @@
+import tracemalloc
+
+import pytest
+
+from instrumentation import Profiler, current, finish_rerun, phase, start_rerun
+
+
+@pytest.mark.parametrize('mode', ['cprofile', 'tracemalloc'])
+def test_interrupted_rerun_still_stops_profiling(mode):
+    metrics = start_rerun("page")
+    profiler = Profiler(mode)
+    profiler.start()
+    with pytest.raises(RuntimeError):
+        try:
+            with phase("query"):
+                raise RuntimeError("rerun requested")
+        finally:
+            report = finish_rerun(metrics, profiler)
+
+    assert current() is None
+    assert not tracemalloc.is_tracing()
+    assert [entry['phase'] for entry in report['phases']] == ["query"]
+    assert report['profile']['mode'] == mode
+    # A second profile in the same thread starts cleanly.
+    profiler = Profiler(mode)
+    profiler.start()
+    assert profiler.error is None
+    profiler.stop()
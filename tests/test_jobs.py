@@ -0,0 +1,115 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from backups import BackupStore
+from jobs import Job, JobCancelled, JobQueue, backup_job, export_job, import_csv_job, restore_point_job
+from repository import JsonRepository, SqliteRepository
+from storage import JournalStore
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    if request.param == 'sqlite':
+        return SqliteRepository(str(tmp_path / "library.db"))
+    store = JournalStore(str(tmp_path / "library.json"))
+    return JsonRepository(store, store.open())
+
+
+def _csv(count):
+    rows = [f"Book {i},Author {i},978000000{i:04d}" for i in range(count)]
+    return ("title,author,isbn\n" + "\n".join(rows)).encode('utf-8')
+
+
+def test_cancelled_import_keeps_the_chunks_before_it(repo):
+    job = Job('import', "Import")
+    progress = job.progress
+
+    def cancel_after_first_chunk(fraction=None, message=None):
+        if job.fraction > 0:
+            job.cancel()
+        progress(fraction, message)
+
+    job.progress = cancel_after_first_chunk
+    with pytest.raises(JobCancelled):
+        import_csv_job(repo, _csv(50), chunksize=10)(job)
+    assert repo.count_books() == 20
+
+
+def test_failed_chunk_stops_the_import(repo):
+    import_books = repo.import_books
+    calls = []
+
+    def fail_third_chunk(books, on_duplicate='skip'):
+        calls.append(len(books))
+        if len(calls) == 3:
+            raise ValueError("disk full")
+        return import_books(books, on_duplicate)
+
+    repo.import_books = fail_third_chunk
+    with pytest.raises(ValueError, match="chunk 3 .*disk full.*20 books"):
+        import_csv_job(repo, _csv(50), chunksize=10)(Job('import', "Import"))
+    assert repo.count_books() == 20
+
+
+def test_import_writes_every_chunk(repo):
+    result = import_csv_job(repo, _csv(50) + b"\nBook 0,Author 0,\n", chunksize=10)(Job('import', "Import"))
+    assert repo.count_books() == 50
+    assert result['report'].duplicates == 1
+
+
+def test_restore_point_streams_backup(repo, tmp_path):
+    repo.add_books([{'id': f'b{i}', 'title': f'Book {i}', 'author': 'A'} for i in range(20)])
+    repo.set_collection('Shelf', ['b1', 'b2'])
+    store = BackupStore(str(tmp_path / "backups"), buckets=4)
+    point = store.create(repo)
+    repo.delete_book('b1')
+
+    fractions = []
+    job = Job('restore', "Restore")
+    job.progress = lambda fraction=None, message=None: fractions.append(fraction)
+    restore_point_job(store, repo, point['id'])(job)
+    assert repo.count_books() == 20
+    assert repo.collections() == {'Shelf': ['b1', 'b2']}
+    assert fractions == [0.25, 0.5, 0.75, 1.0]
+
+
+def _wait(job):
+    while not job.finished:
+        time.sleep(0.01)
+
+
+def test_downloads_are_files_removed_with_the_job(repo):
+    repo.add_books([{'id': 'b1', 'title': 'Book', 'author': 'A'}])
+    queue = JobQueue(workers=1, history=1)
+    first = queue.submit('export', "Export", export_job(repo, 'csv'))
+    _wait(first)
+
+    label, path, file_name, mime = first.result['download']
+    assert file_name == "library.csv"
+    with open(path) as f:
+        assert "Book" in f.read()
+    _wait(queue.submit('export', "Export", export_job(repo, 'jsonl')))
+    queue.submit('export', "Export", lambda job: {'message': "Done"})
+    assert queue.get(first.id) is None
+    assert not os.path.exists(path)
+    queue.shutdown()
+
+
+def test_backup_download_is_opt_in(repo, tmp_path):
+    repo.add_books([{'id': 'b1', 'title': 'Book', 'author': 'A'}])
+    store = BackupStore(str(tmp_path / "backups"), buckets=4)
+    assert 'download' not in backup_job(store, repo)(Job('backup', "Backup"))
+    result = backup_job(store, repo, download=True)(Job('backup', "Backup"))
+    assert result['download'][2] == "library.json"
+    os.remove(result['download'][1])
+
+
+def test_importing_jobs_leaves_pandas_unloaded():
+    # The app imports jobs at startup; pandas loads only once an import runs.
+    code = "import sys, jobs; sys.exit('pandas' in sys.modules)"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=root).returncode == 0
@@ -0,0 +1,68 @@
+import pytest
+
+from indexes import OrderedIdSet
+from repository import JsonRepository, SqliteRepository
+from storage import JournalStore
+
+BOOK_IDS = ['a', 'b', 'c', 'd', 'e']
+
+
+def _open(kind, tmp_path):
+    if kind == 'sqlite':
+        return SqliteRepository(str(tmp_path / "library.db"))
+    return JsonRepository.open(JournalStore(str(tmp_path / "library.json")))
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def kind(request):
+    return request.param
+
+
+@pytest.fixture
+def repo(kind, tmp_path):
+    repo = _open(kind, tmp_path)
+    repo.add_books([{'id': book_id, 'title': f"Book {book_id}", 'author': 'A'} for book_id in BOOK_IDS])
+    return repo
+
+
+def test_ordered_id_set():
+    ids = OrderedIdSet(['a', 'b', 'a', 'c'])
+    assert ids.ids() == ['a', 'b', 'c']
+    assert ids.add(['d', 'a', 'e'], position=1) == ['d', 'e']
+    assert ids.ids() == ['a', 'd', 'e', 'b', 'c']
+    assert ids.move(['c', 'a', 'x'], 1) == ['c', 'a']
+    assert ids.ids() == ['d', 'c', 'a', 'e', 'b']
+    assert ids.remove(['e', 'x']) == ['e']
+    assert ids.ids() == ['d', 'c', 'a', 'b'] and 'e' not in ids and len(ids) == 4
+
+
+def test_collection_edits_keep_order_without_repeats(repo, kind, tmp_path):
+    repo.add_to_collection('Shelf', ['a', 'b', 'c'])
+    repo.add_to_collection('Shelf', ['b', 'd'], position=0)
+    assert repo.collections()['Shelf'] == ['d', 'a', 'b', 'c']
+    repo.move_in_collection('Shelf', ['c', 'd'], 1)
+    assert repo.collections()['Shelf'] == ['a', 'c', 'd', 'b']
+    repo.remove_from_collection('Shelf', ['d'])
+    repo.delete_book('a')
+    assert repo.collections()['Shelf'] == ['c', 'b']
+    assert repo.in_collection('Shelf', 'b') and not repo.in_collection('Shelf', 'a')
+    # The edits survive reopening, replayed from the journal for JSON.
+    assert _open(kind, tmp_path).collections()['Shelf'] == ['c', 'b']
+
+
+def test_reading_list_edits_keep_order_without_repeats(repo, kind, tmp_path):
+    repo.add_to_reading_list(['c', 'a'])
+    repo.add_to_reading_list(['e', 'c'], position=1)
+    assert repo.reading_list() == ['c', 'e', 'a']
+    repo.move_in_reading_list(['a'], 0)
+    repo.remove_from_reading_list(['e'])
+    assert repo.reading_list() == ['a', 'c']
+    assert repo.in_reading_list('c') and not repo.in_reading_list('e')
+    assert _open(kind, tmp_path).reading_list() == ['a', 'c']
+
+
+def test_setting_a_collection_drops_repeats(repo):
+    repo.set_collection('Shelf', ['b', 'a', 'b'])
+    assert repo.collections()['Shelf'] == ['b', 'a']
+    repo.delete_collection('Shelf')
+    assert 'Shelf' not in repo.collections()
@@ -0,0 +1,92 @@
+import json
+
+import pytest
+
+from repository import JsonRepository
+from storage import SCHEMA_VERSION, JournalStore, read_quarantine
+
+
+def _open(path):
+    return JsonRepository.open(JournalStore(str(path)))
+
+
+def test_legacy_list_is_validated_and_rewritten_once(tmp_path):
+    path = tmp_path / "library.json"
+    path.write_text(json.dumps([
+        {'id': 'a', 'title': 'Emma', 'author': 'Jane Austen'},
+        {'title': 'No id', 'author': 'Anon'},
+        "not a book",
+        {'id': 7, 'title': 'Numeric id', 'author': 'X'},
+    ]))
+    repo = _open(path)
+
+    titles = sorted(book['title'] for book in repo.query_books())
+    assert titles == ['Emma', 'No id']
+    assert all(isinstance(book['id'], str) for book in repo.query_books())
+    report = read_quarantine(str(path) + ".quarantine")
+    assert report['checked'] == 4 and report['ids_assigned'] == 1
+    assert [(entry['index'], entry['reason']) for entry in report['entries']] == [
+        (2, "not a JSON object"), (3, "id is not a string")
+    ]
+    snapshot = json.loads(path.read_text())
+    assert snapshot['schema'] == SCHEMA_VERSION
+    assert sorted(book['title'] for book in snapshot['books']) == titles
+
+    # The rewritten snapshot is trusted: reopening sets nothing aside again.
+    reopened = _open(path)
+    assert sorted(book['id'] for book in reopened.query_books()) == sorted(book['id'] for book in repo.query_books())
+    assert len(read_quarantine(str(path) + ".quarantine")['entries']) == 2
+
+
+def test_unmarked_snapshot_with_bad_lists(tmp_path):
+    path = tmp_path / "library.json"
+    path.write_text(json.dumps({
+        'books': [{'id': 'a', 'title': 'Emma', 'author': 'Jane Austen'}],
+        'collections': ['not', 'a', 'mapping'],
+        'reading_list': ['a'],
+    }))
+    repo = _open(path)
+    assert repo.collections() == {} and repo.reading_list() == ['a']
+    entries = read_quarantine(str(path) + ".quarantine")['entries']
+    assert [(entry['index'], entry['reason']) for entry in entries] == [(None, "collections is not a JSON object")]
+
+
+def test_valid_library_writes_no_quarantine(tmp_path):
+    path = tmp_path / "library.json"
+    path.write_text(json.dumps({'books': [{'id': 'a', 'title': 'Emma', 'author': 'Jane Austen'}]}))
+    _open(path)
+    assert read_quarantine(str(path) + ".quarantine") is None
+    assert json.loads(path.read_text())['schema'] == SCHEMA_VERSION
+
+
+def test_corrupt_file_is_never_rewritten(tmp_path):
+    path = tmp_path / "library.json"
+    path.write_text('{"books": [{"id": "a", "title": "Emma"')
+    with pytest.raises(json.JSONDecodeError):
+        _open(path)
+    assert path.read_text() == '{"books": [{"id": "a", "title": "Emma"'
+
+
+def test_snapshot_keys_after_books_are_kept(tmp_path):
+    path = tmp_path / "library.json"
+    path.write_text(json.dumps({
+        'generation': 'abc123',
+        'books': [{'id': 'a', 'title': 'Emma', 'author': 'Jane Austen'}],
+        'collections': {'classics': ['a']},
+    }))
+    repo = _open(path)
+    assert [book['id'] for book in repo.query_books()] == ['a']
+    assert repo.collections() == {'classics': ['a']}
+
+
+def test_snapshot_books_array_must_end_the_snapshot(tmp_path):
+    path = tmp_path / "library.json"
+    text = json.dumps({
+        'generation': 'abc123',
+        'books': [{'id': 'a', 'title': 'Emma', 'author': 'Jane Austen'}],
+        'reading_list': ['a'],
+    })
+    path.write_text(text)
+    with pytest.raises(json.JSONDecodeError):
+        _open(path)
+    assert path.read_text() == text
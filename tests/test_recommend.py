@@ -0,0 +1,79 @@
+import random
+
+import pytest
+
+from recommend import FeatureIndex
+from repository import JsonRepository, SqliteRepository
+from storage import JournalStore
+
+BOOKS = [
+    {'id': 'dune', 'title': 'Dune', 'author': 'Frank Herbert', 'genre': 'Science Fiction', 'read': True, 'rating': 5, 'tags': ['desert']},
+    {'id': 'emma', 'title': 'Emma', 'author': 'Jane Austen', 'genre': 'Fiction', 'read': True, 'rating': 2},
+    {'id': 'messiah', 'title': 'Dune Messiah', 'author': 'Frank Herbert', 'genre': 'Science Fiction', 'tags': ['desert']},
+    {'id': 'hyperion', 'title': 'Hyperion', 'author': 'Dan Simmons', 'genre': 'Science Fiction'},
+    {'id': 'persuasion', 'title': 'Persuasion', 'author': 'Jane Austen', 'genre': 'Fiction'},
+    {'id': 'children', 'title': 'Children of Dune', 'author': 'Frank Herbert', 'genre': 'Science Fiction', 'read': True},
+]
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    if request.param == 'sqlite':
+        repo = SqliteRepository(str(tmp_path / "library.db"))
+    else:
+        store = JournalStore(str(tmp_path / "library.json"))
+        repo = JsonRepository(store, store.open())
+    repo.add_books([dict(book) for book in BOOKS])
+    return repo
+
+
+def _picks(repo, **options):
+    return [(book['id'], liked['id'] if liked else None) for book, _, liked in repo.recommend_books(**options)]
+
+
+def test_unread_books_like_the_liked_ones(repo):
+    # Emma is rated too low to count, and read books are never recommended.
+    assert _picks(repo) == [('messiah', 'dune'), ('hyperion', 'dune')]
+    assert _picks(repo, limit=1) == [('messiah', 'dune')]
+    assert _picks(repo, exclude=['messiah']) == [('hyperion', 'dune')]
+
+
+def test_recommendations_follow_writes(repo):
+    repo.update_book('emma', {'rating': 5})
+    assert [book_id for book_id, _ in _picks(repo)] == ['messiah', 'persuasion', 'hyperion']
+    repo.update_book('messiah', {'read': True})
+    repo.delete_book('hyperion')
+    assert _picks(repo) == [('persuasion', 'emma')]
+    repo.update_book('dune', {'rating': 3})
+    repo.update_book('emma', {'read': False})
+    assert _picks(repo) == []
+
+
+def test_edits_then_refresh_match_a_rebuild():
+    rng = random.Random(3)
+    genres, authors, tags = ['Fiction', 'Mystery', 'Fantasy'], [f"Author {i}" for i in range(8)], ['a', 'b', 'c', 'd']
+
+    def book(book_id):
+        return {
+            'id': book_id, 'genre': rng.choice(genres), 'author': rng.choice(authors),
+            'tags': rng.sample(tags, rng.randrange(3)), 'read': rng.random() < 0.5, 'rating': rng.randrange(6),
+        }
+
+    books = {f"b{i}": book(f"b{i}") for i in range(60)}
+    index = FeatureIndex(list(books.values()))
+    index.recommend(5)
+    for step in range(40):
+        book_id = f"b{rng.randrange(80)}"
+        if book_id in books and step % 3 == 0:
+            del books[book_id]
+            index.remove(book_id)
+        else:
+            books[book_id] = book(book_id)
+            index.add(books[book_id])
+        # Between refreshes the scores are adjusted in place; only live unread books come back.
+        assert all(book_id in books and not books[book_id]['read'] for book_id, _, _ in index.recommend(10))
+    # Recompute the frequencies the rebuild uses; the incremental index keeps them between refreshes.
+    index.refresh()
+    fresh = FeatureIndex(list(books.values()))
+    assert [pick[0] for pick in index.recommend(10)] == [pick[0] for pick in fresh.recommend(10)]
+    assert [pick[1] for pick in index.recommend(10)] == pytest.approx([pick[1] for pick in fresh.recommend(10)])
@@ -0,0 +1,53 @@
+import pytest
+
+from repository import JsonRepository, SqliteRepository
+from storage import JournalStore
+
+
+def _books(count):
+    return [{'id': f'b{i}', 'title': f'Book {i}', 'author': f'Author {i}', 'isbn': f'97800000000{i}', 'read': True} for i in range(count)]
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    if request.param == 'sqlite':
+        repo = SqliteRepository(str(tmp_path / "library.db"))
+    else:
+        store = JournalStore(str(tmp_path / "library.json"))
+        repo = JsonRepository(store, store.open())
+    repo.add_books(_books(5))
+    return repo
+
+
+@pytest.mark.parametrize('bad', [{'id': 5, 'title': 'Numeric id'}, 'not a book'])
+def test_failed_replace_leaves_library_unchanged(repo, bad):
+    with pytest.raises(ValueError):
+        repo.replace({'books': _books(2) + [bad], 'collections': {}, 'reading_list': []})
+
+    assert repo.count_books() == 5
+    assert repo.count_books(read=True) == 5
+    assert len(list(repo.iter_books())) == 5
+    assert repo.find_duplicates(_books(5)) == [f'b{i}' for i in range(5)]
+
+
+def test_replace_assigns_missing_ids(repo):
+    repo.replace({'books': [{'title': 'No id', 'author': 'Someone'}], 'collections': {}, 'reading_list': []})
+    assert [book['title'] for book in repo.iter_books()] == ['No id']
+
+
+@pytest.mark.parametrize('bad', [{'id': 5, 'title': 'Numeric id'}, {'title': 'No id'}, None])
+def test_add_books_checks_every_book_first(repo, bad):
+    with pytest.raises(ValueError):
+        repo.add_books([{'id': 'new', 'title': 'New'}, bad])
+
+    assert repo.count_books() == 5
+    assert repo.get_book('new') is None
+    assert len(list(repo.iter_books())) == 5
+
+
+def test_deleting_one_duplicate_keeps_the_others_findable(repo):
+    repo.add_books([{'id': 'copy', 'title': 'Book 1', 'author': 'Author 1', 'isbn': '978000000001', 'read': True}])
+    repo.delete_book('b1')
+    assert repo.find_duplicates([{'title': 'book 1', 'author': 'AUTHOR 1'}, {'isbn': '978000000001'}]) == ['copy', 'copy']
+    repo.delete_book('copy')
+    assert repo.find_duplicates([{'title': 'Book 1', 'author': 'Author 1'}]) == [None]
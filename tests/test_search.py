@@ -0,0 +1,69 @@
+import pytest
+
+from repository import JsonRepository, SqliteRepository
+from storage import JournalStore
+
+BOOKS = [
+    {'id': 'hobbit', 'title': 'The Hobbit', 'author': 'J.R.R. Tolkien', 'genre': 'Fantasy', 'notes': 'Dragons'},
+    {'id': 'rings', 'title': 'The Lord of the Rings', 'author': 'J.R.R. Tolkien', 'genre': 'Fantasy'},
+    {'id': 'dragon', 'title': 'Dragon Rider', 'author': 'Cornelia Funke', 'genre': 'Fantasy', 'tags': ['dragons']},
+    {'id': 'dune', 'title': 'Dune', 'author': 'Frank Herbert', 'genre': 'Science Fiction', 'notes': 'Read with Tolkien'},
+]
+
+
+def _open(kind, path):
+    if kind == 'sqlite':
+        return SqliteRepository(str(path / "library.db"))
+    store = JournalStore(str(path / "library.json"))
+    return JsonRepository(store, store.open())
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    repo = _open(request.param, tmp_path)
+    repo.add_books(BOOKS)
+    return repo
+
+
+def _ids(books):
+    return [book['id'] for book in books]
+
+
+def test_title_match_ranks_above_notes(repo):
+    assert _ids(repo.search_books('tolkien'))[-1] == 'dune'
+    assert _ids(repo.search_books('dragon'))[0] == 'dragon'
+
+
+def test_every_word_must_match(repo):
+    assert _ids(repo.search_books('tolkien hobbit')) == ['hobbit']
+    assert repo.search_books('hobbit rings') == []
+
+
+def test_last_word_is_a_prefix(repo):
+    assert set(_ids(repo.search_books('tolk'))) == {'hobbit', 'rings', 'dune'}
+    assert repo.search_books('tolk fantasy') == []
+    assert set(_ids(repo.search_books('tolk* fantasy'))) == {'hobbit', 'rings'}
+
+
+def test_field_qualifier(repo):
+    assert set(_ids(repo.search_books('author:tolkien'))) == {'hobbit', 'rings'}
+
+
+def test_search_follows_writes(repo):
+    repo.update_book('dune', {'title': 'Dune Messiah'})
+    assert _ids(repo.search_books('messiah')) == ['dune']
+    repo.delete_book('hobbit')
+    assert 'hobbit' not in _ids(repo.search_books('tolkien'))
+
+
+@pytest.mark.parametrize('query', ['b', 'b0', 'b01', 'b015word', 'word', 'b1 author'])
+def test_prefixes_match_every_book_on_both_backends(tmp_path, query):
+    books = [{'id': f'{i:03d}', 'title': f'b{i:03d}word', 'author': 'Author'} for i in range(200)]
+    results = []
+    for kind in ['json', 'sqlite']:
+        (tmp_path / kind).mkdir()
+        repo = _open(kind, tmp_path / kind)
+        repo.add_books(books)
+        results.append(sorted(_ids(repo.search_books(query))))
+    assert results[0] == results[1]
+    assert len(results[0]) == {'b': 200, 'b0': 100, 'b01': 10, 'b015word': 1, 'word': 0, 'b1 author': 0}[query]
@@ -0,0 +1,69 @@
+import pytest
+
+from sharding import ShardedRepository, create_library, shard_of
+
+SHARDS = 3
+
+
+def _books(count):
+    return [{'id': f'b{i:02d}', 'title': f'Book {i:02d}', 'author': f'Author {i % 4}', 'year': 1900 + i} for i in range(count)]
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    path = create_library(str(tmp_path), "Shelf", shards=SHARDS, backend=request.param)
+    repo = ShardedRepository.open(path)
+    repo.add_books(_books(20))
+    repo.set_collection('Favourites', ['b03', 'b01'])
+    repo.add_to_reading_list(['b05', 'b02'])
+    return repo
+
+
+def test_books_are_routed_by_id(repo):
+    for index, shard in enumerate(repo.shards):
+        assert all(shard_of(book['id'], SHARDS) == index for book in shard.iter_books())
+    assert sum(shard.count_books() for shard in repo.shards) == 20
+    assert repo.get_book('b07')['title'] == 'Book 07'
+
+
+def test_reads_merge_the_shards_in_order(repo):
+    assert [book['id'] for book in repo.get_books(['b09', 'b00', 'missing', 'b04'])] == ['b09', 'b00', 'b04']
+    books = repo.query_books(sort_by='year', descending=True, limit=5, offset=2)
+    assert [book['year'] for book in books] == [1917, 1916, 1915, 1914, 1913]
+    total, books = repo.filter_books({'author': ['Author 1']}, sort_by='title')
+    assert total == 5
+    assert [book['id'] for book in books] == ['b01', 'b05', 'b09', 'b13', 'b17']
+
+
+def test_replace_assigns_missing_ids(repo):
+    repo.replace({'books': [{'title': 'No id', 'author': 'Someone'}], 'collections': {}, 'reading_list': []})
+    assert [book['title'] for book in repo.iter_books()] == ['No id']
+    assert repo.collections() == {}
+
+
+@pytest.mark.parametrize('bad', [{'id': 5, 'title': 'Numeric id'}, 'not a book'])
+def test_invalid_replace_changes_no_shard(repo, bad):
+    with pytest.raises(ValueError):
+        repo.replace({'books': _books(3) + [bad], 'collections': {}, 'reading_list': []})
+    assert repo.count_books() == 20
+    assert repo.collections() == {'Favourites': ['b03', 'b01']}
+
+
+def test_failing_shard_puts_every_shard_back(repo):
+    shard = repo.shards[-1]
+    replace = shard.replace
+    calls = []
+
+    def fail_first(data):
+        calls.append(data)
+        if len(calls) == 1:
+            list(data['books'])
+            raise OSError("disk full")
+        replace(data)
+
+    shard.replace = fail_first
+    with pytest.raises(OSError):
+        repo.replace({'books': _books(40)[20:], 'collections': {'New': ['b30']}, 'reading_list': ['b31']})
+    assert sorted(book['id'] for book in repo.iter_books()) == [f'b{i:02d}' for i in range(20)]
+    assert repo.collections() == {'Favourites': ['b03', 'b01']}
+    assert repo.reading_list() == ['b05', 'b02']